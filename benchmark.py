@@ -0,0 +1,360 @@
+"""Benchmarks for mygit's core command paths.
+
+Generates a synthetic repository (file count, directory depth, file size
+and history length are configurable), then times add, status, write_tree,
+commit, find_missing_objects, create_pack and push (against a local fake
+receive-pack server) and prints the results as JSON, so runs of different
+versions can be compared. Each step runs in its own Python process, so the
+peak RSS reported for it is that step's alone. With MYGIT_TRACE2 set, each
+step also writes trace events like a mygit command (see trace_command).
+"""
+import argparse, contextlib, hashlib, http.server, json, os, random, shutil
+import subprocess, sys, tempfile, threading, time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import mygit
+
+
+AUTHOR = 'Bench Mark <bench@example.com>'
+
+WORDS = ('alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu '
+         'nu xi omicron pi rho sigma tau upsilon phi chi psi omega').split()
+
+
+def generate_paths(files, depth):
+    #Return list of file paths, spread over directories depth levels deep
+    fanout = max(2, round(files ** (1 / (depth + 1)))) if depth else 1
+    paths = []
+    for i in range(files):
+        dirs = ['d{}'.format((i // fanout ** level) % fanout)
+                for level in range(depth, 0, -1)]
+        paths.append('/'.join(dirs + ['f{}.txt'.format(i)]))
+    return paths
+
+def generate_contents(rng, size):
+    #Return about size bytes of text made of lines of random words
+    lines = []
+    length = 0
+    while length < size:
+        line = ' '.join(rng.choice(WORDS) for _ in range(8)) + '\n'
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines).encode()[:size]
+
+def generate_repo(path, files, depth, file_size, seed=0):
+    """Create repo at given path with files files of file_size bytes
+    spread over depth levels of directories. Return list of paths."""
+    rng = random.Random(seed)
+    with contextlib.redirect_stdout(sys.stderr):
+        mygit.init(path)
+    paths = generate_paths(files, depth)
+    for file_path in paths:
+        full_path = os.path.join(path, file_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        mygit.write_file(full_path, generate_contents(rng, file_size))
+    return paths
+
+def modify_files(paths, count, rng):
+    #Rewrite a few lines of count randomly chosen files, return their paths
+    chosen = rng.sample(paths, min(count, len(paths)))
+    for path in chosen:
+        lines = mygit.read_file(path).split(b'\n')
+        for _ in range(3):
+            lines[rng.randrange(len(lines))] = ' '.join(
+                    rng.choice(WORDS) for _ in range(8)).encode()
+        mygit.write_file(path, b'\n'.join(lines))
+    return chosen
+
+def total_size(paths):
+    #Return total size in bytes of given files
+    return sum(os.path.getsize(p) for p in paths)
+
+
+class FakeReceivePack(http.server.BaseHTTPRequestHandler):
+    """Smart HTTP handler that speaks just enough git-receive-pack for
+    push: it advertises the refs in self.server.refs, checks the pack's
+    header and trailing SHA-1 as it streams in (without storing it), then
+    updates the ref and reports success."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        lines = [b'# service=git-receive-pack']
+        refs = sorted(self.server.refs.items())
+        capabilities = b'\x00report-status ofs-delta'
+        if refs:
+            lines.append('{} {}'.format(refs[0][1], refs[0][0]).encode() +
+                         capabilities)
+            lines += ['{} {}'.format(s, r).encode() for r, s in refs[1:]]
+        else:
+            lines.append(b'0' * 40 + b' capabilities^{}' + capabilities)
+        body = mygit.build_lines_data(lines[:1]) + \
+                mygit.build_lines_data(lines[1:])
+        self.send_body('application/x-git-receive-pack-advertisement', body)
+
+    def iter_body(self):
+        #Generate request body in pieces, undoing chunked encoding
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers['Content-Length'])
+            while remaining:
+                chunk = self.rfile.read(min(remaining, 65536))
+                remaining -= len(chunk)
+                yield chunk
+
+    def do_POST(self):
+        body = self.iter_body()
+        buffer = b''
+        def read(n):
+            nonlocal buffer
+            while len(buffer) < n:
+                chunk = next(body, b'')
+                if not chunk:
+                    break
+                buffer += chunk
+            data, buffer = buffer[:n], buffer[n:]
+            return data
+        commands = []
+        for line in mygit.read_pkt_lines(read):
+            if line is mygit.PktLine.flush:
+                break
+            commands.append(line.split(b'\x00')[0].decode().split())
+        #Hash the pack as it arrives, holding back the 20-byte trailer
+        sha = hashlib.sha1()
+        pending = buffer
+        size = len(buffer)
+        for chunk in body:
+            size += len(chunk)
+            pending += chunk
+            sha.update(pending[:-20])
+            pending = pending[-20:]
+        self.server.pack_bytes += size
+        unpack_ok = len(pending) == 20 and sha.digest() == pending
+        report = [b'unpack ok' if unpack_ok else b'unpack checksum mismatch']
+        for old_sha1, new_sha1, ref in commands:
+            if unpack_ok:
+                self.server.refs[ref] = new_sha1
+                report.append('ok {}'.format(ref).encode())
+            else:
+                report.append('ng {} unpack failed'.format(ref).encode())
+        self.send_body('application/x-git-receive-pack-result',
+                       mygit.build_lines_data(report))
+
+
+def start_server():
+    """Start fake receive-pack server on a free local port in a background
+    thread, return it (its URL is server.url)."""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             FakeReceivePack)
+    server.refs = {}
+    server.pack_bytes = 0
+    server.url = 'http://127.0.0.1:{}/bench.git'.format(server.server_port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def settle_index(paths):
+    """Wait until the clock has passed the modification time of the files
+    and refresh the index, so no entry is racily clean and status only
+    hashes files that really changed (as it would long after an edit)."""
+    newest = max(os.stat(p).st_mtime for p in paths + ['.git/index'])
+    while time.time() < int(newest) + 1:
+        time.sleep(0.05)
+    mygit.get_status()
+
+def run_step(step, params):
+    """Run one benchmark step in the current process (in the benchmark
+    repo) and return dict of its seconds plus the amount of work it did
+    (files and bytes, where that makes sense)."""
+    rng = random.Random(params['seed'] + 1)
+    paths = generate_paths(params['files'], params['depth'])
+    jobs = params['jobs']
+    result = {}
+    start = time.perf_counter()
+    if step == 'add':
+        mygit.add(paths, jobs=jobs)
+        result.update(files=len(paths), bytes=total_size(paths))
+    elif step == 'status_clean':
+        settle_index(paths)
+        start = time.perf_counter()
+        mygit.get_status(jobs=jobs)
+        result.update(files=len(paths))
+    elif step == 'status_modified':
+        settle_index(paths)
+        modified = modify_files(paths, params['changes'], rng)
+        start = time.perf_counter()
+        changed, _, _ = mygit.get_status(jobs=jobs)
+        assert sorted(changed) == sorted(modified)
+        result.update(files=len(paths), bytes=total_size(modified))
+        #Put the files back for the following steps
+        mygit.add(modified, jobs=jobs)
+    elif step == 'write_tree':
+        mygit.write_tree()
+        result.update(files=len(paths))
+    elif step == 'commit':
+        mygit.commit('initial commit', AUTHOR)
+        result.update(files=len(paths))
+    elif step == 'history':
+        modified_bytes = 0
+        for i in range(params['history']):
+            modified = modify_files(paths, params['changes'], rng)
+            modified_bytes += total_size(modified)
+            mygit.add(modified, jobs=jobs)
+            mygit.commit('commit {}'.format(i + 1), AUTHOR)
+        result.update(files=params['history'] * params['changes'],
+                      bytes=modified_bytes, commits=params['history'])
+    elif step in ('find_missing_objects', 'create_pack'):
+        local_sha1 = mygit.get_local_main_hash()
+        objects = mygit.find_missing_objects(local_sha1, None)
+        if step == 'create_pack':
+            start = time.perf_counter()
+            pack = mygit.create_pack(objects)
+            result.update(bytes=len(pack))
+        result.update(objects=len(objects))
+    elif step == 'push':
+        _, missing = mygit.push(params['url'])
+        result.update(objects=len(missing))
+    else:
+        raise ValueError('unknown step {!r}'.format(step))
+    result['seconds'] = time.perf_counter() - start
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #ru_maxrss is in bytes on macOS, kilobytes elsewhere
+        if sys.platform != 'darwin':
+            peak *= 1024
+        result['peak_rss_mb'] = round(peak / 1e6, 1)
+    return result
+
+def run_step_process(step, repo, params):
+    """Run step in a new Python process inside repo and return its result
+    dict, with throughput added."""
+    output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--step', step,
+             '--params', json.dumps(params)],
+            cwd=repo, env=dict(os.environ,
+                               PYTHONPATH=os.path.dirname(mygit.__file__)))
+    result = json.loads(output.decode().splitlines()[-1])
+    seconds = result['seconds']
+    if 'files' in result and seconds:
+        result['files_per_sec'] = round(result['files'] / seconds, 1)
+    if 'bytes' in result and seconds:
+        result['mb_per_sec'] = round(result['bytes'] / seconds / 1e6, 2)
+    result['seconds'] = round(seconds, 4)
+    return result
+
+STEPS = ['add', 'status_clean', 'status_modified', 'write_tree', 'commit',
+         'history', 'find_missing_objects', 'create_pack', 'push']
+
+def benchmark(files=1000, depth=3, file_size=4096, history=20, changes=10,
+              jobs=None, seed=0, steps=None, keep=False):
+    """Generate a synthetic repo and run benchmark steps on it in order
+    (all of STEPS by default). Return dict of parameters and results."""
+    params = dict(files=files, depth=depth, file_size=file_size,
+                  history=history, changes=changes, jobs=jobs, seed=seed)
+    temp_dir = tempfile.mkdtemp(prefix='mygit-bench-')
+    repo = os.path.join(temp_dir, 'repo')
+    server = start_server()
+    try:
+        start = time.perf_counter()
+        generate_repo(repo, files, depth, file_size, seed=seed)
+        generate_seconds = time.perf_counter() - start
+        results = {}
+        for step in steps or STEPS:
+            pack_bytes = server.pack_bytes
+            result = run_step_process(step, repo, dict(params, url=server.url))
+            if step == 'push':
+                result['bytes'] = server.pack_bytes - pack_bytes
+                if result['seconds']:
+                    result['mb_per_sec'] = round(
+                            result['bytes'] / result['seconds'] / 1e6, 2)
+            results[step] = result
+    finally:
+        server.shutdown()
+        if keep:
+            print('kept benchmark repo in', repo, file=sys.stderr)
+        else:
+            shutil.rmtree(temp_dir)
+    return {
+        'mygit_sha1': hashlib.sha1(mygit.read_file(mygit.__file__))
+                      .hexdigest(),
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'params': params,
+        'generate_seconds': round(generate_seconds, 4),
+        'results': results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description='benchmark mygit on a synthetic repository')
+    parser.add_argument('--files', type=int, default=1000,
+            help='number of files in the repo (default %(default)r)')
+    parser.add_argument('--depth', type=int, default=3,
+            help='directory levels the files are spread over (default '
+            '%(default)r)')
+    parser.add_argument('--file-size', type=int, default=4096,
+            help='size of each file in bytes (default %(default)r)')
+    parser.add_argument('--history', type=int, default=20,
+            help='number of commits after the initial one (default '
+            '%(default)r)')
+    parser.add_argument('--changes', type=int, default=10,
+            help='files modified per commit (default %(default)r)')
+    parser.add_argument('-j', '--jobs', type=int,
+            help='number of worker threads for hashing (default: number of '
+            'CPUs)')
+    parser.add_argument('--seed', type=int, default=0,
+            help='random seed for the generated contents (default '
+            '%(default)r)')
+    parser.add_argument('--steps', nargs='+', choices=STEPS, metavar='step',
+            help='steps to run, in order (default: all of {})'.format(
+            ', '.join(STEPS)))
+    parser.add_argument('-o', '--output',
+            help='file to write JSON results to (default: stdout)')
+    parser.add_argument('--keep', action='store_true',
+            help="don't delete the generated repo afterwards")
+    parser.add_argument('--step', help=argparse.SUPPRESS)
+    parser.add_argument('--params', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.step:
+        #Child process running one step: silence mygit's own output and
+        #print only the result (the step is traced like a mygit command
+        #if MYGIT_TRACE2 is set)
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull), \
+                mygit.trace_command(sys.argv, args.step):
+            result = run_step(args.step, json.loads(args.params))
+        print(json.dumps(result))
+        sys.exit(0)
+
+    report = benchmark(files=args.files, depth=args.depth,
+                       file_size=args.file_size, history=args.history,
+                       changes=args.changes, jobs=args.jobs, seed=args.seed,
+                       steps=args.steps, keep=args.keep)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        mygit.write_file(args.output, (output + '\n').encode())
+    else:
+        print(output)
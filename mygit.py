@@ -1,23 +1,272 @@
-import argparse, collections, difflib, enum, hashlib, operator,stat
-import struct, sys, time, urllib.request, zlib
-import os
+import collections, enum, functools, hashlib, heapq
+import bisect, operator, stat
+import itertools, mmap, struct, sys, time, zlib
+import contextlib, io, os, threading
+#Modules only some commands need (argparse, http.client, tempfile,
+#concurrent.futures and the like) are imported by the functions using
+#them, as importing them all up front took longer than most commands
+
+#The daemon's socket, frame format and client live in the thin entry
+#point, which talks to a running daemon without loading this module
+from mygit_client import (
+        DAEMON_SOCKET, FRAME_BUSY, FRAME_COMMAND, FRAME_EXIT, FRAME_READ,
+        FRAME_STDERR, FRAME_STDIN, FRAME_STDOUT, decode_command,
+        peer_is_same_user, recv_frame, run_daemon_client, send_frame)
 
 
 #Data for one entry in the git index(.git/index)
+#(extended_flags holds the extra 16 bits of flags of version 3+ entries)
 IndexEntry = collections.namedtuple('IndexEntry', [
         'ctime_s', 'ctime_n', 'mtime_s', 'mtime_n', 'dev', 'ino', 'mode',
-        'uid', 'gid', 'size', 'sha1', 'flags', 'path',
+        'uid', 'gid', 'size', 'sha1', 'flags', 'path', 'extended_flags',
+    ], defaults=[0])
+
+#Fixed-size fields at the start of each index entry, and the bit in flags
+#that says an entry has extended flags
+INDEX_ENTRY_FIELDS = struct.Struct('!LLLLLLLLLL20sH')
+INDEX_EXTENDED_FLAG = 0x4000
+
+
+
+
+#Contents of the git index: version number, list of IndexEntry objects and
+#dict mapping extension signature (such as b'TREE') to raw extension data
+IndexFile = collections.namedtuple('IndexFile', [
+        'version', 'entries', 'extensions',
+    ])
+
+#One compiled line of a .gitignore or info/exclude file: the directory the
+#file is in ('' for the top), the compiled pattern, and whether the line
+#is negated (!), only matches directories (trailing /) and is matched
+#against the whole path below base rather than just the file name
+IgnoreRule = collections.namedtuple('IgnoreRule', [
+        'base', 'regex', 'negate', 'dir_only', 'anchored',
+    ])
+
+#Cached listing of one working copy directory: its mtime, a key for the
+#ignore rules that applied, and its non-ignored file and subdirectory names
+UntrackedDir = collections.namedtuple('UntrackedDir', [
+        'mtime_ns', 'rules_key', 'files', 'subdirs',
+    ])
+
+#Data for one parsed commit object
+Commit = collections.namedtuple('Commit', [
+        'tree', 'parents', 'author', 'committer', 'timestamp', 'message',
     ])
 
+#What history walks need to know about a commit; generation is the
+#commit's topological level from the commit-graph (1 for root commits),
+#or GENERATION_INFINITY if it isn't in the commit-graph
+CommitInfo = collections.namedtuple('CommitInfo', [
+        'tree', 'parents', 'timestamp', 'generation',
+    ])
+GENERATION_INFINITY = 0xffffffff
+
+#A memory-mapped commit-graph file: the mmap, its 256-entry fanout table
+#and the offsets of its OID list, commit data and extra edges chunks
+CommitGraph = collections.namedtuple('CommitGraph', [
+        'data', 'fanout', 'oids_offset', 'commits_offset', 'edges_offset',
+    ])
+
+#Number of parsed commits and trees kept in memory by parse_commit and
+#read_tree_entries
+OBJECT_CACHE_SIZE = 16384
+
+#A memory-mapped pack: path without extension, the 256-entry fanout table
+#and mmaps of the .idx and .pack files
+PackFile = collections.namedtuple('PackFile', [
+        'path', 'fanout', 'index', 'data',
+    ])
 
 
+class PktLine(enum.Enum):
+    
+    #Special pkt-lines of the git protocol, by their length field
+    flush = 0
+    delim = 1
+    response_end = 2
+
 
 class ObjectType(enum.Enum):
     
     commit = 1
     tree = 2
     blob = 3
-    
+    tag = 4
+    ofs_delta = 6
+    ref_delta = 7
+
+
+#Where trace events go, as set when the process started: MYGIT_TRACE2=1
+#writes them to stderr, any other value is a file path to append them to.
+#Tracing is off when it's unset, and then trace_timer leaves functions
+#undecorated and trace_region and trace_count return straight away
+TRACE_TARGET = os.environ.get('MYGIT_TRACE2')
+
+#File trace events are written to (None when not tracing), perf_counter
+#time and session id of the traced command, per-thread region nesting,
+#and counters and timers (name -> [intervals, total, min, max]) reported
+#when it exits
+_trace = None
+_trace_start = 0.0
+_trace_sid = None
+_trace_lock = threading.Lock()
+_trace_local = threading.local()
+_trace_counters = collections.Counter()
+_trace_timers = {}
+
+def format_trace_time(timestamp):
+    #Format Unix timestamp as UTC time with microseconds, like trace2
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + \
+            '.{:06d}Z'.format(int(timestamp % 1 * 1000000))
+
+def trace_event(event, **fields):
+    """Write one trace event as a line of JSON, in the shape of git's
+    trace2 event format (event name, session id, thread name, time, then
+    the given fields)."""
+    import json
+    now = time.time()
+    record = {'event': event, 'sid': _trace_sid,
+              'thread': threading.current_thread().name,
+              'time': format_trace_time(now)}
+    record.update(fields)
+    line = json.dumps(record) + '\n'
+    with _trace_lock:
+        _trace.write(line)
+        _trace.flush()
+
+def trace_count(name, count=1):
+    #Add count to the counter of given name, if tracing
+    if _trace is None:
+        return
+    with _trace_lock:
+        _trace_counters[name] += count
+
+def trace_timer(name):
+    """Decorator that adds the number of calls to the function and the
+    time spent in them to the timer of given name, reported when the
+    command exits. (Recursive calls are counted at every level.) When
+    MYGIT_TRACE2 isn't set the function is returned as it is, so the
+    decorator costs nothing."""
+    def decorate(func):
+        if not TRACE_TARGET:
+            return func
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            if _trace is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with _trace_lock:
+                    timer = _trace_timers.setdefault(
+                            name, [0, 0.0, elapsed, elapsed])
+                    timer[0] += 1
+                    timer[1] += elapsed
+                    timer[2] = min(timer[2], elapsed)
+                    timer[3] = max(timer[3], elapsed)
+        return timed
+    return decorate
+
+@contextlib.contextmanager
+def _traced_region(category, label, msg):
+    nesting = getattr(_trace_local, 'nesting', 0) + 1
+    _trace_local.nesting = nesting
+    fields = dict(nesting=nesting, category=category, label=label)
+    if msg is not None:
+        fields['msg'] = msg
+    trace_event('region_enter', **fields)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _trace_local.nesting = nesting - 1
+        trace_event('region_leave',
+                    t_rel=round(time.perf_counter() - start, 6), **fields)
+
+_untraced_region = contextlib.nullcontext()
+
+def trace_region(category, label, msg=None):
+    """Return context manager that records the code run in it as a timed
+    region (region_enter and region_leave events) of given category and
+    label, with an optional message, or does nothing if not tracing."""
+    if _trace is None:
+        return _untraced_region
+    return _traced_region(category, label, msg)
+
+@contextlib.contextmanager
+def trace_command(argv, name):
+    """Context manager to run a command in: if MYGIT_TRACE2 is set, trace
+    events are written from start (with argv) to exit (with the exit code
+    and the total time), with the counters and timers in between. If
+    MYGIT_TRACE2_PROFILE is set to a path, the command is also run under
+    cProfile and its stats are dumped to that path (read them with the
+    pstats module)."""
+    global _trace, _trace_start, _trace_sid
+    #Read at each command, as the daemon runs them with the client's
+    #environment (its timers still depend on how the daemon was started)
+    target = os.environ.get('MYGIT_TRACE2')
+    profile_path = os.environ.get('MYGIT_TRACE2_PROFILE')
+    if target:
+        if target.lower() in ('1', '2', 'true'):
+            _trace = sys.stderr
+        else:
+            _trace = open(target, 'a')
+        _trace_counters.clear()
+        _trace_timers.clear()
+        _trace_start = time.perf_counter()
+        _trace_sid = '{}-P{:08x}'.format(
+                time.strftime('%Y%m%dT%H%M%S', time.gmtime()), os.getpid())
+        trace_event('start', t_abs=0.0, argv=list(argv))
+        trace_event('cmd_name', name=name)
+    if profile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    code = 0
+    try:
+        yield
+    except SystemExit as error:
+        code = error.code if isinstance(error.code, int) else \
+                int(error.code is not None)
+        raise
+    except BaseException as error:
+        code = 1
+        if _trace is not None:
+            trace_event('error', msg='{}: {}'.format(type(error).__name__,
+                                                     error))
+        raise
+    finally:
+        if profile_path:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        if _trace is not None:
+            for func in (parse_commit, read_tree_entries):
+                info = func.cache_info()
+                if not info.hits and not info.misses:
+                    continue
+                _trace_counters['cache/{}_hits'.format(func.__name__)] = \
+                        info.hits
+                _trace_counters['cache/{}_misses'.format(func.__name__)] = \
+                        info.misses
+            for counter, count in sorted(_trace_counters.items()):
+                category, _, counter = counter.rpartition('/')
+                trace_event('counter', category=category, name=counter,
+                            count=count)
+            for timer, (intervals, total, t_min, t_max) in sorted(
+                    _trace_timers.items()):
+                category, _, timer = timer.rpartition('/')
+                trace_event('timer', category=category, name=timer,
+                            intervals=intervals, t_total=round(total, 6),
+                            t_min=round(t_min, 6), t_max=round(t_max, 6))
+            trace_event('exit', t_abs=round(
+                    time.perf_counter() - _trace_start, 6), code=code)
+            if _trace is not sys.stderr:
+                _trace.close()
+            _trace = None
+
 def read_file(path):
     with open(path, 'rb') as f:
         return f.read()
@@ -26,6 +275,22 @@ def write_file(path, data):
     with open(path, 'wb') as f:
         f.write(data)
 
+def write_locked_file(path, data):
+    """Replace file at given path with data the way git does: write it to
+    path + '.lock', created exclusively, then rename that into place, so
+    readers see either the old or the new file, never a partial one. Raise
+    FileExistsError if the lock file exists (another process is writing
+    the file, or one crashed while writing it)."""
+    lock_path = path + '.lock'
+    fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+    except BaseException:
+        os.remove(lock_path)
+        raise
+    os.replace(lock_path, path)
+
 def init(repo):
     #Create a dict for repo and initialize .git directory
     os.mkdir(repo)
@@ -37,40 +302,522 @@ def init(repo):
                b'ref: refs/heads/main')
     print('initialized empty repository: {}'.format(repo))
     
+@trace_timer('objects/hash_data')
 def hash_objects(data, obj_type, write=True):
     """Compute hash of object data of given type and write to object store
     if 'write' is True. Return SHA-1 object has as hex string."""
     header = '{} {}'.format(obj_type, len(data)).encode()
     full_data = header + b'\x00' + data
     sha1 = hashlib.sha1(full_data).hexdigest()
-    print('Computed SHA-1 hash:', sha1)
     if write:
         path = os.path.join('.git', 'objects', sha1[:2], sha1[2:])
         if not os.path.exists(path):
+            import tempfile
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            #Write to a temp file first so concurrent writers of the same
+            #object never expose a partially written file
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(zlib.compress(full_data))
+            os.replace(temp_path, path)
+            forget_loose_objects()
+            trace_count('objects/written')
+    return sha1
+
+@trace_timer('objects/hash_file')
+def hash_object_file(path, obj_type='blob', write=True, chunk_size=65536):
+    """Compute hash of contents of file at given path as an object of given
+    type, and write it to object store if 'write' is True, reading,
+    hashing and compressing the file in pieces of chunk_size bytes so that
+    memory use doesn't grow with the file size. Return SHA-1 object hash as
+    hex string (the same as hash_objects would). Raise ValueError if the
+    file's size changes while it is read, as the object header has the
+    size from before."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        sha = hashlib.sha1('{} {}\x00'.format(obj_type, size).encode())
+        if write:
+            import tempfile
+            os.makedirs(os.path.join('.git', 'objects'), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(
+                    dir=os.path.join('.git', 'objects'))
+            out = os.fdopen(fd, 'wb')
+            compressor = zlib.compressobj()
+            out.write(compressor.compress(
+                    '{} {}\x00'.format(obj_type, size).encode()))
+        try:
+            num_read = 0
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                num_read += len(chunk)
+                sha.update(chunk)
+                if write:
+                    out.write(compressor.compress(chunk))
+            if num_read != size:
+                raise ValueError('{} changed while being hashed: expected '
+                                 '{} bytes, read {}'.format(
+                                 path, size, num_read))
+            if write:
+                out.write(compressor.flush())
+                out.close()
+        except BaseException:
+            if write:
+                out.close()
+                os.remove(temp_path)
+            raise
+    sha1 = sha.hexdigest()
+    trace_count('objects/hashed_bytes', size)
+    if write:
+        path = os.path.join('.git', 'objects', sha1[:2], sha1[2:])
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
             os.makedirs(os.path.dirname(path), exist_ok=True)
-            write_file(path, zlib.compress(full_data))
+            os.replace(temp_path, path)
+            forget_loose_objects()
+            trace_count('objects/written')
     return sha1
 
+def hash_paths(paths, write=True, jobs=None):
+    """Hash contents of given file paths as blobs (writing them to object
+    store if 'write' is True) using a pool of 'jobs' worker threads, one per
+    CPU by default. Return list of SHA-1 hex strings in the same order as
+    paths. hashlib and zlib release the GIL on large buffers, so the work
+    spreads across cores. A symlink is hashed as a blob of its target path,
+    like git stores it."""
+    def hash_path(path):
+        if os.path.islink(path):
+            return hash_objects(os.fsencode(os.readlink(path)), 'blob',
+                                write=write)
+        return hash_object_file(path, 'blob', write=write)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    trace_count('objects/hashed_files', len(paths))
+    with trace_region('objects', 'hash_paths', msg='{} files'.format(
+            len(paths))):
+        if jobs <= 1 or len(paths) <= 1:
+            return [hash_path(p) for p in paths]
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs) as executor:
+            return list(executor.map(hash_path, paths))
+
+def open_pack(path):
+    """Memory-map the version 2 .idx and .pack files at given path (without
+    extension) and return a PackFile."""
+    with open(path + '.idx', 'rb') as f:
+        index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    signature, version = struct.unpack('!4sL', index[:8])
+    assert signature == b'\xfftOc', \
+        'invalid pack index signature {}'.format(signature)
+    assert version == 2, 'unknown pack index version {}'.format(version)
+    fanout = struct.unpack('!256L', index[8:1032])
+    with open(path + '.pack', 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    signature, version, num_objects = struct.unpack('!4sLL', data[:12])
+    assert signature == b'PACK', \
+        'invalid pack signature {}'.format(signature)
+    assert version == 2, 'unknown pack version {}'.format(version)
+    assert num_objects == fanout[255], \
+        'expected {} objects in pack, got {}'.format(fanout[255], num_objects)
+    return PackFile(path, fanout, index, data)
+
+#Cache of (pack directory mtime, list of PackFile) so packs are only
+#opened and mapped once per process
+_packs = (None, [])
+
+def get_packs():
+    #Return list of PackFile for all packs in the object store
+    global _packs
+    pack_dir = os.path.join('.git', 'objects', 'pack')
+    try:
+        mtime = os.stat(pack_dir).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    if mtime != _packs[0]:
+        opened = {p.path: p for p in _packs[1]}
+        packs = []
+        for name in sorted(os.listdir(pack_dir)):
+            if name.endswith('.idx'):
+                path = os.path.join(pack_dir, name[:-4])
+                packs.append(opened.get(path) or open_pack(path))
+        _packs = (mtime, packs)
+    return _packs[1]
+
+def pack_sha1(pack, i):
+    #Return binary SHA-1 of the i'th object (in sorted order) of pack
+    start = 1032 + 20 * i
+    return pack.index[start:start + 20]
+
+def pack_offset(pack, i):
+    #Return offset in the .pack file of the i'th object of pack
+    num_objects = pack.fanout[255]
+    start = 1032 + 24 * num_objects + 4 * i
+    offset, = struct.unpack('!L', pack.index[start:start + 4])
+    if offset & 0x80000000:
+        start = 1032 + 28 * num_objects + 8 * (offset & 0x7fffffff)
+        offset, = struct.unpack('!Q', pack.index[start:start + 8])
+    return offset
+
+def pack_position(pack, key):
+    #Return index of first object in pack (in sorted order) whose binary
+    #SHA-1 is not less than key, binary-searching the fanout range
+    first_byte = key[0]
+    lo = pack.fanout[first_byte - 1] if first_byte else 0
+    hi = pack.fanout[first_byte]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if pack_sha1(pack, mid) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def find_packed_objects(pack, sha1_prefix):
+    """Return list of (sha1, offset) of objects in pack whose hex SHA-1
+    starts with sha1_prefix, binary-searching the fanout range. At most
+    two matches are returned, enough to detect an ambiguous prefix. The
+    prefix must be lower case hex, as checked by find_object."""
+    first_byte = int(sha1_prefix[:2], 16)
+    lo = pack_position(pack, bytes.fromhex(
+            sha1_prefix + '0' * (len(sha1_prefix) % 2)))
+    matches = []
+    while lo < pack.fanout[first_byte] and len(matches) < 2:
+        sha1 = pack_sha1(pack, lo).hex()
+        if not sha1.startswith(sha1_prefix):
+            break
+        matches.append((sha1, pack_offset(pack, lo)))
+        lo += 1
+    return matches
+
+#Sorted list of binary SHA-1s of all loose objects, or None until needed
+_loose_objects = None
+
+def get_loose_objects():
+    """Return sorted list of binary SHA-1s of all loose objects. The object
+    directories are only listed once, the first time this is needed, after
+    which lookups are a binary search (see forget_loose_objects)."""
+    global _loose_objects
+    loose = _loose_objects
+    if loose is None:
+        try:
+            loose = [bytes.fromhex(s) for s in find_loose_objects()]
+        except FileNotFoundError:
+            loose = []
+        _loose_objects = loose
+    return loose
+
+def forget_loose_objects():
+    #Drop list of loose objects after objects were added or removed, so
+    #it is listed again the next time it's needed
+    global _loose_objects
+    _loose_objects = None
+
+def find_loose_object_matches(sha1_prefix):
+    #Return list of (at most two) hex SHA-1s of loose objects starting with
+    #given prefix
+    loose = get_loose_objects()
+    i = bisect.bisect_left(loose, bytes.fromhex(
+            sha1_prefix + '0' * (len(sha1_prefix) % 2)))
+    matches = []
+    while i < len(loose) and len(matches) < 2:
+        sha1 = loose[i].hex()
+        if not sha1.startswith(sha1_prefix):
+            break
+        matches.append(sha1)
+        i += 1
+    return matches
+
+def shortest_unique_prefix(sha1, min_length=7):
+    """Return shortest prefix (of at least min_length characters) of given
+    hex SHA-1 that no other object in the object store starts with. Only
+    the objects sorting right before and after it in each pack and in the
+    loose objects need to be compared."""
+    key = bytes.fromhex(sha1)
+    neighbors = []
+    for pack in get_packs():
+        i = pack_position(pack, key)
+        for j in (i - 1, i, i + 1):
+            if 0 <= j < pack.fanout[255]:
+                neighbors.append(pack_sha1(pack, j))
+    loose = get_loose_objects()
+    i = bisect.bisect_left(loose, key)
+    neighbors.extend(loose[max(i - 1, 0):i + 2])
+    length = min_length
+    for neighbor in neighbors:
+        if neighbor != key:
+            common = len(os.path.commonprefix([sha1, neighbor.hex()]))
+            length = max(length, common + 1)
+    return sha1[:length]
+
+#Characters a (lower case) hex object name may contain
+HEX_DIGITS = frozenset('0123456789abcdef')
+
 def find_object(sha1_prefix):
-    """Find object with given sha-1 prefix and return path to object in object
-    store, or raise ValueError if there are no objects or multiple with this prefix."""
+    """Find object with given sha-1 prefix and return tuple of (sha1, pack,
+    location). For packed objects pack is a PackFile and location the
+    offset of the object in it, for loose objects pack is None and
+    location the path to object in object store. Packs are searched first.
+    Loose objects are looked up in a sorted list of them (see
+    get_loose_objects), or directly by path given a full hash. Raise
+    ValueError if the prefix isn't hex, or there are no objects or multiple
+    with this prefix."""
     if len(sha1_prefix) < 2:
         raise ValueError('hash prefix must be 2 ore more characters')
-    obj_dir = os.path.join('.git', 'objects', sha1_prefix[:2])
-    rest = sha1_prefix[2:]
-    objects = [name for name in os.listdir(obj_dir) if name.startswith(rest)]
-    if not objects:
+    sha1_prefix = sha1_prefix.lower()
+    if len(sha1_prefix) > 40 or not set(sha1_prefix) <= HEX_DIGITS:
+        raise ValueError('not a valid object name {!r}'.format(sha1_prefix))
+    found = {}
+    for pack in get_packs():
+        for sha1, offset in find_packed_objects(pack, sha1_prefix):
+            found.setdefault(sha1, (sha1, pack, offset))
+    if len(sha1_prefix) == 40 and found:
+        return found[sha1_prefix]
+    if len(sha1_prefix) == 40:
+        #A full hash names exactly one file, no need to list the objects
+        path = os.path.join('.git', 'objects', sha1_prefix[:2],
+                            sha1_prefix[2:])
+        if not os.path.exists(path):
+            raise ValueError('object {!r} not found'.format(sha1_prefix))
+        return (sha1_prefix, None, path)
+    for sha1 in find_loose_object_matches(sha1_prefix):
+        found.setdefault(sha1, (sha1, None, os.path.join(
+                '.git', 'objects', sha1[:2], sha1[2:])))
+    if not found:
         raise ValueError('object {!r} not found'.format(sha1_prefix))
-    if len(objects) >= 2:
+    if len(found) >= 2:
         raise ValueError('multiple objects ({}) with prefix {!r}'.format(
-            len(objects), sha1_prefix))
-    return os.path.join(obj_dir, objects[0])
+            len(found), sha1_prefix))
+    return next(iter(found.values()))
+
+def read_pack_header(data, offset):
+    """Parse variable-length pack object header at given offset of data,
+    return tuple of (type_num, size, offset_after_header)."""
+    byte = data[offset]
+    offset += 1
+    type_num = (byte >> 4) & 7
+    size = byte & 0x0f
+    shift = 4
+    while byte & 0x80:
+        byte = data[offset]
+        offset += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+    return (type_num, size, offset)
+
+@trace_timer('zlib/inflate_pack')
+def inflate_at(data, offset, size):
+    """Decompress the zlib stream starting at given offset of data (which
+    must inflate to size bytes) and return the decompressed bytes."""
+    decompressor = zlib.decompressobj()
+    chunks = []
+    chunk_size = size + 64
+    while not decompressor.eof:
+        chunk = data[offset:offset + chunk_size]
+        if not chunk:
+            raise ValueError('truncated pack object')
+        chunks.append(decompressor.decompress(chunk))
+        offset += chunk_size
+        chunk_size = 65536
+    result = b''.join(chunks)
+    assert len(result) == size, 'expected size {}, got {} bytes'.format(
+        size, len(result))
+    return result
+
+def read_delta_size(delta, i):
+    #Read variable-length size from delta at index i, return (size, new_i)
+    size = shift = 0
+    while True:
+        byte = delta[i]
+        i += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return (size, i)
+
+@trace_timer('pack/apply_delta')
+def apply_delta(base, delta):
+    """Apply git delta instructions in delta to base bytes and return the
+    resulting bytes."""
+    base_size, i = read_delta_size(delta, 0)
+    assert base_size == len(base), 'expected base size {}, got {}'.format(
+        base_size, len(base))
+    result_size, i = read_delta_size(delta, i)
+    result = []
+    while i < len(delta):
+        op = delta[i]
+        i += 1
+        if op & 0x80:
+            #Copy from base: up to 4 offset bytes and 3 size bytes
+            offset = size = 0
+            for bit in range(4):
+                if op & (1 << bit):
+                    offset |= delta[i] << (8 * bit)
+                    i += 1
+            for bit in range(3):
+                if op & (0x10 << bit):
+                    size |= delta[i] << (8 * bit)
+                    i += 1
+            result.append(base[offset:offset + (size or 0x10000)])
+        elif op:
+            #Insert the next op bytes of delta
+            result.append(delta[i:i + op])
+            i += op
+        else:
+            raise ValueError('invalid delta opcode 0')
+    data = b''.join(result)
+    assert len(data) == result_size, 'expected size {}, got {}'.format(
+        result_size, len(data))
+    return data
+
+def read_ofs_distance(data, pos):
+    """Read distance back to the base object of an OFS_DELTA entry at
+    given position of data, return tuple of (distance, new_pos)."""
+    byte = data[pos]
+    pos += 1
+    distance = byte & 0x7f
+    while byte & 0x80:
+        byte = data[pos]
+        pos += 1
+        distance = ((distance + 1) << 7) | (byte & 0x7f)
+    return (distance, pos)
+
+def read_pack_object(pack, offset):
+    """Read object at given offset of pack, resolving OFS_DELTA and
+    REF_DELTA chains, and return tuple of (object_type, data_bytes)."""
+    deltas = []
+    while True:
+        type_num, size, pos = read_pack_header(pack.data, offset)
+        if type_num == ObjectType.ofs_delta.value:
+            base_distance, pos = read_ofs_distance(pack.data, pos)
+            deltas.append(inflate_at(pack.data, pos, size))
+            offset -= base_distance
+        elif type_num == ObjectType.ref_delta.value:
+            base_sha1 = pack.data[pos:pos + 20].hex()
+            deltas.append(inflate_at(pack.data, pos + 20, size))
+            obj_type, data = read_object(base_sha1)
+            break
+        else:
+            obj_type = ObjectType(type_num).name
+            data = inflate_at(pack.data, pos, size)
+            break
+    for delta in reversed(deltas):
+        data = apply_delta(data, delta)
+    return (obj_type, data)
+
+def inflate_head(read, is_complete, chunk_size=256):
+    """Inflate the start of the zlib stream returned piece by piece by
+    calling read(chunk_size), until is_complete(data) is true for the data
+    inflated so far or the stream ends, and return that data. (A block of
+    the stream may need many input bytes before it outputs anything.)"""
+    decompressor = zlib.decompressobj()
+    head = b''
+    while not is_complete(head) and not decompressor.eof:
+        data = decompressor.unconsumed_tail or read(chunk_size)
+        if not data:
+            raise ValueError('truncated object data')
+        head += decompressor.decompress(data, chunk_size)
+    return head
+
+def read_pack_object_info(pack, offset):
+    """Return tuple of (object_type, size) of object at given offset of
+    pack. Only the headers of the delta chain are inflated."""
+    size = None
+    while True:
+        type_num, entry_size, pos = read_pack_header(pack.data, offset)
+        if type_num == ObjectType.ofs_delta.value:
+            base_distance, pos = read_ofs_distance(pack.data, pos)
+            offset -= base_distance
+        elif type_num == ObjectType.ref_delta.value:
+            base_sha1 = pack.data[pos:pos + 20].hex()
+            pos += 20
+        else:
+            return (ObjectType(type_num).name,
+                    entry_size if size is None else size)
+        if size is None:
+            #Delta data starts with base size and result size, two
+            #varints each ending with a byte without the top bit set
+            def read(n):
+                nonlocal pos
+                pos += n
+                return pack.data[pos - n:pos]
+            delta_head = inflate_head(
+                    read, lambda head: sum(b < 0x80 for b in head[:20]) >= 2)
+            _, i = read_delta_size(delta_head, 0)
+            size, _ = read_delta_size(delta_head, i)
+        if type_num == ObjectType.ref_delta.value:
+            return (read_object_info(base_sha1)[0], size)
 
+def read_object_info(sha1_prefix):
+    """Return tuple of (object_type, size) of object with given sha-1
+    prefix, inflating only its header, or raise ValueError if not found."""
+    _, pack, location = find_object(sha1_prefix)
+    if pack is not None:
+        return read_pack_object_info(pack, location)
+    with open(location, 'rb') as f:
+        header = inflate_head(f.read, lambda head: b'\x00' in head)
+    obj_type, size_str = header[:header.index(b'\x00')].decode().split()
+    return (obj_type, int(size_str))
+
+def iter_inflate(read, chunk_size=65536):
+    """Generate decompressed chunks of at most chunk_size bytes from the
+    zlib stream returned piece by piece by calling read(chunk_size)."""
+    decompressor = zlib.decompressobj()
+    while not decompressor.eof:
+        data = decompressor.unconsumed_tail or read(chunk_size)
+        if not data:
+            raise ValueError('truncated object data')
+        chunk = decompressor.decompress(data, chunk_size)
+        if chunk:
+            yield chunk
+
+def iter_object(sha1_prefix, chunk_size=65536):
+    """Read object with given sha-1 prefix and return tuple of
+    (object_type, size, chunks), where chunks is an iterator over the
+    object data in pieces of at most chunk_size bytes, so that large blobs
+    can be processed without holding them in memory. (Deltified objects in
+    packs are resolved in memory first.) Raise ValueError if not found."""
+    _, pack, location = find_object(sha1_prefix)
+    if pack is not None:
+        type_num, size, pos = read_pack_header(pack.data, location)
+        if type_num in (ObjectType.ofs_delta.value,
+                        ObjectType.ref_delta.value):
+            obj_type, data = read_pack_object(pack, location)
+            return (obj_type, len(data), (data[i:i + chunk_size]
+                    for i in range(0, len(data), chunk_size)))
+        def read(n):
+            nonlocal pos
+            pos += n
+            return pack.data[pos - n:pos]
+        return (ObjectType(type_num).name, size,
+                iter_inflate(read, chunk_size))
+
+    f = open(location, 'rb')
+    chunks = iter_inflate(f.read, chunk_size)
+    data = b''
+    while b'\x00' not in data:
+        data += next(chunks)
+    nul_index = data.index(b'\x00')
+    obj_type, size_str = data[:nul_index].decode().split()
+    def iter_data():
+        with f:
+            if len(data) > nul_index + 1:
+                yield data[nul_index + 1:]
+            yield from chunks
+    return (obj_type, int(size_str), iter_data())
+
+@trace_timer('objects/read')
 def read_object(sha1_prefix):
     """Read object with given sha-1 prefix and return tuple of
     (object_type, data_bytes) or raise ValueError if not found"""
-    path = find_object(sha1_prefix)
-    full_data = zlib.decompress(read_file(path))
+    _, pack, location = find_object(sha1_prefix)
+    if pack is not None:
+        trace_count('objects/read_packed')
+        return read_pack_object(pack, location)
+    trace_count('objects/read_loose')
+    full_data = zlib.decompress(read_file(location))
     nul_index = full_data.index(b'\x00')
     header = full_data[:nul_index]
     obj_type, size_str = header.decode().split()
@@ -87,16 +834,17 @@ def cat_file(mode, sha1_prefix):
     'type', print the type of the object. If mode is 'pretty', print a 
     prettified version of the object."""
     
-    obj_type, data = read_object(sha1_prefix)
     if mode in ['commit', 'tree', 'blob']:
+        obj_type, _, chunks = iter_object(sha1_prefix)
         if obj_type != mode:
             raise ValueError('expected object type {}, got {}'.format(
                 mode, obj_type))
-        sys.stdout.buffer.write(data)
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
     elif mode == 'size':
-        print(len(data))
+        print(read_object_info(sha1_prefix)[1])
     elif mode == 'type':
-        print(obj_type)
+        print(read_object_info(sha1_prefix)[0])
     #elif mode == 'pretty':
     #    if obj_type in ['commit', 'blob']:
     #        sys.stdout.buffer.write(data)
@@ -108,38 +856,176 @@ def cat_file(mode, sha1_prefix):
         #    assert False, 'unhandled object type {!r}'.format(obj_type)
     else:
         raise ValueError('unexpected mode {!r}'.format(mode))
+
+def cat_file_batch(contents=True, input=None, output=None):
+    """Read object names (hashes or hash prefixes) from input, one per
+    line, and for each one write "<sha1> <type> <size>" to output, followed
+    by the object data and a newline if contents is True (like git cat-file
+    --batch, or --batch-check if contents is False). Objects that can't be
+    found are reported as "<name> missing" or "<name> ambiguous". Packs and
+    caches stay open between requests, and output is flushed after each
+    object so the caller can read results as it writes names."""
+    input = input or sys.stdin.buffer
+    output = output or sys.stdout.buffer
+    for line in input:
+        name = line.strip().decode()
+        if not name:
+            continue
+        try:
+            sha1, _, _ = find_object(name)
+            if contents:
+                obj_type, size, chunks = iter_object(sha1)
+            else:
+                obj_type, size = read_object_info(sha1)
+        except ValueError as error:
+            problem = 'ambiguous' if str(error).startswith('multiple') \
+                    else 'missing'
+            output.write('{} {}\n'.format(name, problem).encode())
+        else:
+            output.write('{} {} {}\n'.format(sha1, obj_type, size).encode())
+            if contents:
+                for chunk in chunks:
+                    output.write(chunk)
+                output.write(b'\n')
+        output.flush()
    
      
-def read_index():
-    #Read git index file and return list of IndexEntry objects
+#Index last read by read_index_file, by its trailing checksum
+_index = (None, None)
+
+@trace_timer('index/read')
+def read_index_file():
+    """Read git index file (version 2, 3 or 4) and return IndexFile (an
+    empty one if there is no index yet). The file is memory-mapped and
+    parsed in place with a precompiled struct, without slicing out a copy
+    of each entry. Extensions are returned undecoded, so unknown ones are
+    kept when the index is written back. The result is kept until the
+    index's checksum changes, so callers mustn't modify it."""
+    global _index
     data_path = os.path.join('.git', 'index')
     try:
-        with open(data_path, "r") as data:
-            content = data.read()
+        f = open(data_path, 'rb')
     except FileNotFoundError:
-        return []
+        return IndexFile(2, [], {})
+    with f:
+        f.seek(-20, os.SEEK_END)
+        checksum = f.read(20)
+        if checksum == _index[0]:
+            return _index[1]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            data = memoryview(data)
+            try:
+                index = parse_index(data)
+            finally:
+                data.release()
+    _index = (checksum, index)
+    return index
+
+def parse_index(data):
+    #Parse contents of index file in given bytes-like data into IndexFile
     digest = hashlib.sha1(data[:-20]).digest()
     assert digest == data[-20:], 'invalid index checksum'
     signature, version, num_entries = struct.unpack('!4sLL', data[:12])
     assert signature == b'DIRC', \
-        'invalid index signature {}'.format(signature)
-    assert version == 2, 'unknown index version {}'.format(version)
-    entry_data = data[12:-20]
+        'invalid index signature {}'.format(bytes(signature))
+    assert version in (2, 3, 4), 'unknown index version {}'.format(version)
     entries = []
-    i = 0
-    while i + 62 < len(entry_data):
+    unpack_fields = INDEX_ENTRY_FIELDS.unpack_from
+    i = 12
+    path = b''
+    for _ in range(num_entries):
+        fields = unpack_fields(data, i)
         fields_end = i + 62
-        fields = struct.unpack('!LLLLLLLLLL20sH',
-                               entry_data[i:fields_end])
-        path_end  = entry_data.index(b'\x00', fields_end)
-        path = entry_data[fields_end:path_end]
-        entry = IndexEntry(*(fields + (path.decode(), )))
-        entries.append(entry)
-        entry_len = ((62 + len(path) + 8) // 8) * 8
-        i += entry_len
-        
-    assert len(entries) == num_entries
-    return entries
+        extended_flags = 0
+        if fields[11] & INDEX_EXTENDED_FLAG:
+            assert version >= 3, 'extended flags in version 2 index'
+            extended_flags, = struct.unpack_from('!H', data, fields_end)
+            fields_end += 2
+        if version == 4:
+            #Path is stored as number of bytes to strip from the end of the
+            #previous path, followed by the suffix to append
+            strip, path_start = read_ofs_distance(data, fields_end)
+            path_end = data.obj.find(b'\x00', path_start)
+            path = path[:len(path) - strip] + data[path_start:path_end]
+            i = path_end + 1
+        else:
+            name_length = fields[11] & 0xfff
+            if name_length < 0xfff:
+                path_end = fields_end + name_length
+            else:
+                path_end = data.obj.find(b'\x00', fields_end)
+            path = data[fields_end:path_end].tobytes()
+            i += ((path_end - i + 8) // 8) * 8
+        entries.append(IndexEntry(*fields, path.decode(), extended_flags))
+
+    extensions = {}
+    while i < len(data) - 20:
+        signature, size = struct.unpack_from('!4sL', data, i)
+        extensions[signature] = data[i + 8:i + 8 + size].tobytes()
+        i += 8 + size
+    return IndexFile(version, entries, extensions)
+
+def read_index():
+    #Read git index file and return list of IndexEntry objects
+    return read_index_file().entries
+
+def parse_cache_tree(data):
+    """Parse data of the TREE index extension and return dict mapping
+    directory path ('' for the root) to tuple of (entry_count, sha1) of its
+    tree object, where entry_count is the number of index entries under
+    the directory. Invalidated directories are left out."""
+    cache = {}
+    stack = []
+    i = 0
+    while i < len(data):
+        nul_index = data.index(b'\x00', i)
+        newline_index = data.index(b'\n', nul_index)
+        name = data[i:nul_index].decode()
+        entry_count, subtree_count = map(
+                int, data[nul_index + 1:newline_index].split())
+        i = newline_index + 1
+        while stack and stack[-1][1] == 0:
+            stack.pop()
+        if stack:
+            parent, remaining = stack[-1]
+            stack[-1] = (parent, remaining - 1)
+            path = parent + '/' + name if parent else name
+        else:
+            path = name
+        if entry_count >= 0:
+            cache[path] = (entry_count, data[i:i + 20].hex())
+            i += 20
+        stack.append((path, subtree_count))
+    return cache
+
+def build_cache_tree(cache):
+    """Return TREE index extension data for given dict of cached trees (see
+    parse_cache_tree). Parent directories missing from cache are written
+    as invalidated."""
+    children = collections.defaultdict(set)
+    for path in cache:
+        while path:
+            parent = path.rpartition('/')[0]
+            children[parent].add(path)
+            path = parent
+    result = []
+    stack = ['']
+    while stack:
+        path = stack.pop()
+        subdirs = sorted(children[path])
+        entry_count, sha1 = cache.get(path, (-1, None))
+        result.append('{}\x00{} {}\n'.format(
+                path.rpartition('/')[2], entry_count, len(subdirs)).encode())
+        if sha1 is not None:
+            result.append(bytes.fromhex(sha1))
+        stack.extend(reversed(subdirs))
+    return b''.join(result)
+
+def invalidate_cache_tree(cache, path):
+    #Remove cached trees of all directories containing given path
+    while path:
+        path = path.rpartition('/')[0]
+        cache.pop(path, None)
 
 def ls_files(details=False):
     """Print lists of files in index (including mode, sha-1 and stage number
@@ -152,31 +1038,422 @@ def ls_files(details=False):
         else:
             print(entry.path)
             
-def get_status():
+def index_entry_from_stat(path, st, sha1):
+    """Return IndexEntry for path with the stat data in st (an os.stat
+    result) and given binary sha1. Stat fields are truncated to 32 bits and
+    the mode is normalized, the same way git stores them."""
+    flags = len(path.encode())
+    assert flags < (1 << 12)
+    if stat.S_ISLNK(st.st_mode):
+        mode = 0o120000
+    elif st.st_mode & stat.S_IXUSR:
+        mode = 0o100755
+    else:
+        mode = 0o100644
+    return IndexEntry(
+            (st.st_ctime_ns // 1000000000) & 0xffffffff,
+            st.st_ctime_ns % 1000000000,
+            (st.st_mtime_ns // 1000000000) & 0xffffffff,
+            st.st_mtime_ns % 1000000000,
+            st.st_dev & 0xffffffff, st.st_ino & 0xffffffff, mode,
+            st.st_uid, st.st_gid, st.st_size & 0xffffffff, sha1, flags, path)
+
+def stat_matches(entry, st):
+    """Return True if stat data in st matches the stat data stored in the
+    given index entry (so the file is assumed to be unchanged)."""
+    cached = index_entry_from_stat(entry.path, st, entry.sha1)
+    return (entry.mtime_s == cached.mtime_s and
+            entry.mtime_n == cached.mtime_n and
+            entry.ctime_s == cached.ctime_s and
+            entry.ctime_n == cached.ctime_n and
+            entry.size == cached.size and
+            entry.ino == cached.ino and
+            entry.dev == cached.dev)
+
+def get_index_mtime():
+    #Return mtime of the index file in whole seconds, or None if no index
+    try:
+        return int(os.stat(os.path.join('.git', 'index')).st_mtime)
+    except FileNotFoundError:
+        return None
+
+def is_racy(entry, index_mtime):
+    """Return True if entry is "racily clean": the file was modified in the
+    same second as (or after) the index was written, so a later change
+    may not show up in its stat data and the file must be hashed."""
+    return index_mtime is None or entry.mtime_s >= index_mtime
+
+def translate_ignore_pattern(pattern):
+    """Translate gitignore glob pattern into a regular expression string
+    (for re.fullmatch). '*' and '?' don't match '/', and '**' matches any
+    number of directories."""
+    import re
+    result = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            result.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            result.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            result.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            result.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            result.append('[' + chars.replace('\\', '\\\\') + ']')
+            i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            result.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            result.append(re.escape(pattern[i]))
+            i += 1
+    return ''.join(result)
+
+def compile_ignore_rules(data, base):
+    """Compile contents of a .gitignore file in directory base ('' for the
+    top of the working copy) into a list of IgnoreRule."""
+    import re
+    rules = []
+    for line in data.decode(errors='replace').splitlines():
+        line = line.rstrip(' ')
+        if not line or line.startswith('#'):
+            continue
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        anchored = '/' in line
+        line = line.lstrip('/')
+        if line:
+            regex = re.compile(translate_ignore_pattern(line))
+            rules.append(IgnoreRule(base, regex, negate, dir_only, anchored))
+    return rules
+
+def is_ignored(rules, path, is_dir):
+    """Return True if path (relative to top of working copy) is ignored by
+    given list of IgnoreRule, where later rules take precedence."""
+    name = path.rpartition('/')[2]
+    for rule in reversed(rules):
+        if rule.dir_only and not is_dir:
+            continue
+        if rule.anchored:
+            if rule.base:
+                if not path.startswith(rule.base + '/'):
+                    continue
+                match = rule.regex.fullmatch(path[len(rule.base) + 1:])
+            else:
+                match = rule.regex.fullmatch(path)
+        else:
+            match = rule.regex.fullmatch(name)
+        if match:
+            return not rule.negate
+    return False
+
+def parse_untracked_cache(data):
+    #Parse untracked cache file data into dict of path: UntrackedDir
+    cache = {}
+    i = 0
+    while i < len(data):
+        nul_index = data.index(b'\x00', i)
+        newline_index = data.index(b'\n', nul_index)
+        path = data[i:nul_index].decode()
+        mtime_ns, rules_key, num_files, num_subdirs = \
+                data[nul_index + 1:newline_index].decode().split()
+        i = newline_index + 1
+        names = []
+        for _ in range(int(num_files) + int(num_subdirs)):
+            nul_index = data.index(b'\x00', i)
+            names.append(data[i:nul_index].decode())
+            i = nul_index + 1
+        cache[path] = UntrackedDir(int(mtime_ns), rules_key,
+                                   tuple(names[:int(num_files)]),
+                                   tuple(names[int(num_files):]))
+    return cache
+
+def build_untracked_cache(cache):
+    #Return untracked cache file data for dict of path: UntrackedDir
+    result = []
+    for path, cached in sorted(cache.items()):
+        result.append('{}\x00{} {} {} {}\n'.format(
+                path, cached.mtime_ns, cached.rules_key, len(cached.files),
+                len(cached.subdirs)).encode())
+        result.extend(n.encode() + b'\x00'
+                      for n in cached.files + cached.subdirs)
+    return b''.join(result)
+
+@trace_timer('untracked/walk')
+def find_working_files(cache, changed_dirs=None):
+    """Walk the working copy and return tuple of (paths, new_cache): the set
+    of paths of all files that aren't ignored by .gitignore files or
+    .git/info/exclude, and the updated untracked cache.
+
+    cache is a dict mapping directory path to UntrackedDir. A directory
+    whose mtime and ignore rules match its cached entry is not listed
+    again (creating, deleting or renaming a file in a directory changes
+    its mtime); only its subdirectories are checked. Directories modified
+    in the current second aren't cached, as later changes in the same
+    second might not change the mtime. If changed_dirs is given (a set of
+    directory paths, from a filesystem monitor), cached directories not in
+    it are trusted without even checking their mtime."""
+    scan_time = int(time.time())
+    paths = set()
+    new_cache = {}
+    try:
+        data = read_file(os.path.join('.git', 'info', 'exclude'))
+    except FileNotFoundError:
+        data = b''
+    stack = [('', compile_ignore_rules(data, ''),
+              hashlib.sha1(data).hexdigest())]
+    while stack:
+        path, rules, rules_key = stack.pop()
+        prefix = path + '/' if path else ''
+        cached = cache.get(path)
+        if (cached is not None and changed_dirs is not None and
+                path not in changed_dirs):
+            mtime_ns = cached.mtime_ns
+        else:
+            try:
+                mtime_ns = os.stat(path or '.').st_mtime_ns
+            except FileNotFoundError:
+                continue
+        if cached is not None and cached.mtime_ns == mtime_ns:
+            has_gitignore = '.gitignore' in cached.files
+        else:
+            has_gitignore = True
+        data = b''
+        if has_gitignore:
+            try:
+                data = read_file(prefix + '.gitignore')
+            except (FileNotFoundError, IsADirectoryError):
+                pass
+        if data:
+            rules = rules + compile_ignore_rules(data, path)
+            rules_key = hashlib.sha1(rules_key.encode() + data).hexdigest()
+        if (cached is None or cached.mtime_ns != mtime_ns or
+                cached.rules_key != rules_key):
+            files = []
+            subdirs = []
+            trace_count('untracked/dirs_listed')
+            with os.scandir(path or '.') as dir_entries:
+                for dir_entry in dir_entries:
+                    if dir_entry.name == '.git':
+                        continue
+                    is_dir = dir_entry.is_dir(follow_symlinks=False)
+                    if is_ignored(rules, prefix + dir_entry.name, is_dir):
+                        continue
+                    (subdirs if is_dir else files).append(dir_entry.name)
+            cached = UntrackedDir(mtime_ns, rules_key,
+                                  tuple(sorted(files)), tuple(sorted(subdirs)))
+        else:
+            trace_count('untracked/dirs_cached')
+        if mtime_ns // 1000000000 < scan_time:
+            new_cache[path] = cached
+        paths.update(prefix + name for name in cached.files)
+        stack.extend((prefix + name, rules, rules_key)
+                     for name in cached.subdirs)
+    return (paths, new_cache)
+
+def get_config(section, key):
+    """Return value of key in given section of .git/config, or None if not
+    set. Only plain "[section]" headers and "key = value" lines are
+    understood; names are case-insensitive like in git."""
+    try:
+        lines = read_file(os.path.join('.git', 'config')).decode().splitlines()
+    except FileNotFoundError:
+        return None
+    current_section = None
+    value = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith('['):
+            current_section = line.strip('[]').strip().lower()
+        elif '=' in line and current_section == section.lower():
+            name, _, line_value = line.partition('=')
+            if name.strip().lower() == key.lower():
+                value = line_value.strip()
+    return value
+
+def encode_ewah(bits, size):
+    """Encode set of bit numbers (all below size) as an EWAH compressed
+    bitmap as used in git's index extensions. All words are written as
+    literal words, which any EWAH reader accepts."""
+    words = [0] * ((size + 63) // 64)
+    for bit in bits:
+        words[bit // 64] |= 1 << (bit % 64)
+    marker = len(words) << 33
+    return struct.pack('!LL{}QL'.format(len(words) + 1), size,
+                       len(words) + 1, marker, *words, 0)
+
+def decode_ewah(data):
+    """Decode EWAH bitmap at start of data, return tuple of (set of bit
+    numbers, number of bytes used)."""
+    size, num_words = struct.unpack_from('!LL', data)
+    words = struct.unpack_from('!{}Q'.format(num_words), data, 8)
+    bits = set()
+    bit = i = 0
+    while i < num_words:
+        #Marker word: a run of running_length words of all 0 or all 1 bits,
+        #then num_literals literal words
+        running_length = (words[i] >> 1) & 0xffffffff
+        num_literals = words[i] >> 33
+        if words[i] & 1:
+            bits.update(range(bit, bit + running_length * 64))
+        bit += running_length * 64
+        for word in words[i + 1:i + 1 + num_literals]:
+            bits.update(bit + b for b in range(64) if word >> b & 1)
+            bit += 64
+        i += 1 + num_literals
+    return ({b for b in bits if b < size}, 8 + 8 * num_words + 4)
+
+def parse_fsmonitor(data, entries):
+    """Parse data of the FSMN index extension (version 2), return tuple of
+    (token, dirty_paths): the filesystem monitor token, and the set of
+    paths of entries that weren't known to be clean when it was taken."""
+    version, = struct.unpack_from('!L', data)
+    assert version == 2, 'unknown fsmonitor extension version {}'.format(
+        version)
+    token_end = data.index(b'\x00', 4)
+    bits, _ = decode_ewah(data[token_end + 5:])
+    return (data[4:token_end].decode(),
+            {entries[b].path for b in bits if b < len(entries)})
+
+def build_fsmonitor(token, dirty_paths, entries):
+    #Return FSMN index extension data for given token and dirty paths
+    bits = {i for i, e in enumerate(entries) if e.path in dirty_paths}
+    ewah = encode_ewah(bits, len(entries))
+    return (struct.pack('!L', 2) + token.encode() + b'\x00' +
+            struct.pack('!L', len(ewah)) + ewah)
+
+def query_fsmonitor(hook, token):
+    """Ask filesystem monitor hook (git's fsmonitor hook protocol version 2)
+    which paths changed since given token. Return tuple of (new_token,
+    paths), where paths is None if everything must be checked."""
+    import shlex, subprocess
+    result = subprocess.run(shlex.split(hook) + ['2', token],
+                            stdout=subprocess.PIPE)
+    if result.returncode != 0:
+        return (None, None)
+    fields = result.stdout.decode().split('\x00')
+    new_token, paths = fields[0], [p for p in fields[1:] if p]
+    if '/' in paths:
+        return (new_token, None)
+    return (new_token, {p.rstrip('/') for p in paths})
+
+def get_status(refresh=True, jobs=None):
     """Gets status of working copy, return tuple of(changed_paths, new_paths,
-    deleted_paths)."""
+    deleted_paths). Files ignored by .gitignore or .git/info/exclude are
+    not reported as new.
+
+    If core.fsmonitor is set in .git/config to a filesystem monitor hook,
+    only the paths it reports as changed since the token stored in the
+    index (FSMN extension), plus the ones that were dirty then, are
+    checked. Otherwise every indexed file is stat'ed.
+
+    Files whose stat data matches their index entry are not re-hashed,
+    unless they are racily clean. The remaining files are hashed in
+    parallel by 'jobs' worker threads (see hash_paths). The directory walk
+    for new files is sped up by the untracked cache (see
+    find_working_files), kept in .git/untracked-cache rather than in an
+    index extension so that git doesn't warn about it. If refresh is True,
+    the updated untracked cache, and the stat data of files that had to be
+    hashed but turned out unchanged, are written back so the next call
+    can skip them."""
     
-    paths = set()
-    for root, dirs, files in os.walk('.'):
-        dirs[:] = [d for d in dirs if d != '.git']
-        for file in files:
-            path = os.path.join(root, file)
-            path = path.replace('\\', '/')
-            if path.startswith('./'):
-                path = path[2:]
-            paths.add(path)
-        entries_by_path = {e.path: e for e in read_index()}
-        entry_paths = set(entries_by_path)
-        changed = {p for p in (paths & entry_paths) 
-                   if hash_objects(read_file(p), 'blob', write=False) != 
-                   entries_by_path[p].sha1.hex()}
-        new = paths - entry_paths
-        deleted = entry_paths - paths
-        return (sorted(changed), sorted(new), sorted(deleted))
+    index = read_index_file()
+    cache_path = os.path.join('.git', 'untracked-cache')
+    try:
+        cache_data = read_file(cache_path)
+    except FileNotFoundError:
+        cache_data = b''
+    entries = index.entries
+    hook = get_config('core', 'fsmonitor')
+    token = reported = changed_dirs = None
+    if hook:
+        if b'FSMN' in index.extensions:
+            token, dirty = parse_fsmonitor(index.extensions[b'FSMN'], entries)
+        with trace_region('status', 'fsmonitor', msg=hook):
+            new_token, reported = query_fsmonitor(hook, token or '')
+    if token is not None and reported is not None:
+        #Only check reported paths (and everything under them, in case they
+        #are directories) and the entries that were dirty last time
+        candidates = set(dirty)
+        changed_dirs = set()
+        entry_paths = [e.path for e in entries]
+        for path in reported:
+            i = bisect.bisect_left(entry_paths, path)
+            while i < len(entry_paths) and (
+                    entry_paths[i] == path or
+                    entry_paths[i].startswith(path + '/')):
+                candidates.add(entry_paths[i])
+                i += 1
+            changed_dirs.add(path)
+            while path:
+                path = path.rpartition('/')[0]
+                changed_dirs.add(path)
+        check_entries = [e for e in entries if e.path in candidates]
+    else:
+        check_entries = entries
+    with trace_region('status', 'untracked'):
+        paths, cache = find_working_files(parse_untracked_cache(cache_data),
+                                          changed_dirs=changed_dirs)
+    entries_by_path = {e.path: e for e in entries}
+    entry_paths = set(entries_by_path)
+    index_mtime = get_index_mtime()
+    deleted = set()
+    to_hash = []
+    trace_count('status/stat', len(check_entries))
+    with trace_region('status', 'stat', msg='{} entries'.format(
+            len(check_entries))):
+        for entry in check_entries:
+            try:
+                st = os.lstat(entry.path)
+            except (FileNotFoundError, NotADirectoryError):
+                deleted.add(entry.path)
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                deleted.add(entry.path)
+            elif not stat_matches(entry, st) or is_racy(entry, index_mtime):
+                to_hash.append((entry.path, st))
+    sha1s = hash_paths([p for p, _ in to_hash], write=False, jobs=jobs)
+    changed = set()
+    refreshed = {}
+    for (path, st), sha1 in zip(to_hash, sha1s):
+        entry = entries_by_path[path]
+        if sha1 != entry.sha1.hex():
+            changed.add(path)
+        else:
+            refreshed[path] = index_entry_from_stat(path, st, entry.sha1)
+    extensions = dict(index.extensions)
+    if hook and new_token is not None:
+        unrefreshed = {p for p, _ in to_hash} - set(refreshed)
+        extensions[b'FSMN'] = build_fsmonitor(
+                new_token, changed | deleted | unrefreshed, entries)
+    #Refreshing is only an optimization, so skip it if another process
+    #is writing the index (or cache) right now
+    if refresh and (refreshed or extensions != index.extensions):
+        with contextlib.suppress(FileExistsError):
+            write_index([refreshed.get(e.path, e) for e in entries],
+                        extensions=extensions, version=index.version)
+    new_cache_data = build_untracked_cache(cache)
+    if refresh and new_cache_data != cache_data:
+        with contextlib.suppress(FileExistsError):
+            write_locked_file(cache_path, new_cache_data)
+    new = paths - entry_paths
+    return (sorted(changed), sorted(new), sorted(deleted))
     
-def status():
+def status(jobs=None):
     #Show status of working copy
-    changed, new, deleted = get_status()
+    changed, new, deleted = get_status(jobs=jobs)
     if changed:
         print('changed files:')
         for path in changed:
@@ -192,72 +1469,570 @@ def status():
         for path in deleted:
             print('   ', path)
             
-def diff():
-    #Show diff of files changed(between index and working copy.)
-    changed, _, _ = get_status()
+def split_lines(data):
+    #Split bytes into lines, keeping the b'\n' at the end of each line
+    lines = data.split(b'\n')
+    last = lines.pop()
+    lines = [line + b'\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+def find_middle_snake(a, alo, ahi, b, blo, bhi):
+    """Return (x, y, u, v) such that a[x:u] == b[y:v] is the middle snake
+    of a shortest edit script from a[alo:ahi] to b[blo:bhi], searching
+    forwards from the start and backwards from the end at the same time
+    (Myers' linear space refinement). Both ranges must be non-empty and
+    their first and last elements must differ."""
+    n = ahi - alo
+    m = bhi - blo
+    delta = n - m
+    odd = delta & 1
+    #Furthest reaching x per diagonal, forwards and backwards (counted
+    #from the end); negative diagonals wrap around to the end of the list
+    forward = [0] * (n + m + 3)
+    backward = [0] * (n + m + 3)
+    for d in range((n + m + 1) // 2 + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[k - 1] < forward[k + 1]):
+                x = forward[k + 1]
+            else:
+                x = forward[k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            forward[k] = x
+            if odd and -d < delta - k < d and x + backward[delta - k] >= n:
+                return (alo + x0, blo + y0, alo + x, blo + y)
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[k - 1] < backward[k + 1]):
+                x = backward[k + 1]
+            else:
+                x = backward[k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x += 1
+                y += 1
+            backward[k] = x
+            if not odd and -d <= delta - k <= d and \
+                    x + forward[delta - k] >= n:
+                return (ahi - x, bhi - y, ahi - x0, bhi - y0)
+
+def diff_matches(a, b):
+    """Return sorted list of (i, j, length) blocks where a[i:i+length] ==
+    b[j:j+length], forming a longest common subsequence of sequences a and
+    b (Myers' O(ND) algorithm, using memory linear in the input size)."""
+    matches = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        start = alo
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            alo += 1
+            blo += 1
+        if alo > start:
+            matches.append((start, blo - (alo - start), alo - start))
+        end = ahi
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+        if ahi < end:
+            matches.append((ahi, bhi, end - ahi))
+        if alo == ahi or blo == bhi:
+            continue
+        x, y, u, v = find_middle_snake(a, alo, ahi, b, blo, bhi)
+        if u > x:
+            matches.append((x, y, u - x))
+        stack.append((alo, x, blo, y))
+        stack.append((u, ahi, v, bhi))
+    matches.sort()
+    return matches
+
+def find_line_changes(a_lines, b_lines):
+    """Return list of (a_lo, a_hi, b_lo, b_hi) tuples, meaning lines
+    a_lines[a_lo:a_hi] are replaced by b_lines[b_lo:b_hi], that turn one
+    list of lines into the other. Lines are hashed to small integers
+    first, so the diff itself only compares ints, and lines that only occur
+    on one side are left out of it, as they can't match anyway (this keeps
+    diffs of rewritten files fast)."""
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in a_lines]
+    b = [ids.setdefault(line, len(ids)) for line in b_lines]
+    a_ids = set(a)
+    b_ids = set(b)
+    a_kept = [i for i, line in enumerate(a) if line in b_ids]
+    b_kept = [j for j, line in enumerate(b) if line in a_ids]
+    matches = diff_matches([a[i] for i in a_kept], [b[j] for j in b_kept])
+    #Changes are the gaps between matching lines; a sentinel match at the
+    #end closes the last gap
+    changes = []
+    i = j = 0
+    pairs = [(a_kept[i + k], b_kept[j + k])
+             for i, j, length in matches for k in range(length)]
+    for a_match, b_match in pairs + [(len(a), len(b))]:
+        if a_match > i or b_match > j:
+            changes.append((i, a_match, j, b_match))
+        i, j = a_match + 1, b_match + 1
+    return changes
+
+def find_function_line(lines, i):
+    #Return the last line before lines[i] starting with a letter, '_' or
+    #'$' (git's default guess at the enclosing function) for hunk headers
+    for line in reversed(lines[:i]):
+        if line[:1].isalpha() or line[:1] in (b'_', b'$'):
+            return line[:80].rstrip()
+    return b''
+
+def format_range(start, length):
+    #Format line range of a unified diff hunk header, like '3,4' in
+    #'@@ -3,4 +3,5 @@'
+    if length == 1:
+        return str(start + 1)
+    return '{},{}'.format(start + 1 if length else start, length)
+
+def unified_diff(a_lines, b_lines, changes, context=3):
+    """Yield lines (bytes, without line ending) of the hunks of a unified
+    diff with given lines of context, given changes from
+    find_line_changes."""
+    #Changes no more than twice the context apart share a hunk
+    hunks = []
+    for change in changes:
+        if hunks and change[0] - hunks[-1][-1][1] <= 2 * context:
+            hunks[-1].append(change)
+        else:
+            hunks.append([change])
+    for hunk in hunks:
+        a_start = max(hunk[0][0] - context, 0)
+        b_start = hunk[0][2] - (hunk[0][0] - a_start)
+        a_end = min(hunk[-1][1] + context, len(a_lines))
+        b_end = hunk[-1][3] + (a_end - hunk[-1][1])
+        function = find_function_line(a_lines, a_start)
+        yield '@@ -{} +{} @@'.format(
+                format_range(a_start, a_end - a_start),
+                format_range(b_start, b_end - b_start)).encode() + (
+                b' ' + function if function else b'')
+        i = a_start
+        for a_lo, a_hi, b_lo, b_hi in hunk + [(a_end, a_end, b_end, b_end)]:
+            lines = ([b' ' + line for line in a_lines[i:a_lo]] +
+                     [b'-' + line for line in a_lines[a_lo:a_hi]] +
+                     [b'+' + line for line in b_lines[b_lo:b_hi]])
+            for line in lines:
+                if line.endswith(b'\n'):
+                    yield line[:-1]
+                else:
+                    yield line
+                    yield b'\\ No newline at end of file'
+            i = a_hi
+
+def is_binary(data):
+    #Guess whether data is binary the way git does: a NUL byte early on
+    return b'\x00' in data[:8000]
+
+def read_head(chunks, size=8000):
+    #Return at least the first size bytes (all if fewer) from iterator of
+    #chunks, leaving the rest in it; enough to tell if data is_binary
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= size:
+            break
+    return head
+
+def iter_working_file(path, chunk_size=65536):
+    """Return tuple of (mode, size, chunks) of file in working copy, like
+    iter_object returns for an object, where chunks is an iterator over
+    its data. A symlink's data is its target."""
+    if os.path.islink(path):
+        target = os.fsencode(os.readlink(path))
+        return (0o120000, len(target), iter([target]))
+    f = open(path, 'rb')
+    st = os.fstat(f.fileno())
+    def iter_data():
+        with f:
+            for chunk in iter(functools.partial(f.read, chunk_size), b''):
+                yield chunk
+    return (0o100755 if st.st_mode & stat.S_IXUSR else 0o100644,
+            st.st_size, iter_data())
+
+def diff_file(change, stat_only=False):
+    """Diff one file between index and working copy. change is a tuple of
+    (old_path, new_path, old_mode, old_sha1, similarity), where new_path is
+    None if the file was deleted and similarity is None unless the file was
+    renamed. Return tuple of (output, insertions, deletions, binary_sizes):
+    output is the diff in git's format as bytes (empty if stat_only is
+    True), and binary_sizes is (old_size, new_size) if the file is binary,
+    otherwise None. Only the start of a binary file is read."""
+    old_path, new_path, old_mode, old_sha1, score = change
+    obj_type, old_size, old_chunks = iter_object(old_sha1)
+    assert obj_type == 'blob'
+    if new_path is None:
+        new_mode, new_size, new_chunks = 0, 0, iter([])
+    else:
+        new_mode, new_size, new_chunks = iter_working_file(new_path)
+    old_data = read_head(old_chunks)
+    new_data = read_head(new_chunks)
+    if is_binary(old_data) or is_binary(new_data):
+        changes = []
+        binary_sizes = (old_size, new_size)
+    else:
+        old_data += b''.join(old_chunks)
+        new_data += b''.join(new_chunks)
+        old_lines = split_lines(old_data)
+        new_lines = split_lines(new_data)
+        changes = find_line_changes(old_lines, new_lines)
+        binary_sizes = None
+    insertions = sum(b_hi - b_lo for _, _, b_lo, b_hi in changes)
+    deletions = sum(a_hi - a_lo for a_lo, a_hi, _, _ in changes)
+    if stat_only:
+        return (b'', insertions, deletions, binary_sizes)
+
+    a_path = 'a/' + old_path
+    b_path = 'b/' + (new_path or old_path)
+    header = ['diff --git {} {}'.format(a_path, b_path)]
+    if new_path is None:
+        header.append('deleted file mode {:o}'.format(old_mode))
+        new_sha1 = '0' * 40
+        b_path = '/dev/null'
+    else:
+        if score is not None:
+            header += ['similarity index {}%'.format(score),
+                       'rename from ' + old_path,
+                       'rename to ' + new_path]
+        if new_mode != old_mode:
+            header += ['old mode {:o}'.format(old_mode),
+                       'new mode {:o}'.format(new_mode)]
+        if binary_sizes:
+            new_sha1 = hash_paths([new_path], write=False, jobs=1)[0]
+        else:
+            new_sha1 = hashlib.sha1('blob {}\x00'.format(
+                    len(new_data)).encode() + new_data).hexdigest()
+    if new_sha1 != old_sha1:
+        header.append('index {}..{}{}'.format(
+                old_sha1[:7], new_sha1[:7],
+                ' {:o}'.format(old_mode) if new_mode == old_mode else ''))
+    lines = [line.encode() for line in header]
+    if binary_sizes:
+        if new_sha1 != old_sha1:
+            lines.append('Binary files {} and {} differ'.format(
+                    a_path, b_path).encode())
+    elif changes:
+        lines += ['--- {}'.format(a_path).encode(),
+                  '+++ {}'.format(b_path).encode()]
+        lines += unified_diff(old_lines, new_lines, changes)
+    return (b'\n'.join(lines) + b'\n', insertions, deletions, binary_sizes)
+
+def find_renames(deleted, new, entries_by_path, threshold=50):
+    """Pair up deleted and new files whose contents are at least threshold
+    percent similar, and return dict mapping each renamed deleted path to
+    tuple of (new_path, similarity). Identical files are paired by hash
+    first; similarity of the others is the share of bytes in lines the
+    two files have in common, relative to the larger file. Files are only
+    read in full when their size allows a match and their start shows
+    they aren't binary."""
+    renames = {}
+    deleted = list(deleted)
+    new_sha1s = dict(zip(new, hash_paths(new, write=False)))
+    new_by_sha1 = {}
+    for path, sha1 in new_sha1s.items():
+        new_by_sha1.setdefault(sha1, []).append(path)
+    for path in deleted:
+        candidates = new_by_sha1.get(entries_by_path[path].sha1.hex())
+        if candidates:
+            renames[path] = (candidates.pop(0), 100)
+    paired = {new_path for new_path, _ in renames.values()}
+    old_paths = [p for p in deleted if p not in renames]
+    new_paths = [p for p in new if p not in paired]
+    if not old_paths or not new_paths:
+        return renames
+
+    def line_counts(chunks):
+        #Count lines of file given iterator of its chunks, None if binary
+        head = read_head(chunks)
+        if is_binary(head):
+            return None
+        return collections.Counter(split_lines(head + b''.join(chunks)))
+
+    old_sizes = {p: read_object_info(entries_by_path[p].sha1.hex())[1]
+                 for p in old_paths}
+    new_sizes = {p: os.lstat(p).st_size for p in new_paths}
+    old_lines = {}
+    new_lines = {}
+    scores = []
+    for old_path, old_size in old_sizes.items():
+        for new_path, new_size in new_sizes.items():
+            larger = max(old_size, new_size)
+            #Skip pairs whose sizes alone rule out enough similarity
+            if not larger or min(old_size, new_size) * 100 < \
+                    larger * threshold:
+                continue
+            if old_path not in old_lines:
+                old_lines[old_path] = line_counts(iter_object(
+                        entries_by_path[old_path].sha1.hex())[2])
+            if old_lines[old_path] is None:
+                break
+            if new_path not in new_lines:
+                new_lines[new_path] = line_counts(
+                        iter_working_file(new_path)[2])
+            if new_lines[new_path] is None:
+                continue
+            common = old_lines[old_path] & new_lines[new_path]
+            score = sum(len(line) * count
+                        for line, count in common.items()) * 100 // larger
+            if score >= threshold:
+                scores.append((-score, old_path, new_path))
+    for score, old_path, new_path in sorted(scores):
+        if old_path not in renames and new_path not in paired:
+            renames[old_path] = (new_path, -score)
+            paired.add(new_path)
+    return renames
+
+def format_rename(old_path, new_path):
+    #Format renamed path for diff --stat like git, e.g. 'dir/{a => b}.py'
+    prefix = os.path.commonprefix([old_path, new_path])
+    prefix = prefix[:prefix.rfind('/') + 1]
+    suffix = os.path.commonprefix([old_path[len(prefix):][::-1],
+                                   new_path[len(prefix):][::-1]])[::-1]
+    suffix = suffix[suffix.find('/'):] if '/' in suffix else ''
+    if not prefix and not suffix:
+        return '{} => {}'.format(old_path, new_path)
+    return '{}{{{} => {}}}{}'.format(
+            prefix, old_path[len(prefix):len(old_path) - len(suffix)],
+            new_path[len(prefix):len(new_path) - len(suffix)], suffix)
+
+def print_diff_stat(names, results, width=80):
+    """Print a git-style diffstat: one line per file with a histogram of
+    lines added and deleted, scaled to fit in given width, then a
+    summary line. results are tuples returned by diff_file."""
+    max_change = max([ins + dels for _, ins, dels, binary in results
+                      if not binary] + [0])
+    number_width = len(str(max_change))
+    if any(binary for _, _, _, binary in results):
+        number_width = max(number_width, 3)
+    name_width = max([len(name) for name in names] + [0])
+    graph_width = max_change
+    if name_width + number_width + 6 + graph_width > width:
+        graph_width = max(min(graph_width, width * 3 // 8 - number_width - 6),
+                          6)
+        if name_width > width - number_width - 6 - graph_width:
+            name_width = width - number_width - 6 - graph_width
+        else:
+            graph_width = width - number_width - 6 - name_width
+    total_insertions = total_deletions = 0
+    for name, (_, insertions, deletions, binary) in zip(names, results):
+        if len(name) > name_width:
+            name = '...' + name[len(name) - name_width + 3:]
+        if binary:
+            print(' {:<{}} | {:>{}} {} -> {} bytes'.format(
+                    name, name_width, 'Bin', number_width, *binary))
+            continue
+        total_insertions += insertions
+        total_deletions += deletions
+        if graph_width <= max_change:
+            #Scale linearly, but show at least one mark for each kind of
+            #change
+            def scale(n):
+                return n and 1 + n * (graph_width - 1) // max_change
+            total = scale(insertions + deletions)
+            if total < 2 and insertions and deletions:
+                total = 2
+            if insertions < deletions:
+                pluses = scale(insertions)
+                minuses = total - pluses
+            else:
+                minuses = scale(deletions)
+                pluses = total - minuses
+        else:
+            pluses, minuses = insertions, deletions
+        print(' {:<{}} | {:>{}} {}'.format(
+                name, name_width, insertions + deletions, number_width,
+                '+' * pluses + '-' * minuses).rstrip())
+    summary = ' {} file{} changed'.format(len(results),
+                                          '' if len(results) == 1 else 's')
+    if total_insertions or not total_deletions:
+        summary += ', {} insertion{}(+)'.format(
+                total_insertions, '' if total_insertions == 1 else 's')
+    if total_deletions or not total_insertions:
+        summary += ', {} deletion{}(-)'.format(
+                total_deletions, '' if total_deletions == 1 else 's')
+    print(summary)
+
+#Below this many changed files or bytes of them, diff doesn't start
+#worker processes (which takes longer than diffing a few small files),
+#and the most it starts
+DIFF_PARALLEL_FILES = 32
+DIFF_PARALLEL_BYTES = 1 << 20
+DIFF_MAX_JOBS = 8
+
+def diff(stat_only=False, renames=False, jobs=None):
+    """Show diff of files changed or deleted between index and working copy,
+    in git's format, or just a summary of them if stat_only is True. If
+    renames is True, deleted files are paired with similar new files and
+    shown as renames. Many or large files are diffed in parallel by 'jobs'
+    worker processes (one per CPU by default, at most DIFF_MAX_JOBS); the
+    diff is pure Python, so threads would only take turns holding the
+    GIL."""
+    changed, new, deleted = get_status(jobs=jobs)
     entries_by_path = {e.path: e for e in read_index()}
-    for i, path in enumerate(changed):
-        sha1 = entries_by_path[path].sha1.hex()
-        obj_type, data = read_object(sha1)
-        assert obj_type == 'blob'
-        index_lines = data.decode().splitlines()
-        working_lines = read_file(path).decode().splitlines()
-        diff_lines = difflib.unified_diff(
-            index_lines, working_lines,
-            '{} (index)'.format(path),
-            '{} (working copy)'.format(path),
-            lineterm='')
-        for line in diff_lines:
-            print(line)
-        if i < len(changed) - 1:
-            print('-' * 70)
-           
-def write_index(entries):
-    #Write a list of IndexEntry objects to git index
+    if renames:
+        with trace_region('diff', 'renames'):
+            found = find_renames(deleted, new, entries_by_path)
+    else:
+        found = {}
+    changes = []
+    for path in changed:
+        entry = entries_by_path[path]
+        changes.append((path, path, entry.mode, entry.sha1.hex(), None))
+    for path in deleted:
+        new_path, score = found.get(path, (None, None))
+        entry = entries_by_path[path]
+        changes.append((path, new_path, entry.mode, entry.sha1.hex(), score))
+    changes.sort(key=lambda c: c[1] or c[0])
+    work = functools.partial(diff_file, stat_only=stat_only)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(changes), DIFF_MAX_JOBS)
+    #The index has the old size of each file, a good enough estimate
+    size = sum(entries_by_path[c[0]].size for c in changes)
+    if jobs <= 1 or (len(changes) < DIFF_PARALLEL_FILES and
+                     size < DIFF_PARALLEL_BYTES):
+        results = map(work, changes)
+        executor = None
+    else:
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        results = executor.map(work, changes, chunksize=8)
+    try:
+        with trace_region('diff', 'files', msg='{} files'.format(
+                len(changes))):
+            if stat_only:
+                names = [format_rename(c[0], c[1]) if c[4] is not None
+                         else c[0] for c in changes]
+                if changes:
+                    print_diff_stat(names, list(results))
+            else:
+                for output, _, _, _ in results:
+                    sys.stdout.buffer.write(output)
+                sys.stdout.flush()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+@trace_timer('index/write')
+def write_index(entries, extensions=None, version=2):
+    """Write a list of IndexEntry objects to git index in given format
+    version (2, 3 or 4), followed by given dict of extensions (mapping
+    signature to raw data), if any. Version 4 prefix-compresses paths. A
+    version 2 index is written as version 3 if any entry has extended
+    flags. The index is replaced through .git/index.lock (see
+    write_locked_file)."""
+    assert version in (2, 3, 4), 'unknown index version {}'.format(version)
+    if version == 2 and any(e.flags & INDEX_EXTENDED_FLAG for e in entries):
+        version = 3
     packed_entries = []
+    previous_path = b''
     for entry in entries:
-        entry_head = struct.pack('!LLLLLLLLLL20sH',
+        entry_head = INDEX_ENTRY_FIELDS.pack(
                 entry.ctime_s, entry.ctime_n, entry.mtime_s, entry.mtime_n,
                 entry.dev, entry.ino, entry.mode, entry.uid, entry.gid,
                 entry.size, entry.sha1, entry.flags)
+        if entry.flags & INDEX_EXTENDED_FLAG:
+            entry_head += struct.pack('!H', entry.extended_flags)
         path = entry.path.encode()
-        length = ((62 + len(path) + 8) // 8) * 8
-        packed_entry = entry_head + path + b'\x00' * (length - 62 - len(path))
+        if version == 4:
+            common = len(os.path.commonprefix([previous_path, path]))
+            packed_entry = (entry_head +
+                            encode_ofs_distance(len(previous_path) - common) +
+                            path[common:] + b'\x00')
+            previous_path = path
+        else:
+            length = ((len(entry_head) + len(path) + 8) // 8) * 8
+            packed_entry = entry_head + path + b'\x00' * (
+                    length - len(entry_head) - len(path))
         packed_entries.append(packed_entry)
-    header = struct.pack('4sLL', b'DIRC', 2, len(entries))
+    for signature, data in (extensions or {}).items():
+        packed_entries.append(struct.pack('!4sL', signature, len(data)))
+        packed_entries.append(data)
+    header = struct.pack('!4sLL', b'DIRC', version, len(entries))
     all_data = header + b''.join(packed_entries)
     digest = hashlib.sha1(all_data).digest()
-    write_file(os.path.join('.git', 'index'), all_data + digest)
+    write_locked_file(os.path.join('.git', 'index'), all_data + digest)
     
+def update_index_version(version):
+    #Rewrite git index in given format version (2, 3 or 4)
+    index = read_index_file()
+    write_index(index.entries, extensions=index.extensions, version=version)
 
-def add(paths):
-    #Add all file paths to git index
-    paths = [p.replace('\\', '/') for p in paths]
-    all_entries = read_index()
-    entries = [e for e in all_entries if e.path not in paths]
-    for path in paths:
-        sha1 = hash_objects(read_file(path), 'blob')
-        st = os.stat(path)
-        flags = len(path.encode())
-        assert flags < (1 << 12)
-        entry = IndexEntry(
-            int(st.st_birthtime), 0, int(st.st_mtime), 0, st.st_dev,
-            st.st_ino, st.st_mode, st.st_uid. st.st_gid, st.st_size,
-            bytes.fromhex(sha1), flags, path)
+def add(paths, jobs=None):
+    """Add all file paths to git index, hashing and compressing the blobs
+    with 'jobs' worker threads (see hash_paths)."""
+    #dict.fromkeys drops repeated paths but keeps the order
+    paths = list(dict.fromkeys(p.replace('\\', '/') for p in paths))
+    index = read_index_file()
+    added = set(paths)
+    entries = [e for e in index.entries if e.path not in added]
+    stats = [os.lstat(p) for p in paths]
+    sha1s = hash_paths(paths, jobs=jobs)
+    for path, st, sha1 in zip(paths, stats, sha1s):
+        entry = index_entry_from_stat(path, st, bytes.fromhex(sha1))
         entries.append(entry)
     entries.sort(key=operator.attrgetter('path'))
-    write_index(entries)
+    extensions = dict(index.extensions)
+    if b'TREE' in extensions:
+        cache = parse_cache_tree(extensions[b'TREE'])
+        for path in paths:
+            invalidate_cache_tree(cache, path)
+        extensions[b'TREE'] = build_cache_tree(cache)
+    if b'FSMN' in extensions:
+        #Dirty bits are by entry position, so map them to the new entries
+        token, dirty = parse_fsmonitor(extensions[b'FSMN'], index.entries)
+        extensions[b'FSMN'] = build_fsmonitor(token, dirty, entries)
+    write_index(entries, extensions=extensions, version=index.version)
           
 def write_tree():
-    #Write a tree object from the current index entries
-    tree_entries = []
-    for entry in read_index():
-        assert '/' not in entry.path, \
-            'current only supports a single top level dir'
-        mode_path = '{:o} {}'.format(entry.mode, entry.path).encode()
-        tree_entry = mode_path + b'\x00' + entry.sha1
-        tree_entries.append(tree_entry)
-    return hash_objects(b''.join(tree_entries), 'tree')
+    """Write tree objects for the current index entries, one per directory,
+    and return SHA-1 of the root tree. Directories whose tree is still
+    valid in the index's cache tree (TREE extension) aren't rebuilt, and
+    the trees written are recorded there, so after changing one file only
+    the trees along its path are written again."""
+    index = read_index_file()
+    cache = parse_cache_tree(index.extensions.get(b'TREE', b''))
+
+    def build(entries, prefix):
+        #Write tree for the given entries, which are all under prefix
+        path = prefix.rstrip('/')
+        if path in cache and cache[path][0] == len(entries):
+            return cache[path][1]
+        tree_entries = []
+        i = 0
+        while i < len(entries):
+            name, sep, _ = entries[i].path[len(prefix):].partition('/')
+            if sep:
+                j = i + 1
+                while (j < len(entries) and
+                       entries[j].path.startswith(prefix + name + '/')):
+                    j += 1
+                sha1 = bytes.fromhex(build(entries[i:j], prefix + name + '/'))
+                tree_entries.append((name + '/', '40000 ' + name, sha1))
+                i = j
+            else:
+                mode_path = '{:o} {}'.format(entries[i].mode, name)
+                tree_entries.append((name, mode_path, entries[i].sha1))
+                i += 1
+        tree_entries.sort()
+        data = b''.join(mode_path.encode() + b'\x00' + sha1
+                        for _, mode_path, sha1 in tree_entries)
+        sha1 = hash_objects(data, 'tree')
+        cache[path] = (len(entries), sha1)
+        return sha1
+
+    sha1 = build(index.entries, '')
+    extensions = dict(index.extensions)
+    extensions[b'TREE'] = build_cache_tree(cache)
+    write_index(index.entries, extensions=extensions, version=index.version)
+    return sha1
 
 def get_local_main_hash():
     #Get current commit hash (sha1 string) of local main branch
@@ -274,80 +2049,288 @@ def commit(message, author):
     parent = get_local_main_hash()
     if author is None:
         author = '{} <{}>'.format(
-            os.environ.get['GIT_AUTHOR_NAME'], os.environ.get['GIT_AUTHOR_EMAIL'])
+            os.environ.get('GIT_AUTHOR_NAME'), os.environ.get('GIT_AUTHOR_EMAIL'))
     timestamp = int(time.mktime(time.localtime()))
     utc_offset = -time.timezone
-    author_time = '{} {} {:02}{:02}'.format(
+    author_time = '{} {}{:02}{:02}'.format(
         timestamp,
         '+' if utc_offset > 0 else '-',
         abs(utc_offset) // 3600,
         (abs(utc_offset) // 60) % 60)
-    lines = ['tree' + tree]
+    lines = ['tree ' + tree]
     if parent:
-        lines.append('parent' + parent)
+        lines.append('parent ' + parent)
     lines.append('author {} {}'.format(author, author_time))
     lines.append('committer {} {}'.format(author, author_time))
     lines.append('')
     lines.append(message)
     lines.append('')
-    data = '\n'.join('lines').encode()
+    data = '\n'.join(lines).encode()
     sha1 = hash_objects(data, 'commit')
     main_path = os.path.join('.git', 'refs', 'heads', 'main')
     write_file(main_path, (sha1 + '\n').encode())
     print('committed to main: {:7}'.format(sha1))
     return sha1 
         
-def extract_lines(data):
-    #Extract list of lines from given server data
-    lines = []
-    i = 0
-    for _ in range(1000):
-        line_length = int(data[i:i + 4], 16)
-        line = data[i + 4: i + line_length]
-        lines.append(line)
-        if line_length == 0:
-            i += 4
-        else:
-            i += line_length
-            
-        if i >= len(data):
-            break
-    return lines           
+def read_pkt_lines(read):
+    """Generate pkt-lines read from a stream by calling read(n): the
+    payload bytes of each data line (including any trailing newline), or
+    PktLine.flush, PktLine.delim or PktLine.response_end for the special
+    packets. Lines are parsed one at a time as they arrive, so there is no
+    limit on how many a response can have."""
+    while True:
+        header = read(4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise ValueError('truncated pkt-line header {!r}'.format(header))
+        length = int(header, 16)
+        if length < 4:
+            yield PktLine(length)
+            continue
+        payload = read(length - 4)
+        if len(payload) < length - 4:
+            raise ValueError('truncated pkt-line, expected {} bytes, got '
+                             '{}'.format(length - 4, len(payload)))
+        yield payload
+
+def iter_side_band(lines, progress=None):
+    """Generate the data (band 1) of side-band pkt-lines up to the next
+    flush, writing progress messages (band 2) to progress (sys.stderr by
+    default) as they arrive. Raise ValueError on an error message (band
+    3)."""
+    import re
+    progress = progress or sys.stderr
+    line_start = True
+    for line in lines:
+        if line is PktLine.flush:
+            return
+        band, payload = line[0], line[1:]
+        if band == 1:
+            yield payload
+        elif band == 2:
+            #Messages may hold several lines, or '\r'-terminated updates
+            #of one progress line, or be split across packets; each line
+            #gets the prefix like in git
+            for message in re.findall(r'[^\r\n]*[\r\n]?',
+                                      payload.decode(errors='replace')):
+                if message:
+                    progress.write(('remote: ' if line_start else '') +
+                                   message)
+                    line_start = message[-1] in '\r\n'
+            progress.flush()
+        elif band == 3:
+            raise ValueError('remote error: {}'.format(
+                    payload.decode(errors='replace').strip()))
+        else:
+            raise ValueError('unknown side-band {}'.format(band))
         
+def encode_pkt_line(line):
+    #Encode given line (without newline) as a pkt-line to send to server
+    return '{:04x}'.format(len(line) + 5).encode() + line + b'\n'
+
 def build_lines_data(lines):
     #Build byte string from given lines to send to server
-    result = []
-    for line in lines:
-        result.append('{:04x}'.format(len(line) + 5).encode())
-        result.append(line)
-        result.append(b'\n')
-    result.append(b'0000')
-    return b''.join(result)
+    return b''.join(encode_pkt_line(line) for line in lines) + b'0000'
+
+
+#Open keep-alive HTTP connections by (scheme, host and port, proxy), so
+#requests to the same remote reuse one connection (and TLS session)
+_http_connections = {}
+
+#URL prefixes that were redirected, mapped to where they redirected to, so
+#that later requests to the same repo go there directly (like git, which
+#keeps the URL the first request was redirected to)
+_http_redirects = {}
+
+#Maximum number of redirects followed for one request
+HTTP_MAX_REDIRECTS = 5
+
+def http_connection(parts):
+    """Return tuple of (connection, path, headers): the pooled keep-alive
+    http.client.HTTPConnection (or HTTPSConnection) for the scheme and host
+    of given urllib.parse.urlsplit result, the path to request on it and
+    any extra headers it needs. A proxy configured in the environment
+    (http_proxy, https_proxy, no_proxy) is used like urllib does: HTTPS
+    goes through a CONNECT tunnel, HTTP requests the full URL from it."""
+    import base64, http.client, urllib.parse, urllib.request
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    headers = {}
+    proxy = urllib.request.getproxies().get(parts.scheme)
+    if proxy and urllib.request.proxy_bypass(parts.hostname):
+        proxy = None
+    key = (parts.scheme, parts.netloc, proxy)
+    if proxy:
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        proxy_parts = urllib.parse.urlsplit(proxy)
+        if proxy_parts.username is not None:
+            credentials = '{}:{}'.format(
+                    urllib.parse.unquote(proxy_parts.username),
+                    urllib.parse.unquote(proxy_parts.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + \
+                    base64.b64encode(credentials.encode()).decode()
+    connection = _http_connections.get(key)
+    if connection is None:
+        if proxy and parts.scheme == 'https':
+            connection = http.client.HTTPSConnection(
+                    proxy_parts.hostname, proxy_parts.port or 80)
+            connection.set_tunnel(parts.hostname, parts.port,
+                                  headers=headers)
+        elif proxy:
+            connection = http.client.HTTPConnection(
+                    proxy_parts.hostname, proxy_parts.port or 80)
+        elif parts.scheme == 'https':
+            connection = http.client.HTTPSConnection(parts.hostname,
+                                                     parts.port)
+        else:
+            connection = http.client.HTTPConnection(parts.hostname,
+                                                    parts.port)
+        _http_connections[key] = connection
+        trace_count('http/connections')
+    if proxy and parts.scheme == 'https':
+        #The tunnel carries the proxy credentials, not each request
+        return (connection, path, {})
+    if proxy:
+        return (connection, urllib.parse.urlunsplit(parts), headers)
+    return (connection, path, headers)
+
+def forget_http_connection(connection):
+    #Close connection and remove it from the pool
+    connection.close()
+    for key, pooled in list(_http_connections.items()):
+        if pooled is connection:
+            del _http_connections[key]
+
+@trace_timer('http/request')
+def http_open(url, username, password, data=None, content_type=None,
+              headers=None):
+    """Make an authenticated HTTP request to given URL (GET by default, POST
+    if data is not None) over a pooled keep-alive connection and return
+    the http.client.HTTPResponse, which must be read to the end before the
+    next request to the same server. Data may also be an iterable of
+    bytes, which is sent with chunked transfer encoding as it is
+    generated; credentials are then sent up front, because a streamed
+    body can't be replayed after a 401, and it goes over a new connection,
+    because it couldn't be replayed if the pooled one had timed out. Proxies are used as configured in
+    the environment (see http_connection). Redirects are followed, up to
+    HTTP_MAX_REDIRECTS, unless the body is streamed (which can't be sent
+    twice); credentials are only kept for the same host. Requests for URLs
+    under one that was redirected go to the new location right away. Raise
+    urllib.error.HTTPError if the server responds with an error."""
+    import base64, urllib.error, urllib.parse
+    for old_prefix, new_prefix in _http_redirects.items():
+        if url.startswith(old_prefix + '/'):
+            url = new_prefix + url[len(old_prefix):]
+            break
+    requested_url = url
+    headers = dict(headers or {})
+    if content_type:
+        headers['Content-Type'] = content_type
+    if username is not None:
+        credentials = '{}:{}'.format(username, password or '').encode()
+        headers['Authorization'] = 'Basic ' + \
+                base64.b64encode(credentials).decode()
+    method = 'GET' if data is None else 'POST'
+    replayable = data is None or isinstance(data, bytes)
+    redirects = 0
+    while True:
+        parts = urllib.parse.urlsplit(url)
+        connection, path, extra_headers = http_connection(parts)
+        reused = connection.sock is not None
+        if reused and not replayable:
+            #The server may have closed the kept-alive connection while it
+            #was idle, and a streamed body couldn't be resent, so reconnect
+            connection.close()
+            reused = False
+        trace_count('http/requests')
+        try:
+            connection.request(method, path, body=data,
+                               headers=dict(headers, **extra_headers))
+            response = connection.getresponse()
+        except ConnectionError:
+            #The server may have closed a kept-alive connection while it
+            #was idle; retry once on a new one if the body can be resent
+            forget_http_connection(connection)
+            if reused and replayable:
+                continue
+            raise
+        location = response.headers.get('Location')
+        if (response.status not in (301, 302, 303, 307, 308) or
+                not location or not replayable or
+                redirects >= HTTP_MAX_REDIRECTS):
+            break
+        response.read()
+        redirects += 1
+        trace_count('http/redirects')
+        new_url = urllib.parse.urljoin(url, location)
+        if urllib.parse.urlsplit(new_url).netloc != parts.netloc:
+            headers.pop('Authorization', None)
+        if response.status == 303:
+            method, data = 'GET', None
+        url = new_url
+    if url != requested_url:
+        #Remember the redirect for the URL before the path segments (and
+        #query) both URLs end with, e.g. the repo before /info/refs
+        old_parts = urllib.parse.urlsplit(requested_url)
+        new_parts = urllib.parse.urlsplit(url)
+        old_path = old_parts.path.split('/')
+        new_path = new_parts.path.split('/')
+        common = 0
+        while (common < min(len(old_path), len(new_path)) - 1 and
+               old_path[-1 - common] == new_path[-1 - common]):
+            common += 1
+        if common and old_parts.query == new_parts.query:
+            old_base, new_base = [urllib.parse.urlunsplit(parts._replace(
+                    path='/'.join(path[:-common]), query='', fragment=''))
+                    for parts, path in [(old_parts, old_path),
+                                        (new_parts, new_path)]]
+            _http_redirects[old_base] = new_base
+    if not 200 <= response.status < 300:
+        response.read()
+        raise urllib.error.HTTPError(url, response.status, response.reason,
+                                     response.headers, None)
+    return response
 
-def http_request(url, username, password, data=None):
-    """Make an authenticated HTTP request to given URL
-    (GET by default, POST if data is not None.)"""
-    password_manager = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-    password_manager.add_password(None, url, username, password)
-    auth_handler = urllib.request.HTTPBasicAuthHandler(password_manager)
-    opener = urllib.request.build_opener(auth_handler)
-    f = opener.open(url, data=data)
-    return f.read()
+def http_request(url, username, password, data=None, content_type=None):
+    """Make an authenticated HTTP request to given URL like http_open and
+    return the response body as bytes."""
+    return http_open(url, username, password, data=data,
+                     content_type=content_type).read()
+
+def get_remote_refs(git_url, username, password, service='git-receive-pack'):
+    """Return tuple of (refs, capabilities) advertised by remote repo for
+    given service, where refs is a dict mapping ref name (like
+    'refs/heads/main') to SHA-1 hex string, and capabilities a set of
+    strings (like 'side-band-64k')."""
+    url = git_url + '/info/refs?service=' + service
+    response = http_open(url, username, password)
+    lines = read_pkt_lines(response.read)
+    service_line = next(lines, None)
+    assert service_line == '# service={}\n'.format(service).encode(), \
+        'unexpected service line {!r}'.format(service_line)
+    assert next(lines, None) is PktLine.flush
+    refs = {}
+    capabilities = None
+    for line in lines:
+        if line is PktLine.flush:
+            break
+        line = line.rstrip(b'\n')
+        if capabilities is None:
+            line, _, capability_data = line.partition(b'\x00')
+            capabilities = set(capability_data.decode().split())
+        sha1, name = line.decode().split(' ', 1)
+        #An empty repo advertises its capabilities on a dummy ref
+        if name != 'capabilities^{}':
+            refs[name] = sha1
+    response.read()
+    return (refs, capabilities or set())
 
 def get_remote_main_hash(git_url, username, password):
     """Get a commit hash of remote master branch, return SHA-1 hex string 
     or None if no remote commits."""
-    url = git_url + '/info/refs?service=git-receive-pack'
-    response = http_request(url, username, password)
-    lines = extract_lines(response)
-    assert lines[0] == b'# service=git-receive-pack\n'
-    assert lines[1] == b''
-    if lines[2][:40] == b'0' * 40:
-        return None
-    main_sha1, main_ref = lines[2].split(b'\x00')[0].split()
-    assert main_ref == b'refs/heads/main'
-    assert len(main_sha1) == 40
-    return main_sha1.decode()
+    refs, _ = get_remote_refs(git_url, username, password)
+    return refs.get('refs/heads/main')
 
 def read_tree(sha1=None, data=None):
     """Read tree object with given sha1(hex string) or data, and return
@@ -360,57 +2343,440 @@ def read_tree(sha1=None, data=None):
 
     i = 0
     entries = []
-    for _ in range(1000):
+    while True:
         end = data.find(b'\x00', i)
         if end == -1:
             break
-        mode_str, path = data[i:end].decode().split()
+        mode_str, path = data[i:end].decode().split(' ', 1)
         mode = int(mode_str, 8)
         digest = data[end + 1:end + 21]
         entries.append((mode, path, digest.hex()))
         i = end + 1 + 20
     return entries
 
-def find_tree_objects(tree_sha1):
-    """Return set of sha1 hashes of all objects in this tree
-    (recursively), including hash of the tree itself."""
-    objects = {tree_sha1}
-    for mode, path, sha1, in read_tree(sha1=tree_sha1):
-        if stat.S_ISDIR(mode):
-            objects.update(find_tree_objects(sha1))
+@functools.lru_cache(maxsize=OBJECT_CACHE_SIZE)
+def read_tree_entries(sha1):
+    """Return tuple of (mode, path, sha1) entries of tree with given sha1
+    (full hex string). Results are kept in a bounded LRU cache, so a tree is
+    only inflated once while it is in use."""
+    return tuple(read_tree(sha1=sha1))
+
+@functools.lru_cache(maxsize=OBJECT_CACHE_SIZE)
+def parse_commit(sha1):
+    """Read commit object with given sha1 (full hex string) and return a
+    Commit. Results are kept in a bounded LRU cache like read_tree_entries."""
+    obj_type, data = read_object(sha1)
+    assert obj_type == 'commit', 'expected commit {}, got {}'.format(
+        sha1, obj_type)
+    header, _, message = data.decode(errors='replace').partition('\n\n')
+    tree = author = committer = None
+    parents = []
+    for line in header.splitlines():
+        key, _, value = line.partition(' ')
+        if key == 'tree':
+            tree = value
+        elif key == 'parent':
+            parents.append(value)
+        elif key == 'author':
+            author = value
+        elif key == 'committer':
+            committer = value
+    timestamp = int(committer.split()[-2]) if committer else 0
+    return Commit(tree, tuple(parents), author, committer, timestamp, message)
+
+def get_local_refs():
+    """Return dict mapping ref name (like 'refs/heads/main') to commit
+    sha1 for all local branches, loose or in .git/packed-refs."""
+    refs = {}
+    try:
+        for line in read_file(os.path.join('.git', 'packed-refs')) \
+                .decode().splitlines():
+            if line and line[0] not in '#^':
+                sha1, name = line.split()
+                refs[name] = sha1
+    except FileNotFoundError:
+        pass
+    heads_dir = os.path.join('.git', 'refs', 'heads')
+    for root, dirs, files in os.walk(heads_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            ref = 'refs/heads/' + os.path.relpath(path, heads_dir).replace(
+                    '\\', '/')
+            refs[ref] = read_file(path).decode().strip()
+    return {name: sha1 for name, sha1 in refs.items()
+            if name.startswith('refs/heads/')}
+
+def write_commit_graph():
+    """Write commit-graph file (.git/objects/info/commit-graph, in git's
+    format) for all commits reachable from local branches. It stores each
+    commit's tree, parents, generation number and commit date, so history
+    walks don't have to inflate commit objects. Return number of commits."""
+    commits = {}
+    stack = list(get_local_refs().values())
+    while stack:
+        sha1 = stack.pop()
+        if sha1 not in commits:
+            commits[sha1] = parse_commit(sha1)
+            stack.extend(commits[sha1].parents)
+    generations = {}
+    for sha1 in commits:
+        stack = [sha1]
+        while stack:
+            top = stack[-1]
+            if top in generations:
+                stack.pop()
+                continue
+            pending = [p for p in commits[top].parents
+                       if p not in generations]
+            if pending:
+                stack.extend(pending)
+            else:
+                generations[top] = 1 + max(
+                        (generations[p] for p in commits[top].parents),
+                        default=0)
+                stack.pop()
+
+    oids = sorted(commits)
+    positions = {sha1: i for i, sha1 in enumerate(oids)}
+    fanout = [0] * 256
+    for sha1 in oids:
+        fanout[int(sha1[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    commit_data = []
+    edges = []
+    for sha1 in oids:
+        commit = commits[sha1]
+        parents = [positions[p] for p in commit.parents]
+        parent1 = parents[0] if parents else 0x70000000
+        if len(parents) > 2:
+            #Octopus merge: parent2 points at list of others in edges chunk
+            parent2 = 0x80000000 | len(edges)
+            edges.extend(parents[1:-1])
+            edges.append(0x80000000 | parents[-1])
+        else:
+            parent2 = parents[1] if len(parents) > 1 else 0x70000000
+        timestamp = commit.timestamp & 0x3ffffffff
+        commit_data.append(bytes.fromhex(commit.tree) + struct.pack(
+                '!LLLL', parent1, parent2,
+                (generations[sha1] << 2) | (timestamp >> 32),
+                timestamp & 0xffffffff))
+    chunks = [(b'OIDF', struct.pack('!256L', *fanout)),
+              (b'OIDL', b''.join(bytes.fromhex(s) for s in oids)),
+              (b'CDAT', b''.join(commit_data))]
+    if edges:
+        chunks.append((b'EDGE', struct.pack('!{}L'.format(len(edges)),
+                                            *edges)))
+    header = struct.pack('!4sBBBB', b'CGPH', 1, 1, len(chunks), 0)
+    offset = len(header) + 12 * (len(chunks) + 1)
+    table = []
+    for chunk_id, chunk in chunks:
+        table.append(struct.pack('!4sQ', chunk_id, offset))
+        offset += len(chunk)
+    table.append(struct.pack('!4sQ', b'\x00' * 4, offset))
+    contents = header + b''.join(table) + b''.join(c for _, c in chunks)
+    info_dir = os.path.join('.git', 'objects', 'info')
+    os.makedirs(info_dir, exist_ok=True)
+    import tempfile
+    fd, temp_path = tempfile.mkstemp(dir=info_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(contents + hashlib.sha1(contents).digest())
+    os.replace(temp_path, os.path.join(info_dir, 'commit-graph'))
+    return len(oids)
+
+def open_commit_graph(path):
+    """Memory-map commit-graph file at given path and return CommitGraph,
+    or None if it is damaged or its checksum doesn't match (the graph is
+    then ignored, and commits are read from the object store)."""
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if (len(data) < 28 or
+            hashlib.sha1(data[:-20]).digest() != data[-20:]):
+        return None
+    signature, version, hash_version, num_chunks, _ = struct.unpack(
+            '!4sBBBB', data[:8])
+    if signature != b'CGPH' or version != 1 or hash_version != 1:
+        return None
+    offsets = {}
+    for i in range(num_chunks):
+        chunk_id, offset = struct.unpack_from('!4sQ', data, 8 + 12 * i)
+        offsets[chunk_id] = offset
+    if not {b'OIDF', b'OIDL', b'CDAT'} <= set(offsets):
+        return None
+    fanout = struct.unpack_from('!256L', data, offsets[b'OIDF'])
+    return CommitGraph(data, fanout, offsets[b'OIDL'], offsets[b'CDAT'],
+                       offsets.get(b'EDGE'))
+
+#Cache of (commit-graph mtime, CommitGraph or None)
+_commit_graph = (None, None)
+
+def get_commit_graph():
+    #Return CommitGraph for the repo, or None if there is no usable one
+    global _commit_graph
+    path = os.path.join('.git', 'objects', 'info', 'commit-graph')
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if mtime != _commit_graph[0]:
+        _commit_graph = (mtime, open_commit_graph(path))
+    return _commit_graph[1]
+
+def commit_graph_position(graph, sha1):
+    #Return position of commit with given hex sha1 in graph, or None
+    first_byte = int(sha1[:2], 16)
+    lo = graph.fanout[first_byte - 1] if first_byte else 0
+    hi = graph.fanout[first_byte]
+    key = bytes.fromhex(sha1)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = graph.oids_offset + 20 * mid
+        mid_sha1 = graph.data[start:start + 20]
+        if mid_sha1 == key:
+            return mid
+        if mid_sha1 < key:
+            lo = mid + 1
         else:
-            objects.add(sha1)
+            hi = mid
+    return None
+
+def commit_graph_oid(graph, position):
+    #Return hex sha1 of commit at given position in graph
+    start = graph.oids_offset + 20 * position
+    return graph.data[start:start + 20].hex()
+
+def commit_info(sha1):
+    """Return CommitInfo for commit with given sha1 (full hex string), from
+    the commit-graph if it has the commit, otherwise by parsing the commit
+    object (generation is then GENERATION_INFINITY)."""
+    graph = get_commit_graph()
+    position = None if graph is None else commit_graph_position(graph, sha1)
+    if position is None:
+        commit = parse_commit(sha1)
+        return CommitInfo(commit.tree, commit.parents, commit.timestamp,
+                          GENERATION_INFINITY)
+    start = graph.commits_offset + 36 * position
+    tree = graph.data[start:start + 20].hex()
+    parent1, parent2, generation, time_low = struct.unpack_from(
+            '!LLLL', graph.data, start + 20)
+    parents = []
+    if parent1 != 0x70000000:
+        parents.append(commit_graph_oid(graph, parent1))
+    if parent2 & 0x80000000:
+        i = parent2 & 0x7fffffff
+        while True:
+            edge, = struct.unpack_from('!L', graph.data,
+                                       graph.edges_offset + 4 * i)
+            parents.append(commit_graph_oid(graph, edge & 0x7fffffff))
+            if edge & 0x80000000:
+                break
+            i += 1
+    elif parent2 != 0x70000000:
+        parents.append(commit_graph_oid(graph, parent2))
+    timestamp = ((generation & 3) << 32) | time_low
+    return CommitInfo(tree, tuple(parents), timestamp, generation >> 2)
+
+def find_tree_objects(tree_sha1, exclude=frozenset()):
+    """Return set of sha1 hashes of all objects in this tree
+    (recursively), including hash of the tree itself. Objects in
+    'exclude' are skipped, and so is everything below excluded trees."""
+    objects = set()
+    stack = [tree_sha1]
+    while stack:
+        sha1 = stack.pop()
+        if sha1 in objects or sha1 in exclude:
+            continue
+        objects.add(sha1)
+        for mode, path, entry_sha1 in read_tree_entries(sha1):
+            if stat.S_ISDIR(mode):
+                stack.append(entry_sha1)
+            elif entry_sha1 not in exclude:
+                objects.add(entry_sha1)
     return objects
 
 def find_commit_objects(commit_sha1):
     """Return set of sha1 hashes of all objects in this commit
     (recursively), its tree, its parents, and the hash of the commit."""
-    objects = {commit_sha1}
-    obj_type, commit = read_object(commit_sha1)
-    assert obj_type == 'commit'
-    lines = commit.decode().splitlines()
-    tree = next(l[5:45] for l in lines if l.startswith('tree '))
-    objects.update(find_tree_objects(tree))
-    parents = (l[7:47] for l in lines if l.startswith('parent '))
-    for parent in parents:
-        objects.update(find_commit_objects(parent))
-    return objects
+    objects = set()
+    commits = set()
+    stack = [commit_sha1]
+    while stack:
+        sha1 = stack.pop()
+        if sha1 in commits:
+            continue
+        commits.add(sha1)
+        commit = commit_info(sha1)
+        objects.update(find_tree_objects(commit.tree, exclude=objects))
+        stack.extend(commit.parents)
+    return objects | commits
 
 def find_missing_objects(local_sha1, remote_sha1):
     """Return set of sha1 hashes of object in local commit that are
-    missing at the remote(based on the given remote commit hash)"""
-    local_objects = find_commit_objects(local_sha1)
+    missing at the remote(based on the given remote commit hash)
+
+    History is walked newest first (by generation number if the commits
+    are in the commit-graph, otherwise by date) from both commits at once,
+    marking every commit as reachable from local, remote or both, and the
+    walk stops as soon as only commits the remote has are left. So the
+    cost depends on the amount of new work, not on the size of the
+    history."""
     if remote_sha1 is None:
-        return local_objects
-    remote_objects = find_commit_objects(remote_sha1)
-    return local_objects - remote_objects
+        return find_commit_objects(local_sha1)
+
+    def queue_key(sha1):
+        commit = commit_info(sha1)
+        return (-commit.generation, -commit.timestamp, sha1)
+
+    LOCAL, REMOTE = 1, 2
+    flags = {local_sha1: LOCAL}
+    flags[remote_sha1] = flags.get(remote_sha1, 0) | REMOTE
+    queue = [queue_key(s) for s in flags]
+    heapq.heapify(queue)
+    queued = set(flags)
+    num_local_queued = sum(1 for f in flags.values() if f == LOCAL)
+    local_commits = []
+    remote_commits = []
+    while num_local_queued:
+        _, _, sha1 = heapq.heappop(queue)
+        queued.remove(sha1)
+        flag = flags[sha1]
+        if flag == LOCAL:
+            num_local_queued -= 1
+            local_commits.append(sha1)
+        else:
+            remote_commits.append(sha1)
+        for parent in commit_info(sha1).parents:
+            if parent not in flags:
+                flags[parent] = flag
+                heapq.heappush(queue, queue_key(parent))
+                queued.add(parent)
+                if flag == LOCAL:
+                    num_local_queued += 1
+            elif flags[parent] | flag != flags[parent]:
+                if parent in queued and flags[parent] == LOCAL:
+                    num_local_queued -= 1
+                flags[parent] |= flag
+    #Everything in the trees of the remote commits at the edge of the walk
+    #is on the remote already
+    remote_objects = set()
+    for sha1 in remote_commits + [key[-1] for key in queue]:
+        remote_objects.update(find_tree_objects(
+                commit_info(sha1).tree, exclude=remote_objects))
+    missing = set(local_commits)
+    for sha1 in local_commits:
+        objects = find_tree_objects(commit_info(sha1).tree,
+                                    exclude=remote_objects)
+        remote_objects |= objects
+        missing |= objects
+    return missing
     
+def find_tree_path(tree_sha1, path):
+    #Return sha1 of blob or tree at given path (like 'dir/file') under
+    #given tree, or None if there is nothing at that path
+    sha1 = tree_sha1
+    mode = stat.S_IFDIR
+    for name in path.split('/'):
+        if not stat.S_ISDIR(mode):
+            return None
+        for mode, entry_name, entry_sha1 in read_tree_entries(sha1):
+            if entry_name == name:
+                sha1 = entry_sha1
+                break
+        else:
+            return None
+    return sha1
+
+def iter_commits(start_sha1s, paths=None):
+    """Yield sha1 of each commit reachable from given commits, newest
+    (by commit date) first. Commits are read one at a time as the walk
+    reaches them, so taking the first few is cheap however long the
+    history is.
+
+    If paths is given, only yield commits that change something at or
+    under one of those paths. Like git, a merge that left the paths the
+    same as one of its parents is skipped, and only that parent's side
+    of history is followed."""
+    #Commits with the same date come out in the order they were queued
+    counter = itertools.count()
+    queue = []
+    seen = set()
+    for sha1 in start_sha1s:
+        if sha1 not in seen:
+            seen.add(sha1)
+            heapq.heappush(queue, (-commit_info(sha1).timestamp,
+                                   next(counter), sha1))
+    while queue:
+        _, _, sha1 = heapq.heappop(queue)
+        commit = commit_info(sha1)
+        parents = commit.parents
+        show = True
+        if paths:
+            def path_sha1s(tree):
+                return tuple(find_tree_path(tree, p) for p in paths)
+            own = path_sha1s(commit.tree)
+            same = [p for p in parents
+                    if path_sha1s(commit_info(p).tree) == own]
+            if same:
+                show = False
+                parents = same[:1]
+            elif not parents:
+                show = any(s is not None for s in own)
+        if show:
+            yield sha1
+        for parent in parents:
+            if parent not in seen:
+                seen.add(parent)
+                heapq.heappush(queue, (-commit_info(parent).timestamp,
+                                       next(counter), parent))
+
+def format_date(timestamp, tz):
+    #Format timestamp and '+hhmm' timezone offset like git log does
+    sign = -1 if tz.startswith('-') else 1
+    offset = sign * (int(tz[1:3]) * 3600 + int(tz[3:5]) * 60)
+    t = time.gmtime(timestamp + offset)
+    return '{} {} {}'.format(time.strftime('%a %b', t), t.tm_mday,
+                             time.strftime('%H:%M:%S %Y', t)) + ' ' + tz
+
+def log(max_count=None, paths=None, oneline=False):
+    """Print history of local main branch, newest commit first. Show at
+    most max_count commits, and only those changing given paths. If
+    oneline is True, show just the shortest unique hash prefix and subject
+    of each commit."""
+    local_sha1 = get_local_main_hash()
+    if local_sha1 is None:
+        print('no commits yet', file=sys.stderr)
+        return
+    paths = [p.strip('/') for p in paths or [] if p.strip('/')]
+    commits = iter_commits([local_sha1], paths=paths)
+    for i, sha1 in enumerate(itertools.islice(commits, max_count)):
+        commit = parse_commit(sha1)
+        if oneline:
+            subject = ' '.join(commit.message.strip('\n').partition('\n\n')[0]
+                               .split('\n'))
+            print(shortest_unique_prefix(sha1), subject)
+            continue
+        name, timestamp, tz = commit.author.rsplit(' ', 2)
+        if i:
+            print()
+        print('commit', sha1)
+        if len(commit.parents) > 1:
+            print('Merge:', ' '.join(shortest_unique_prefix(p)
+                                     for p in commit.parents))
+        print('Author:', name)
+        print('Date:   ' + format_date(int(timestamp), tz))
+        print()
+        for line in commit.message.rstrip('\n').split('\n'):
+            print('    ' + line)
+
 def encode_pack_object(obj):
     """Encode a single object for a pack file and return bytes
     (variable-length header followed by compressed data bytes)."""
     obj_type, data = read_object(obj)
     type_num = ObjectType[obj_type].value
-    size = len(data)
+    return encode_pack_header(type_num, len(data)) + zlib.compress(data)
+
+def encode_pack_header(type_num, size):
+    #Encode variable-length pack object header for given type and size
     byte = (type_num << 4) | (size & 0x0f)
     size >>= 4
     header = []
@@ -419,36 +2785,415 @@ def encode_pack_object(obj):
         byte = size & 0x7f
         size >>= 7
     header.append(byte)
-    return bytes(header) + zlib.compress(data)
+    return bytes(header)
 
-def create_pack(objects):
-    """Create pack file containing all objects in given set of sha1 hashes,
-     return bytes of full pack file"""
+def encode_ofs_distance(distance):
+    """Encode distance back to the base object of an OFS_DELTA entry (the
+    inverse of the decoding in read_pack_object)."""
+    result = [distance & 0x7f]
+    distance >>= 7
+    while distance:
+        distance -= 1
+        result.append(0x80 | (distance & 0x7f))
+        distance >>= 7
+    return bytes(reversed(result))
+
+def encode_delta_size(size):
+    #Encode size as little-endian base-128 varint used in delta headers
+    result = []
+    while True:
+        byte = size & 0x7f
+        size >>= 7
+        if not size:
+            result.append(byte)
+            return bytes(result)
+        result.append(byte | 0x80)
+
+def encode_delta_copy(offset, size):
+    #Encode delta instruction copying size (<= 0x10000) bytes from base
+    op = 0x80
+    args = []
+    for bit in range(4):
+        byte = (offset >> (8 * bit)) & 0xff
+        if byte:
+            op |= 1 << bit
+            args.append(byte)
+    for bit in range(3):
+        byte = (size >> (8 * bit)) & 0xff
+        if byte:
+            op |= 0x10 << bit
+            args.append(byte)
+    return bytes([op] + args)
+
+@trace_timer('pack/create_delta')
+def create_delta(base, target, block_size=16, max_size=None):
+    """Return git delta instructions that turn base into target bytes (see
+    apply_delta). Base is indexed in fixed-size blocks, and every block of
+    target found in the index is extended as far as it matches in both
+    directions and emitted as a copy; everything else is inserted. Return
+    None as soon as the delta is known to be longer than max_size bytes
+    (if given), as it isn't worth finishing then."""
+    if max_size is None:
+        max_size = sys.maxsize
+    index = {}
+    for i in range(0, len(base) - block_size + 1, block_size):
+        index.setdefault(base[i:i + block_size], i)
+    result = [encode_delta_size(len(base)), encode_delta_size(len(target))]
+    size = len(result[0]) + len(result[1])
+
+    def insert(data):
+        for i in range(0, len(data), 127):
+            chunk = data[i:i + 127]
+            result.append(bytes([len(chunk)]) + chunk)
+        return len(data) + (len(data) + 126) // 127
+
+    insert_start = i = 0
+    while i + block_size <= len(target):
+        base_start = index.get(target[i:i + block_size])
+        if base_start is None:
+            i += 1
+            #The bytes since the last copy will have to be inserted,
+            #except for less than a block a later match extends back over
+            #(a whole block would have matched here already)
+            if size + i - insert_start - block_size >= max_size:
+                return None
+            continue
+        start = i
+        while (start > insert_start and base_start > 0 and
+               target[start - 1] == base[base_start - 1]):
+            start -= 1
+            base_start -= 1
+        end = i + block_size
+        base_end = base_start + (end - start)
+        while (end + block_size <= len(target) and
+               base_end + block_size <= len(base) and
+               target[end:end + block_size] ==
+               base[base_end:base_end + block_size]):
+            end += block_size
+            base_end += block_size
+        while (end < len(target) and base_end < len(base) and
+               target[end] == base[base_end]):
+            end += 1
+            base_end += 1
+        size += insert(target[insert_start:start])
+        for offset in range(base_start, base_end, 0x10000):
+            result.append(encode_delta_copy(
+                    offset, min(0x10000, base_end - offset)))
+            size += len(result[-1])
+        if size > max_size:
+            return None
+        insert_start = i = end
+    size += insert(target[insert_start:])
+    if size > max_size:
+        return None
+    return b''.join(result)
+
+def find_deltas(objects, window=10, depth=50, bases=None):
+    """Choose delta bases for given list of (sha1, obj_type, name, size)
+    tuples. Objects are sorted by type, name and size (largest first) and
+    each one is compared with the previous 'window' objects of the same
+    type; delta chains are limited to 'depth' deltas. 'bases' optionally
+    maps sha1 of an object to sha1 of an extra candidate base that is not
+    in objects (for example the previous version of the same path that a
+    remote already has); it is skipped if not in the object store.
+
+    Generate (sha1, obj_type, data, delta) in pack order, where delta is
+    None or a tuple of (base_sha1, delta_bytes). Every base in objects is
+    generated before the objects deltified against it, and only the data
+    of the last 'window' objects is kept in memory."""
+    if bases is None:
+        bases = {}
+    ordered = sorted(objects, key=lambda o: (
+            ObjectType[o[1]].value, o[2], -o[3]))
+    recent = collections.deque(maxlen=window)
+    for sha1, obj_type, _, _ in ordered:
+        _, data = read_object(sha1)
+        candidates = [(base_sha1, base_data, base_depth)
+                      for base_sha1, base_type, base_data, base_depth
+                      in recent if base_type == obj_type]
+        if sha1 in bases:
+            try:
+                base_type, base_data = read_object(bases[sha1])
+            except ValueError:
+                base_type = None
+            if base_type == obj_type:
+                candidates.append((bases[sha1], base_data, 0))
+        best = None
+        best_depth = 0
+        #Only deltas under half the object's size are worth using, and
+        #then only ones smaller than the best so far
+        max_size = len(data) // 2 - 1
+        for base_sha1, base_data, base_depth in candidates:
+            if base_depth >= depth or not base_data:
+                continue
+            #Growing into a bigger target inserts at least the difference,
+            #and a much bigger base is unlikely to be a good match either
+            if abs(len(base_data) - len(data)) > max_size:
+                continue
+            delta = create_delta(base_data, data, max_size=max_size)
+            if delta is not None:
+                best = (base_sha1, delta)
+                best_depth = base_depth + 1
+                max_size = len(delta) - 1
+        yield (sha1, obj_type, data, best)
+        recent.append((sha1, obj_type, data, best_depth))
+
+def encode_pack_entries(objects, ofs_delta=True):
+    """Generate (sha1, entry_bytes) for each object of a pack, given the
+    (sha1, obj_type, data, delta) tuples generated by find_deltas. Deltas
+    against an earlier object of the pack are encoded as OFS_DELTA (unless
+    ofs_delta is False, for receivers that don't support it), deltas
+    against any other object as REF_DELTA."""
+    offsets = {}
+    offset = 12
+    for sha1, obj_type, data, delta in objects:
+        if delta is not None:
+            base_sha1, delta = delta
+            if ofs_delta and base_sha1 in offsets:
+                entry = (encode_pack_header(ObjectType.ofs_delta.value,
+                                            len(delta)) +
+                         encode_ofs_distance(offset - offsets[base_sha1]) +
+                         zlib.compress(delta))
+            else:
+                entry = (encode_pack_header(ObjectType.ref_delta.value,
+                                            len(delta)) +
+                         bytes.fromhex(base_sha1) + zlib.compress(delta))
+        else:
+            entry = (encode_pack_header(ObjectType[obj_type].value,
+                                        len(data)) +
+                     zlib.compress(data))
+        offsets[sha1] = offset
+        offset += len(entry)
+        yield (sha1, entry)
+
+def list_pack_objects(objects):
+    """Return list of (sha1, obj_type, name, size) for objects in given set
+    of sha1 hashes, as needed by find_deltas. Objects are named after the
+    tree entries (among objects) that point at them, so that different
+    versions of the same file end up side by side. Only trees are read in
+    full."""
+    infos = []
+    names = {}
+    for sha1 in objects:
+        obj_type, size = read_object_info(sha1)
+        infos.append((sha1, obj_type, size))
+        if obj_type == 'tree':
+            for _, path, entry_sha1 in read_tree_entries(sha1):
+                names.setdefault(entry_sha1, path)
+    return [(s, t, names.get(s, ''), size) for s, t, size in infos]
+
+def write_pack_index(path, entries, pack_sha1):
+    """Write version 2 pack index to given path for list of (sha1, crc32,
+    offset) entries of the pack with given binary trailer SHA-1. The index
+    is written to a temp file and renamed into place, so readers never see
+    a partially written one."""
+    entries = sorted((bytes.fromhex(s), c, o) for s, c, o in entries)
+    fanout = [0] * 256
+    for sha1, _, _ in entries:
+        fanout[sha1[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    offsets = []
+    large_offsets = []
+    for _, _, offset in entries:
+        if offset < 0x80000000:
+            offsets.append(offset)
+        else:
+            offsets.append(0x80000000 | len(large_offsets))
+            large_offsets.append(offset)
+    contents = b''.join([
+        struct.pack('!4sL', b'\xfftOc', 2),
+        struct.pack('!256L', *fanout),
+        b''.join(sha1 for sha1, _, _ in entries),
+        b''.join(struct.pack('!L', crc) for _, crc, _ in entries),
+        b''.join(struct.pack('!L', offset) for offset in offsets),
+        b''.join(struct.pack('!Q', offset) for offset in large_offsets),
+        pack_sha1,
+    ])
+    import tempfile
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(contents + hashlib.sha1(contents).digest())
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
+
+def find_loose_objects():
+    #Return sorted list of sha1 hashes of all loose objects in object store
+    objects_dir = os.path.join('.git', 'objects')
+    objects = []
+    for dir_name in os.listdir(objects_dir):
+        if len(dir_name) != 2:
+            continue
+        for name in os.listdir(os.path.join(objects_dir, dir_name)):
+            if len(name) == 38:
+                objects.append(dir_name + name)
+    return sorted(objects)
+
+def repack(window=10, depth=50):
+    """Pack all loose objects into a single delta-compressed pack with an
+    .idx, verify every object can be read back from it, then delete the
+    loose copies. Return path of the new pack (without extension), or
+    None if there were no loose objects."""
+    loose = find_loose_objects()
+    if not loose:
+        print('nothing to repack')
+        return None
+    objects = list_pack_objects(loose)
+    pack_dir = os.path.join('.git', 'objects', 'pack')
+    os.makedirs(pack_dir, exist_ok=True)
+    import tempfile
+    fd, temp_path = tempfile.mkstemp(dir=pack_dir)
+    sha = hashlib.sha1()
+    index_entries = []
+    num_deltas = 0
+    with os.fdopen(fd, 'wb') as f, trace_region('repack', 'write_pack'):
+        def write(data):
+            sha.update(data)
+            f.write(data)
+        write(struct.pack('!4sLL', b'PACK', 2, len(objects)))
+        offset = 12
+        for sha1, entry in encode_pack_entries(
+                find_deltas(objects, window=window, depth=depth)):
+            write(entry)
+            index_entries.append((sha1, zlib.crc32(entry), offset))
+            offset += len(entry)
+            if (entry[0] >> 4) & 7 == ObjectType.ofs_delta.value:
+                num_deltas += 1
+        pack_sha1 = sha.digest()
+        f.write(pack_sha1)
+    path = os.path.join(pack_dir, 'pack-' + pack_sha1.hex())
+    os.replace(temp_path, path + '.pack')
+    write_pack_index(path + '.idx', index_entries, pack_sha1)
+
+    pack = open_pack(path)
+    with trace_region('repack', 'verify'):
+        for sha1 in loose:
+            offset = find_packed_objects(pack, sha1)[0][1]
+            obj_type, data = read_pack_object(pack, offset)
+            header = '{} {}'.format(obj_type, len(data)).encode()
+            assert hashlib.sha1(header + b'\x00' + data).hexdigest() == \
+                sha1, 'object {} does not match after repacking'.format(sha1)
+    for sha1 in loose:
+        os.remove(os.path.join('.git', 'objects', sha1[:2], sha1[2:]))
+    forget_loose_objects()
+    for sha1 in {s[:2] for s in loose}:
+        dir_path = os.path.join('.git', 'objects', sha1)
+        if not os.listdir(dir_path):
+            os.rmdir(dir_path)
+    print('packed {} object{} ({} delta{}) into {}'.format(
+            len(loose), '' if len(loose) == 1 else 's',
+            num_deltas, '' if num_deltas == 1 else 's', path))
+    return path
+
+def iter_pack(objects, bases=None, window=10, depth=50, ofs_delta=True):
+    """Generate the bytes of a pack file containing all objects in given
+    set of sha1 hashes: the header, then one chunk per object, then the
+    SHA-1 trailer computed as the chunks go by. Only 'window' objects are
+    held in memory at a time. Objects are deltified against each other,
+    and against the objects in 'bases' (a dict mapping sha1 of an object
+    to sha1 of a suggested base the receiver already has). See find_deltas
+    for window and depth, and encode_pack_entries for ofs_delta."""
+    objects = list_pack_objects(objects)
     header = struct.pack('!4sLL', b'PACK', 2, len(objects))
-    body = b''.join(encode_pack_object(o) for o in sorted(objects))
-    contents = header + body
-    sha1 = hashlib.sha1(contents).digest()
-    data = contents + sha1
-    return data
+    sha = hashlib.sha1(header)
+    yield header
+    for _, entry in encode_pack_entries(find_deltas(
+            objects, window=window, depth=depth, bases=bases),
+            ofs_delta=ofs_delta):
+        sha.update(entry)
+        trace_count('pack/bytes_written', len(entry))
+        yield entry
+    yield sha.digest()
+
+def create_pack(objects, bases=None, window=10, depth=50):
+    """Create pack file containing all objects in given set of sha1 hashes,
+     return bytes of full pack file (see iter_pack)."""
+    return b''.join(iter_pack(objects, bases=bases, window=window,
+                              depth=depth))
 
-def push(git_url, username=None, password=None):
-    #Push main branch to given git repo URL
+def find_tree_paths(tree_sha1):
+    """Return dict mapping path to sha1 of every blob and tree under given
+    tree (walked iteratively)."""
+    paths = {}
+    stack = [(tree_sha1, '')]
+    while stack:
+        sha1, prefix = stack.pop()
+        for mode, name, entry_sha1 in read_tree_entries(sha1):
+            path = prefix + name
+            paths[path] = entry_sha1
+            if stat.S_ISDIR(mode):
+                stack.append((entry_sha1, path + '/'))
+    return paths
+
+def find_delta_bases(local_sha1, remote_sha1):
+    """Return dict mapping sha1 of each blob or tree in the local commit's
+    tree to sha1 of the object at the same path in the remote commit's
+    tree, where the two differ. The remote already has those objects, so
+    they make good delta bases for a push. Return an empty dict if there
+    is no remote commit or it isn't in the local object store."""
+    if remote_sha1 is None:
+        return {}
+    try:
+        remote_tree = commit_info(remote_sha1).tree
+    except ValueError:
+        return {}
+    local_paths = find_tree_paths(commit_info(local_sha1).tree)
+    remote_paths = find_tree_paths(remote_tree)
+    return {sha1: remote_paths[path] for path, sha1 in local_paths.items()
+            if path in remote_paths and remote_paths[path] != sha1}
+
+def push(git_url, username=None, password=None, window=10, depth=50):
+    """Push main branch to given git repo URL. The pack is streamed to the
+    server as it is generated, with objects deltified against each other
+    and against the objects at the same paths in the remote's main commit
+    (see iter_pack for window and depth). The first push to an empty
+    remote sends whole objects, as searching for deltas among all of
+    them costs far more time than it saves in transfer; the remote can
+    repack them. Deltas against objects in the pack are sent as REF_DELTA
+    if the remote doesn't advertise ofs-delta."""
     if username is None:
         username = os.environ.get("GIT_USERNAME")
     if password is None:
         password = os.environ.get("GIT_PASSWORD") 
-    remote_sha1 = get_remote_main_hash(git_url, username, password)
+    with trace_region('push', 'refs', msg=git_url):
+        refs, capabilities = get_remote_refs(git_url, username, password)
+    remote_sha1 = refs.get('refs/heads/main')
     local_sha1 = get_local_main_hash()
-    missing = find_missing_objects(local_sha1, remote_sha1)
+    with trace_region('push', 'find_missing_objects'):
+        missing = find_missing_objects(local_sha1, remote_sha1)
+    trace_count('push/objects', len(missing))
     print('updating remote main from {} to {} ({} object{})'.format(
             remote_sha1 or 'no commits', local_sha1, len(missing),
             '' if len(missing) == 1 else 's'))
-    lines = ['{} {} refs/heads/main\x00 report-status'.format(
-            remote_sha1 or ('0' * 40), local_sha1).encode()]
-    data = build_lines_data(lines) + create_pack(missing)
+    #With side-band-64k the server reports progress while it unpacks,
+    #and the status report comes multiplexed on band 1
+    side_band = 'side-band-64k' in capabilities
+    lines = ['{} {} refs/heads/main\x00 report-status{}'.format(
+            remote_sha1 or ('0' * 40), local_sha1,
+            ' side-band-64k' if side_band else '').encode()]
+    with trace_region('push', 'find_delta_bases'):
+        bases = find_delta_bases(local_sha1, remote_sha1)
+    if remote_sha1 is None:
+        window = 0
+    data = itertools.chain([build_lines_data(lines)], iter_pack(
+            missing, bases=bases, window=window, depth=depth,
+            ofs_delta='ofs-delta' in capabilities))
     url = git_url + '/git-receive-pack'
-    response = http_request(url, username, password, data=data)
-    lines = extract_lines(response)
+    #The pack is generated while it is sent, so this region covers both
+    with trace_region('push', 'send_pack'):
+        response = http_open(
+                url, username, password, data=data,
+                content_type='application/x-git-receive-pack-request')
+    with trace_region('push', 'report'):
+        lines = read_pkt_lines(response.read)
+        if side_band:
+            report = b''.join(iter_side_band(lines))
+            lines = read_pkt_lines(io.BytesIO(report).read)
+        lines = [line for line in lines if line is not PktLine.flush]
+        response.read()
     assert len(lines) >= 2, \
         'expected at least 2 lines, got {}'.format(len(lines))
     assert lines[0] == b'unpack ok\n', \
@@ -457,102 +3202,747 @@ def push(git_url, username=None, password=None):
         "expected line 2 b'ok refs/heads/main', got {}".format(lines[1])
     return (remote_sha1, missing)
 
-     
-    
-if __name__ == "__main__":
+def inflate_pack_entry(data, pos, sha=None):
+    """Inflate zlib stream starting at given position of pack data in
+    pieces, feeding the output to sha (a hashlib object) if given, and
+    return position just after the stream. Memory use doesn't depend on
+    the size of the object."""
+    decompressor = zlib.decompressobj()
+    while not decompressor.eof:
+        chunk = decompressor.unconsumed_tail
+        if not chunk:
+            chunk = data[pos:pos + 65536]
+            if not chunk:
+                raise ValueError('truncated pack object')
+            pos += len(chunk)
+        output = decompressor.decompress(chunk, 65536)
+        if sha is not None:
+            sha.update(output)
+    return pos - len(decompressor.unused_data)
+
+def index_pack(path, jobs=None):
+    """Build the version 2 .idx file for the pack file at given path (the
+    .idx path is derived by replacing the .pack extension), and return
+    the pack's binary trailer SHA-1.
+
+    The pack is memory-mapped and read in one pass to find each object's
+    offset, CRC-32 and (for whole objects) hash, which is computed as the
+    object is inflated. Deltas are then resolved per tree of objects
+    based on one whole object, with the trees spread over 'jobs' worker
+    threads (one per CPU by default; zlib and hashlib release the GIL).
+    Each delta is applied to its base as the tree is walked depth first,
+    so only the objects along one delta chain are held in memory."""
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with data:
+        signature, version, num_objects = struct.unpack('!4sLL', data[:12])
+        assert signature == b'PACK', \
+            'invalid pack signature {}'.format(signature)
+        assert version == 2, 'unknown pack version {}'.format(version)
+        with memoryview(data) as view:
+            pack_sha1 = hashlib.sha1(view[:-20]).digest()
+        assert pack_sha1 == data[-20:], 'pack checksum mismatch'
+
+        sha1s = {}
+        crcs = {}
+        types = {}
+        children = collections.defaultdict(list)
+        offset = 12
+        with trace_region('index_pack', 'scan',
+                          msg='{} objects'.format(num_objects)):
+            for _ in range(num_objects):
+                type_num, size, pos = read_pack_header(data, offset)
+                if type_num == ObjectType.ofs_delta.value:
+                    distance, pos = read_ofs_distance(data, pos)
+                    children[offset - distance].append(offset)
+                    end = inflate_pack_entry(data, pos)
+                elif type_num == ObjectType.ref_delta.value:
+                    children[data[pos:pos + 20].hex()].append(offset)
+                    end = inflate_pack_entry(data, pos + 20)
+                else:
+                    obj_type = ObjectType(type_num).name
+                    sha = hashlib.sha1('{} {}\x00'.format(obj_type, size)
+                                       .encode())
+                    end = inflate_pack_entry(data, pos, sha)
+                    sha1s[offset] = sha.hexdigest()
+                    types[offset] = obj_type
+                crcs[offset] = zlib.crc32(data[offset:end])
+                offset = end
+        assert offset == len(data) - 20, \
+            'expected pack data to end at {}, ends at {}'.format(
+                len(data) - 20, offset)
+
+        def read_entry(offset):
+            #Return inflated data (or delta) of pack entry at given offset
+            type_num, size, pos = read_pack_header(data, offset)
+            if type_num == ObjectType.ofs_delta.value:
+                _, pos = read_ofs_distance(data, pos)
+            elif type_num == ObjectType.ref_delta.value:
+                pos += 20
+            return inflate_at(data, pos, size)
+
+        def resolve_deltas(root):
+            #Resolve all deltas based (directly or not) on object at root,
+            #return list of (offset, sha1) of the objects they produce
+            resolved = []
+            obj_type = types[root]
+            stack = [(root, sha1s[root], None)]
+            while stack:
+                offset, sha1, base = stack.pop()
+                obj_data = read_entry(offset)
+                if base is not None:
+                    obj_data = apply_delta(base, obj_data)
+                    sha1 = hashlib.sha1('{} {}\x00'.format(
+                            obj_type, len(obj_data)).encode() +
+                            obj_data).hexdigest()
+                    resolved.append((offset, sha1))
+                for child in children.get(offset, []) + \
+                        children.get(sha1, []):
+                    stack.append((child, None, obj_data))
+            return resolved
+
+        roots = [offset for offset, sha1 in sha1s.items()
+                 if offset in children or sha1 in children]
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        with trace_region('index_pack', 'resolve_deltas',
+                          msg='{} bases'.format(len(roots))):
+            if jobs <= 1 or len(roots) <= 1:
+                results = map(resolve_deltas, roots)
+                for resolved in results:
+                    sha1s.update(resolved)
+            else:
+                import concurrent.futures
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=jobs) as executor:
+                    for resolved in executor.map(resolve_deltas, roots):
+                        sha1s.update(resolved)
+    if len(sha1s) != num_objects:
+        raise ValueError('{} deltas have bases missing from the pack'.format(
+                num_objects - len(sha1s)))
+    write_pack_index(path[:-len('.pack')] + '.idx',
+                     [(sha1s[o], crcs[o], o) for o in sha1s], pack_sha1)
+    return pack_sha1
+
+def receive_pack(lines, jobs=None):
+    """Write pack data received as side-band pkt-lines (see iter_side_band)
+    to the object store, chunk by chunk, index it (see index_pack) and
+    return its path without extension, or None if it has no objects."""
+    pack_dir = os.path.join('.git', 'objects', 'pack')
+    os.makedirs(pack_dir, exist_ok=True)
+    import tempfile
+    fd, temp_path = tempfile.mkstemp(dir=pack_dir, suffix='.pack')
+    try:
+        with os.fdopen(fd, 'wb') as f, \
+                trace_region('fetch', 'receive_pack'):
+            for chunk in iter_side_band(lines):
+                trace_count('fetch/bytes_received', len(chunk))
+                f.write(chunk)
+        with open(temp_path, 'rb') as f:
+            header = f.read(12)
+        num_objects = struct.unpack('!L', header[8:])[0] \
+                if len(header) == 12 else 0
+        if not num_objects:
+            os.remove(temp_path)
+            return None
+        pack_sha1 = index_pack(temp_path, jobs=jobs)
+    except BaseException:
+        for leftover in (temp_path, temp_path[:-len('.pack')] + '.idx'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    path = os.path.join(pack_dir, 'pack-' + pack_sha1.hex())
+    #The .idx goes last, as it makes the pack visible to readers
+    os.replace(temp_path, path + '.pack')
+    os.replace(temp_path[:-len('.pack')] + '.idx', path + '.idx')
+    return path
+
+def fetch(git_url, username=None, password=None, jobs=None, max_haves=256):
+    """Fetch branches from given git repo URL into refs/remotes/origin/
+    using git-upload-pack over smart HTTP, and return dict mapping each
+    remote branch name (like 'refs/heads/main') to its commit hash.
+
+    All remote branches whose commits aren't local yet are wanted, and the
+    newest max_haves local commits are offered as common ground in one
+    round. The pack the server sends is streamed straight into the object
+    store and indexed (see receive_pack), never exploded into loose
+    objects."""
+    if username is None:
+        username = os.environ.get("GIT_USERNAME")
+    if password is None:
+        password = os.environ.get("GIT_PASSWORD")
+    with trace_region('fetch', 'refs', msg=git_url):
+        refs, capabilities = get_remote_refs(git_url, username, password,
+                                             service='git-upload-pack')
+    branches = {name: sha1 for name, sha1 in refs.items()
+                if name.startswith('refs/heads/')}
+
+    def have_object(sha1):
+        try:
+            find_object(sha1)
+        except ValueError:
+            return False
+        return True
+
+    wants = sorted({sha1 for sha1 in branches.values()
+                    if not have_object(sha1)})
+    if wants:
+        if 'side-band-64k' in capabilities:
+            side_band = 'side-band-64k'
+        elif 'side-band' in capabilities:
+            side_band = 'side-band'
+        else:
+            raise ValueError('remote does not support side-band')
+        want_capabilities = [side_band] + [
+                c for c in ('ofs-delta',) if c in capabilities]
+        want_lines = ['want {}'.format(sha1).encode() for sha1 in wants]
+        want_lines[0] += b' ' + ' '.join(want_capabilities).encode()
+        local_tips = set(get_local_refs().values())
+        remotes_dir = os.path.join('.git', 'refs', 'remotes', 'origin')
+        for root, dirs, files in os.walk(remotes_dir):
+            for name in files:
+                local_tips.add(read_file(os.path.join(root, name))
+                               .decode().strip())
+        haves = itertools.islice(iter_commits(sorted(local_tips)),
+                                 max_haves)
+        request = build_lines_data(want_lines) + b''.join(
+                encode_pkt_line('have {}'.format(sha1).encode())
+                for sha1 in haves) + encode_pkt_line(b'done')
+        with trace_region('fetch', 'negotiate'):
+            response = http_open(
+                    git_url + '/git-upload-pack', username, password,
+                    data=request,
+                    content_type='application/x-git-upload-pack-request')
+            lines = read_pkt_lines(response.read)
+            #ACK or NAK lines come first, then the multiplexed pack
+            for line in lines:
+                if line is PktLine.flush or \
+                        not line.startswith((b'ACK', b'NAK')):
+                    break
+        path = receive_pack(itertools.chain([line], lines), jobs=jobs)
+        response.read()
+        if path:
+            print('received pack {}'.format(os.path.basename(path)))
+
+    remotes_dir = os.path.join('.git', 'refs', 'remotes', 'origin')
+    for name, sha1 in sorted(branches.items()):
+        ref_path = os.path.join(remotes_dir, name[len('refs/heads/'):])
+        try:
+            old_sha1 = read_file(ref_path).decode().strip()
+        except FileNotFoundError:
+            old_sha1 = None
+        if old_sha1 != sha1:
+            os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+            write_file(ref_path, (sha1 + '\n').encode())
+            print('{} -> origin/{}: {}'.format(
+                    name, name[len('refs/heads/'):],
+                    '{}..{}'.format(shortest_unique_prefix(old_sha1),
+                                    shortest_unique_prefix(sha1))
+                    if old_sha1 else 'new branch'))
+    return branches
+
+def verify_tree_entry_name(name):
+    """Raise ValueError if given tree entry name isn't safe to check out,
+    like git's verify_path: it must not be empty, '.', '..' or '.git' (in
+    any case, as the file system may not care), or contain a slash or NUL,
+    so a tree from a remote can't write outside the working copy or into
+    .git (for example a config setting core.fsmonitor to run a command)."""
+    if (name in ('', '.', '..') or name.lower() == '.git' or
+            '/' in name or '\x00' in name):
+        raise ValueError('invalid path {!r} in tree'.format(name))
+
+def checkout_tree(tree_sha1):
+    """Write the files of given tree to the working copy (streaming each
+    blob to disk) and make the index match it. Every entry name is checked
+    first (see verify_tree_entry_name), so nothing is written if any of
+    them is invalid or appears twice in a tree."""
+    files = []
+    stack = [(tree_sha1, '')]
+    while stack:
+        sha1, prefix = stack.pop()
+        names = set()
+        for mode, name, entry_sha1 in read_tree_entries(sha1):
+            verify_tree_entry_name(name)
+            if name in names:
+                raise ValueError('duplicate path {!r} in tree'.format(
+                        prefix + name))
+            names.add(name)
+            if stat.S_ISDIR(mode):
+                stack.append((entry_sha1, prefix + name + '/'))
+            else:
+                files.append((mode, prefix + name, entry_sha1))
+
+    entries = []
+    for mode, path, entry_sha1 in files:
+        if mode == 0o160000:
+            #Submodule commit, there's nothing to check out here
+            os.makedirs(path, exist_ok=True)
+            continue
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        obj_type, _, chunks = iter_object(entry_sha1)
+        assert obj_type == 'blob'
+        if stat.S_ISLNK(mode):
+            os.symlink(b''.join(chunks), path)
+        else:
+            with open(path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            if mode == 0o100755:
+                os.chmod(path, 0o755)
+        entries.append(index_entry_from_stat(
+                path, os.lstat(path), bytes.fromhex(entry_sha1)))
+    entries.sort(key=lambda e: e.path.encode())
+    write_index(entries)
+
+def clone(git_url, repo, username=None, password=None, jobs=None):
+    """Clone git repo at given URL into new directory repo: fetch its
+    branches and check out its main branch."""
+    init(repo)
+    os.chdir(repo)
+    branches = fetch(git_url, username=username, password=password,
+                     jobs=jobs)
+    main_sha1 = branches.get('refs/heads/main')
+    if main_sha1 is None:
+        print('remote has no main branch, nothing checked out')
+        return
+    write_file(os.path.join('.git', 'refs', 'heads', 'main'),
+               (main_sha1 + '\n').encode())
+    checkout_tree(commit_info(main_sha1).tree)
+    print('checked out main at {}'.format(main_sha1))
+
+class DaemonOutput(io.RawIOBase):
+
+    #Raw stream sending what is written to it to the daemon's client as
+    #frames of given kind (FRAME_STDOUT or FRAME_STDERR)
+    def __init__(self, sock, kind):
+        self.sock = sock
+        self.kind = kind
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        send_frame(self.sock, self.kind, bytes(data))
+        return len(data)
+
+
+class DaemonInput(io.RawIOBase):
+
+    #Raw stream reading the daemon's client's stdin, a frame per read
+    def __init__(self, sock, reader):
+        self.sock = sock
+        self.reader = reader
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        send_frame(self.sock, FRAME_READ, struct.pack('!L', len(buffer)))
+        kind, data = recv_frame(self.reader)
+        assert kind == FRAME_STDIN, 'expected stdin frame, got {}'.format(
+                kind)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def serve_daemon_client(sock, reader, request):
+    """Run command request (the decoded command frame) sent by a client on
+    given connected socket (read through reader) in this process, with
+    stdin, stdout, stderr, environment and current directory switched to
+    the client's, then send back the exit code."""
+    import traceback
+    saved_streams = (sys.stdin, sys.stdout, sys.stderr)
+    saved_environ = dict(os.environ)
+    saved_cwd = os.getcwd()
+    sys.stdin = io.TextIOWrapper(io.BufferedReader(
+            DaemonInput(sock, reader)), encoding='utf-8')
+    sys.stdout = io.TextIOWrapper(io.BufferedWriter(
+            DaemonOutput(sock, FRAME_STDOUT)), encoding='utf-8')
+    sys.stderr = io.TextIOWrapper(io.BufferedWriter(
+            DaemonOutput(sock, FRAME_STDERR)), encoding='utf-8',
+            line_buffering=True)
+    os.environ.clear()
+    os.environ.update(request['env'])
+    #Other processes may have added loose objects since the last command;
+    #the index, packs and commit-graph are checked for changes when read
+    forget_loose_objects()
+    code = 0
+    try:
+        os.chdir(request['cwd'])
+        main(request['argv'])
+    except SystemExit as error:
+        code = error.code if isinstance(error.code, int) else \
+                int(error.code is not None)
+    except Exception:
+        code = 1
+        try:
+            traceback.print_exc()
+        except OSError:
+            pass
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except OSError:
+            pass
+        sys.stdin, sys.stdout, sys.stderr = saved_streams
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        os.chdir(saved_cwd)
+    send_frame(sock, FRAME_EXIT, struct.pack('!l', code))
+
+def run_daemon():
+    """Serve mygit commands forwarded by clients (see run_daemon_client)
+    over a Unix socket in .git until stopped by 'daemon --stop', SIGTERM or
+    Ctrl-C. Commands run in this process, so the parsed index, the commit
+    and tree caches, the pack and commit-graph mmaps and the loaded code
+    stay resident between them.
+
+    Commands switch the process's stdio, environment and directory, so
+    only one runs at a time. A client that connects while one is running
+    is told to run its command itself instead of waiting, as it may be
+    what feeds the running command's stdin (as in 'mygit ls-files -s |
+    ... | mygit cat-file --batch')."""
+    import signal, socket
+    if os.path.exists(DAEMON_SOCKET):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(DAEMON_SOCKET)
+        except OSError:
+            #Left behind by a daemon that was killed
+            os.remove(DAEMON_SOCKET)
+        else:
+            raise ValueError('a daemon is already running')
+        finally:
+            probe.close()
+    socket_path = os.path.abspath(DAEMON_SOCKET)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    #Commands run with the daemon's rights, so only its user may connect;
+    #the umask keeps the socket private from the moment it's created
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(DAEMON_SOCKET)
+    finally:
+        os.umask(old_umask)
+    os.chmod(DAEMON_SOCKET, 0o600)
+    server.listen()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('daemon listening on {}'.format(DAEMON_SOCKET))
+    sys.stdout.flush()
+    busy = threading.Lock()
+
+    def serve(sock, reader, request):
+        try:
+            serve_daemon_client(sock, reader, request)
+        except (OSError, EOFError):
+            #Client went away mid-command
+            pass
+        finally:
+            reader.close()
+            sock.close()
+            busy.release()
+
+    try:
+        while True:
+            sock, _ = server.accept()
+            reader = sock.makefile('rb')
+            handed_over = False
+            try:
+                if not peer_is_same_user(sock):
+                    continue
+                kind, data = recv_frame(reader)
+                if kind != FRAME_COMMAND:
+                    continue
+                request = decode_command(data)
+                if request['argv'] == ['daemon', '--stop']:
+                    send_frame(sock, FRAME_EXIT, struct.pack('!l', 0))
+                    break
+                if busy.acquire(blocking=False):
+                    threading.Thread(target=serve,
+                                     args=(sock, reader, request)).start()
+                    handed_over = True
+                else:
+                    send_frame(sock, FRAME_BUSY)
+            except (OSError, EOFError, ValueError):
+                pass
+            finally:
+                if not handed_over:
+                    reader.close()
+                    sock.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(socket_path)
+        #Let a running command finish rather than cut it off mid-write
+        with busy:
+            pass
+
+#Commands (and aliases) build_parser knows
+COMMANDS = ('add', 'cat-file', 'clone', 'commit', 'commit-graph', 'daemon',
+            'diff', 'fetch', 'gc', 'hash-object', 'init', 'log', 'ls-files',
+            'push', 'repack', 'status', 'update-index')
+
+def build_parser(command=None):
+    """Return argparse parser for mygit's command line. If command is
+    given, only its sub-parser is built, as building all of them takes
+    longer than a quick command like ls-files."""
+    import argparse
     parser = argparse.ArgumentParser()
     sub_parsers = parser.add_subparsers(dest='command', metavar='command')
     sub_parsers.required = True
     
-    sub_parser = sub_parsers.add_parser('add',
-            help='add files(s) to index')
-    sub_parser.add_argument('paths', nargs='+', metavar='path',
-            help='path(s) of files to add')
-    
-    sub_parser = sub_parsers.add_parser('cat-file',
-            help='display contents of object')
-    valid_modes = ['commit', 'tree', 'blob', 'size', 'type', 'pretty']
-    sub_parser.add_argument('mode', choices=valid_modes,
-            help="object type (commit, tree, blob) or display mode (size, "
-            'type, pretty)')
-    sub_parser.add_argument('hash_prefix',
-            help="SHA-1 hash (or hash prefix) of object to display")
-    
-    sub_parser = sub_parsers.add_parser('commit',
-            help='commit current state of index to main branch')
-    sub_parser.add_argument('-a', '--author',
-            help='commit author in format "A U Thor <author@example.com"'
-            '(Uses GIT_AUTHOR_NAME and GIT_AUTHOR_EMAIL environment '
-            'variables by default)')
-    sub_parser.add_argument('-m', '--message', required=True,
-            help="text of commit message")
-    
-    sub_parser = sub_parsers.add_parser('diff',
-            help='show diff of files changed')
-    
-    sub_parser = sub_parsers.add_parser('hash-object',
-            help='hash contents of given path (and optionally write to'
-            'object store)')
-    sub_parser.add_argument('path',
-            help="path of file to hash")
-    sub_parser.add_argument('-t', choices=['commit', 'tree', 'blob'],
-            default='blob', dest='type',
-            help='type of object (default %(default)r)')
-    sub_parser.add_argument('-w', action='store_true', dest='write',
-            help='write object to object store (as well as printing hash)')
-    
-    sub_parser = sub_parsers.add_parser('init',
-            help='initializing a new repo')
-    sub_parser.add_argument('repo',
-            help="directory name for new repo")
-    
-    sub_parser = sub_parsers.add_parser('ls-files',
-            help='list files in index')
-    sub_parser.add_argument('-s', '--stage', action='store_true',
-            help='show object details(mode, hash, and stage number) in'
-            'addition to path')
-    
-    sub_parser = sub_parsers.add_parser('push',
-            help='push main branch to given git server URL')
-    sub_parser.add_argument('git_url',
-            help='URL of git repo, eg: https://github.com/jdav892/mygit.git')
-    sub_parser.add_argument('-p', '--password',
-            help='password to use for authentication (uses GIT_PASSWORD)'
-            'environment variable by default')
-    sub_parser.add_argument('-u', '--username',
-            help='username to use for authentication (uses GIT_USERNAME)'
-            'environment variable by default')
-    
-    sub_parser = sub_parsers.add_parser('status',
-            help='show status of working copy')
-    
-    args = parser.parse_args()
+    if command in (None, 'add'):
+        sub_parser = sub_parsers.add_parser('add',
+                help='add files(s) to index')
+        sub_parser.add_argument('paths', nargs='+', metavar='path',
+                help='path(s) of files to add')
+        sub_parser.add_argument('-j', '--jobs', type=int,
+                help='number of worker threads for hashing (default: number '
+                'of CPUs)')
+
+    if command in (None, 'cat-file'):
+        sub_parser = sub_parsers.add_parser('cat-file',
+                help='display contents of object')
+        valid_modes = ['commit', 'tree', 'blob', 'size', 'type', 'pretty']
+        sub_parser.add_argument('mode', choices=valid_modes, nargs='?',
+                help="object type (commit, tree, blob) or display mode (size, "
+                'type, pretty)')
+        sub_parser.add_argument('hash_prefix', nargs='?',
+                help="SHA-1 hash (or hash prefix) of object to display")
+        batch_group = sub_parser.add_mutually_exclusive_group()
+        batch_group.add_argument('--batch', action='store_true',
+                help='print type, size and contents of each object named on '
+                'stdin')
+        batch_group.add_argument('--batch-check', action='store_true',
+                help='print type and size of each object named on stdin')
+
+    if command in (None, 'commit'):
+        sub_parser = sub_parsers.add_parser('commit',
+                help='commit current state of index to main branch')
+        sub_parser.add_argument('-a', '--author',
+                help='commit author in format "A U Thor <author@example.com"'
+                '(Uses GIT_AUTHOR_NAME and GIT_AUTHOR_EMAIL environment '
+                'variables by default)')
+        sub_parser.add_argument('-m', '--message', required=True,
+                help="text of commit message")
+
+    if command in (None, 'clone'):
+        sub_parser = sub_parsers.add_parser('clone',
+                help='clone git repo at given URL into a new directory')
+        sub_parser.add_argument('git_url',
+                help='URL of git repo, eg: '
+                'https://github.com/jdav892/mygit.git')
+        sub_parser.add_argument('repo',
+                help='directory to clone into')
+        sub_parser.add_argument('-p', '--password',
+                help='password to use for authentication (uses GIT_PASSWORD)'
+                'environment variable by default')
+        sub_parser.add_argument('-u', '--username',
+                help='username to use for authentication (uses GIT_USERNAME)'
+                'environment variable by default')
+        sub_parser.add_argument('-j', '--jobs', type=int,
+                help='number of worker threads for resolving deltas (default: '
+                'number of CPUs)')
+
+    if command in (None, 'commit-graph'):
+        sub_parser = sub_parsers.add_parser('commit-graph',
+                help='write commit-graph file for faster history traversal')
+        sub_parser.add_argument('action', choices=['write'],
+                help='action to perform (write)')
+
+    if command in (None, 'daemon'):
+        sub_parser = sub_parsers.add_parser('daemon',
+                help='serve commands from a resident process, so they start '
+                'fast')
+        sub_parser.add_argument('--stop', action='store_true',
+                help='stop the daemon running in this repo')
+
+    if command in (None, 'diff'):
+        sub_parser = sub_parsers.add_parser('diff',
+                help='show diff of files changed')
+        sub_parser.add_argument('--stat', action='store_true',
+                help='only show number of lines changed per file')
+        sub_parser.add_argument('-M', '--find-renames', action='store_true',
+                help='show deleted files similar to new ones as renames')
+        sub_parser.add_argument('-j', '--jobs', type=int,
+                help='number of worker threads for hashing and processes for '
+                'diffing (default: number of CPUs)')
+
+    if command in (None, 'fetch'):
+        sub_parser = sub_parsers.add_parser('fetch',
+                help='fetch branches from given git server URL')
+        sub_parser.add_argument('git_url',
+                help='URL of git repo, eg: '
+                'https://github.com/jdav892/mygit.git')
+        sub_parser.add_argument('-p', '--password',
+                help='password to use for authentication (uses GIT_PASSWORD)'
+                'environment variable by default')
+        sub_parser.add_argument('-u', '--username',
+                help='username to use for authentication (uses GIT_USERNAME)'
+                'environment variable by default')
+        sub_parser.add_argument('-j', '--jobs', type=int,
+                help='number of worker threads for resolving deltas (default: '
+                'number of CPUs)')
+
+    if command in (None, 'hash-object'):
+        sub_parser = sub_parsers.add_parser('hash-object',
+                help='hash contents of given path (and optionally write to'
+                'object store)')
+        sub_parser.add_argument('path',
+                help="path of file to hash")
+        sub_parser.add_argument('-t', choices=['commit', 'tree', 'blob'],
+                default='blob', dest='type',
+                help='type of object (default %(default)r)')
+        sub_parser.add_argument('-w', action='store_true', dest='write',
+                help='write object to object store (as well as printing hash)')
+
+    if command in (None, 'init'):
+        sub_parser = sub_parsers.add_parser('init',
+                help='initializing a new repo')
+        sub_parser.add_argument('repo',
+                help="directory name for new repo")
+
+    if command in (None, 'ls-files'):
+        sub_parser = sub_parsers.add_parser('ls-files',
+                help='list files in index')
+        sub_parser.add_argument('-s', '--stage', action='store_true',
+                help='show object details(mode, hash, and stage number) in'
+                'addition to path')
+
+    if command in (None, 'log'):
+        sub_parser = sub_parsers.add_parser('log',
+                help='show commit history of local main branch')
+        sub_parser.add_argument('-n', '--max-count', type=int,
+                help='show at most this many commits')
+        sub_parser.add_argument('--oneline', action='store_true',
+                help='show only abbreviated hash and subject of each commit')
+        sub_parser.add_argument('paths', nargs='*', metavar='path',
+                help='only show commits changing these paths')
+
+    if command in (None, 'push'):
+        sub_parser = sub_parsers.add_parser('push',
+                help='push main branch to given git server URL')
+        sub_parser.add_argument('git_url',
+                help='URL of git repo, eg: '
+                'https://github.com/jdav892/mygit.git')
+        sub_parser.add_argument('-p', '--password',
+                help='password to use for authentication (uses GIT_PASSWORD)'
+                'environment variable by default')
+        sub_parser.add_argument('-u', '--username',
+                help='username to use for authentication (uses GIT_USERNAME)'
+                'environment variable by default')
+        sub_parser.add_argument('--window', type=int, default=10,
+                help='number of objects to consider as delta bases (default '
+                '%(default)r)')
+        sub_parser.add_argument('--depth', type=int, default=50,
+                help='maximum delta chain length (default %(default)r)')
+
+    if command in (None, 'repack', 'gc'):
+        sub_parser = sub_parsers.add_parser('repack', aliases=['gc'],
+                help='pack loose objects into a delta-compressed pack')
+        sub_parser.add_argument('--window', type=int, default=10,
+                help='number of objects to consider as delta bases (default '
+                '%(default)r)')
+        sub_parser.add_argument('--depth', type=int, default=50,
+                help='maximum delta chain length (default %(default)r)')
+
+    if command in (None, 'update-index'):
+        sub_parser = sub_parsers.add_parser('update-index',
+                help='change the format of the index')
+        sub_parser.add_argument('--index-version', type=int, required=True,
+                choices=[2, 3, 4], dest='version',
+                help='index format version to write (4 compresses paths)')
+
+    if command in (None, 'status'):
+        sub_parser = sub_parsers.add_parser('status',
+                help='show status of working copy')
+        sub_parser.add_argument('-j', '--jobs', type=int,
+                help='number of worker threads for hashing (default: number '
+                'of CPUs)')
+    return parser
+
+def main(argv=None):
+    #Run mygit command line given as list of arguments (sys.argv[1:])
+    if argv is None:
+        argv = sys.argv[1:]
+    command = next((a for a in argv if not a.startswith('-')), None)
+    parser = build_parser(command if command in COMMANDS else None)
+    args = parser.parse_args(argv)
     
-    if args.command == 'add':
-        add(args.path)
-    elif args.command == 'cat-file':
+    if args.command == 'daemon':
+        if args.stop:
+            #A running daemon would have been sent the command instead
+            print('no daemon running', file=sys.stderr)
+            sys.exit(1)
         try:
-            cat_file(args.mode, args.hash_prefix)
-        
+            run_daemon()
         except ValueError as error:
             print(error, file=sys.stderr)
             sys.exit(1)
+        return
+    with trace_command([sys.argv[0]] + argv, args.command):
+        if args.command == 'add':
+            add(args.paths, jobs=args.jobs)
+        elif args.command == 'cat-file':
+            if args.batch or args.batch_check:
+                if args.mode or args.hash_prefix:
+                    parser.error('--batch and --batch-check read object '
+                                 'names from stdin')
+                cat_file_batch(contents=args.batch)
+                sys.exit(0)
+            if not args.hash_prefix:
+                parser.error('cat-file needs a mode and a hash prefix')
+            try:
+                cat_file(args.mode, args.hash_prefix)
+        
+            except ValueError as error:
+                print(error, file=sys.stderr)
+                sys.exit(1)
             
-    elif args.command == 'commit':
-        commit(args.message, author=args.author)
-    elif args.command == 'diff':
-        diff()
-    elif args.command == 'hash-object':
-        sha1 = hash_objects(read_file(args.path), args.type, write=args.write)
-        print(sha1)
-    elif args.command == 'init':
-        init(args.repo)
-    elif args.command == 'ls-files':
-        ls_files(details=args.stage)
-    elif args.command == 'push':
-        push(args.git_url, username=args.username, password=args.password)
-    elif args.command == 'status':
-        status()
-    else:
-        assert False, 'unexpected command {!r}'.format(args.command)
-             
\ No newline at end of file
+        elif args.command == 'commit':
+            commit(args.message, author=args.author)
+        elif args.command == 'clone':
+            clone(args.git_url, args.repo, username=args.username,
+                  password=args.password, jobs=args.jobs)
+        elif args.command == 'commit-graph':
+            num_commits = write_commit_graph()
+            print('wrote commit-graph with {} commit{}'.format(
+                    num_commits, '' if num_commits == 1 else 's'))
+        elif args.command == 'diff':
+            diff(stat_only=args.stat, renames=args.find_renames,
+                 jobs=args.jobs)
+        elif args.command == 'fetch':
+            fetch(args.git_url, username=args.username, password=args.password,
+                  jobs=args.jobs)
+        elif args.command == 'hash-object':
+            sha1 = hash_object_file(args.path, args.type, write=args.write)
+            print(sha1)
+        elif args.command == 'init':
+            init(args.repo)
+        elif args.command == 'ls-files':
+            ls_files(details=args.stage)
+        elif args.command == 'log':
+            log(max_count=args.max_count, paths=args.paths,
+                oneline=args.oneline)
+        elif args.command == 'push':
+            push(args.git_url, username=args.username, password=args.password,
+                 window=args.window, depth=args.depth)
+        elif args.command in ('repack', 'gc'):
+            repack(window=args.window, depth=args.depth)
+        elif args.command == 'update-index':
+            update_index_version(args.version)
+        elif args.command == 'status':
+            status(jobs=args.jobs)
+        else:
+            assert False, 'unexpected command {!r}'.format(args.command)
+
+
+if __name__ == "__main__":
+    #Hand the command to the daemon if one is running (mygit_client.py
+    #does the same without loading this module first)
+    code = run_daemon_client(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+    main()
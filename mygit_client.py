@@ -0,0 +1,130 @@
+"""Thin entry point for mygit: forwards the command line to the daemon
+running in the current repo (see mygit.run_daemon) without loading mygit
+at all, and only imports mygit (from its cached bytecode) to run the
+command itself if there is no daemon. Run it in place of mygit.py when
+startup time matters:
+
+    python mygit_client.py status
+
+mygit.py imports the frame helpers below from here, so this file has to
+stay next to it, and should keep importing nothing that isn't needed to
+talk to the daemon.
+"""
+import os, struct, sys
+
+
+#Unix socket a daemon listens on (relative to the repo root), and the
+#kinds of frame sent over it: a command (see encode_command) and
+#stdin data from the client; stdout and stderr data, a request for up to
+#n bytes of stdin, the exit code, and a refusal because another command
+#is running, from the daemon
+DAEMON_SOCKET = os.path.join('.git', 'mygit-daemon.sock')
+FRAME_COMMAND = b'c'
+FRAME_STDIN = b'i'
+FRAME_STDOUT = b'1'
+FRAME_STDERR = b'2'
+FRAME_READ = b'r'
+FRAME_EXIT = b'x'
+FRAME_BUSY = b'b'
+
+def send_frame(sock, kind, data=b''):
+    #Send frame of given kind: kind byte, 4-byte data length, then data
+    sock.sendall(struct.pack('!cL', kind, len(data)))
+    if data:
+        sock.sendall(data)
+
+def recv_frame(reader):
+    """Read one frame (see send_frame) from given binary file object and
+    return tuple of (kind, data). Raise EOFError if the other end closed
+    the connection."""
+    header = reader.read(5)
+    if len(header) < 5:
+        raise EOFError('connection closed')
+    kind, size = struct.unpack('!cL', header)
+    data = reader.read(size)
+    if len(data) < size:
+        raise EOFError('connection closed')
+    return (kind, data)
+
+def encode_command(argv, cwd, env):
+    """Encode command line argv to run in directory cwd with environment
+    env (a dict) as data of a command frame: NUL-separated cwd, number of
+    arguments, the arguments and NAME=value pairs. (JSON would do, but
+    importing json takes longer than the rest of the client.)"""
+    fields = [cwd, str(len(argv))] + argv + [
+            '{}={}'.format(name, value) for name, value in env.items()]
+    return b'\x00'.join(os.fsencode(field) for field in fields)
+
+def decode_command(data):
+    #Decode data of a command frame, return dict with argv, cwd and env
+    fields = [os.fsdecode(field) for field in data.split(b'\x00')]
+    num_args = int(fields[1])
+    env = dict(field.split('=', 1) for field in fields[2 + num_args:])
+    return dict(argv=fields[2:2 + num_args], cwd=fields[0], env=env)
+
+def peer_is_same_user(sock):
+    """Return True if the process at the other end of given connected Unix
+    socket runs as the same user as this one. Where the platform can't
+    tell (no SO_PEERCRED), rely on the socket being only accessible to
+    its owner and return True."""
+    import socket
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return True
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                  struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', credentials)
+    return uid == os.getuid()
+
+def run_daemon_client(argv):
+    """Forward command line argv to the daemon running in this repo, if
+    there is one, copying its output to stdout and stderr and answering
+    its reads from stdin. Return the command's exit code, or None if the
+    command should run locally instead: no daemon is running (or it's
+    another user's, or MYGIT_NO_DAEMON is set), it is busy, or the command
+    is 'daemon' itself (but 'daemon --stop' is forwarded)."""
+    if argv[:1] == ['daemon'] and '--stop' not in argv[1:]:
+        return None
+    if not os.path.exists(DAEMON_SOCKET) or os.environ.get('MYGIT_NO_DAEMON'):
+        return None
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(DAEMON_SOCKET)
+    except OSError:
+        sock.close()
+        return None
+    #The command carries the environment, which may hold credentials
+    if not peer_is_same_user(sock):
+        sock.close()
+        return None
+    with sock, sock.makefile('rb') as reader:
+        send_frame(sock, FRAME_COMMAND, encode_command(
+                argv, os.getcwd(), dict(os.environ)))
+        while True:
+            try:
+                kind, data = recv_frame(reader)
+            except EOFError:
+                print('daemon closed connection', file=sys.stderr)
+                return 1
+            if kind == FRAME_STDOUT:
+                sys.stdout.buffer.write(data)
+                sys.stdout.flush()
+            elif kind == FRAME_STDERR:
+                sys.stderr.buffer.write(data)
+                sys.stderr.flush()
+            elif kind == FRAME_READ:
+                size, = struct.unpack('!L', data)
+                send_frame(sock, FRAME_STDIN,
+                           os.read(sys.stdin.fileno(), size))
+            elif kind == FRAME_EXIT:
+                return struct.unpack('!l', data)[0]
+            elif kind == FRAME_BUSY:
+                return None
+
+
+if __name__ == '__main__':
+    code = run_daemon_client(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+    import mygit
+    mygit.main()
@@ -0,0 +1,737 @@
+"""Tests for mygit, run against repositories made by real git (tests that
+need git are skipped if it isn't installed). Run with:
+
+    python -m unittest discover tests
+"""
+import contextlib, http.server, io, os, random, shutil, subprocess, sys
+import socket, tempfile, threading, unittest, urllib.parse
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+import mygit, mygit_client
+
+
+WORDS = 'alpha beta gamma delta epsilon zeta eta theta iota kappa'.split()
+
+def git(*args, input=None):
+    #Run git command in the current directory and return its stdout
+    return subprocess.run(['git', '-c', 'user.name=Test',
+                           '-c', 'user.email=test@example.com'] + list(args),
+                          input=input, stdout=subprocess.PIPE, check=True
+                          ).stdout
+
+def reset_caches():
+    #Forget everything mygit caches per repo, as the tests switch repos
+    mygit._packs = (None, [])
+    mygit._commit_graph = (None, None)
+    mygit._index = (None, None)
+    mygit.forget_loose_objects()
+    mygit.parse_commit.cache_clear()
+    mygit.read_tree_entries.cache_clear()
+    for connection in mygit._http_connections.values():
+        connection.close()
+    mygit._http_connections.clear()
+    mygit._http_redirects.clear()
+
+
+@unittest.skipUnless(shutil.which('git'), 'git not installed')
+class RepoTestCase(unittest.TestCase):
+
+    #Runs each test in a new empty git repo (on branch main) as the
+    #current directory
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp(prefix='mygit-test-')
+        self.repo = os.path.join(self.temp_dir, 'repo')
+        os.mkdir(self.repo)
+        os.chdir(self.repo)
+        git('init', '-q', '-b', 'main')
+        reset_caches()
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.temp_dir)
+        reset_caches()
+
+    def commit_history(self, commits=20, lines=300, seed=0):
+        """Commit a few files with git, changing some lines of them in each
+        of commits commits, so that a repack finds many deltas."""
+        rng = random.Random(seed)
+        files = {'file{}.txt'.format(i): [
+                ' '.join(rng.choice(WORDS) for _ in range(8))
+                for _ in range(lines)] for i in range(3)}
+        for n in range(commits):
+            for path, file_lines in files.items():
+                for _ in range(5):
+                    file_lines[rng.randrange(lines)] = ' '.join(
+                            rng.choice(WORDS) for _ in range(8))
+                mygit.write_file(path, '\n'.join(file_lines).encode())
+            git('add', '.')
+            git('commit', '-q', '-m', 'commit {}'.format(n))
+
+    def merge_history(self, commits=40, seed=0):
+        """Commit a random history with branches and merges on main, a
+        minute apart. Each branch changes files in its own directory, so
+        merges don't conflict, and main changes files in main/."""
+        rng = random.Random(seed)
+        branches = ['main']
+        unmerged = []
+        current = 'main'
+        for n in range(commits):
+            date = '{} +0100'.format(1700000000 + 60 * n)
+            with mock.patch.dict(os.environ, GIT_AUTHOR_DATE=date,
+                                 GIT_COMMITTER_DATE=date):
+                action = rng.random()
+                if n and action < 0.15:
+                    current = 'topic{}'.format(n)
+                    git('checkout', '-q', '-b', current, 'main')
+                    branches.append(current)
+                    continue
+                if unmerged and action < 0.35:
+                    branch = unmerged.pop(rng.randrange(len(unmerged)))
+                    git('checkout', '-q', 'main')
+                    git('merge', '-q', '--no-ff', '-m',
+                        'Merge {}\n\nmerge {}'.format(branch, n), branch)
+                    current = 'main'
+                    continue
+                if n and action < 0.5:
+                    current = rng.choice(branches)
+                    git('checkout', '-q', current)
+                path = os.path.join(current, 'file{}.txt'.format(
+                        rng.randrange(3)))
+                os.makedirs(current, exist_ok=True)
+                with open(path, 'a') as f:
+                    f.write('line {}\n'.format(n))
+                git('add', path)
+                git('commit', '-q', '-m', 'Change {} in {}\n\nbody of '
+                    'commit {}'.format(path, current, n))
+                if current != 'main' and current not in unmerged:
+                    unmerged.append(current)
+        git('checkout', '-q', 'main')
+
+
+class PackInfoTests(RepoTestCase):
+
+    def test_object_info_of_git_deltas(self):
+        self.commit_history()
+        git('repack', '-q', '-a', '-d', '-f', '--window=50')
+        expected = git('cat-file', '--batch-all-objects',
+                       '--batch-check=%(objectname) %(objecttype) '
+                       '%(objectsize) %(deltabase)').decode().splitlines()
+        num_deltas = 0
+        for line in expected:
+            sha1, obj_type, size, delta_base = line.split()
+            num_deltas += delta_base != '0' * 40
+            self.assertEqual(mygit.read_object_info(sha1),
+                             (obj_type, int(size)), sha1)
+        self.assertGreater(num_deltas, 40)
+
+    def test_object_info_of_loose_objects(self):
+        self.commit_history(commits=2)
+        for line in git('cat-file', '--batch-all-objects',
+                        '--batch-check').decode().splitlines():
+            sha1, obj_type, size = line.split()
+            self.assertEqual(mygit.read_object_info(sha1),
+                             (obj_type, int(size)))
+
+
+class PackWriteTests(RepoTestCase):
+
+    def index_pack(self, data):
+        #Index pack data with git in a new bare repo, return its objects
+        bare = os.path.join(self.temp_dir, 'bare.git')
+        shutil.rmtree(bare, ignore_errors=True)
+        git('init', '-q', '--bare', bare)
+        git('-C', bare, 'index-pack', '--stdin', '--strict', input=data)
+        return set(git('-C', bare, 'cat-file', '--batch-all-objects',
+                       '--batch-check=%(objectname)').decode().split())
+
+    def pack_types(self, data):
+        #Return set of pack entry type numbers in pack data
+        pack_path = os.path.join(self.temp_dir, 'test.pack')
+        mygit.write_file(pack_path, data)
+        mygit.index_pack(pack_path)
+        pack = mygit.open_pack(pack_path[:-len('.pack')])
+        return {mygit.read_pack_header(pack.data, mygit.pack_offset(
+                pack, i))[0] for i in range(pack.fanout[255])}
+
+    def test_pack_with_ofs_and_ref_deltas(self):
+        self.commit_history(commits=5)
+        objects = mygit.find_missing_objects(
+                git('rev-parse', 'HEAD').decode().strip(), None)
+        for ofs_delta, delta_type in [(True, mygit.ObjectType.ofs_delta),
+                                      (False, mygit.ObjectType.ref_delta)]:
+            data = b''.join(mygit.iter_pack(objects, ofs_delta=ofs_delta))
+            self.assertEqual(self.index_pack(data), objects)
+            types = self.pack_types(data)
+            self.assertIn(delta_type.value, types)
+            self.assertEqual(len(types & {mygit.ObjectType.ofs_delta.value,
+                                          mygit.ObjectType.ref_delta.value}),
+                             1)
+
+    def test_repack(self):
+        self.commit_history(commits=10)
+        objects = git('cat-file', '--batch-all-objects',
+                      '--batch-check=%(objectname)').split()
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            path = mygit.repack()
+        self.assertIn('packed {} objects'.format(len(objects)),
+                      output.getvalue())
+        counts = dict(line.split(': ') for line in git(
+                'count-objects', '-v').decode().splitlines())
+        self.assertEqual((counts['count'], counts['in-pack']),
+                         ('0', str(len(objects))))
+        git('fsck', '--strict', '--no-dangling')
+        verify = git('verify-pack', '-v', path + '.idx').decode()
+        self.assertIn('chain length = 1', verify)
+        self.assertEqual(git('cat-file', '--batch-all-objects',
+                             '--batch-check=%(objectname)').split(), objects)
+
+
+class FindObjectTests(RepoTestCase):
+
+    def test_invalid_object_names(self):
+        self.commit_history(commits=2)
+        git('repack', '-a', '-d')
+        for name in ['zz', 'HEAD', '12345g', '0x1234', ' 1234', 'a' * 41]:
+            with self.assertRaisesRegex(ValueError, 'not a valid object'):
+                mygit.find_object(name)
+
+    def test_prefix_lookup(self):
+        self.commit_history(commits=2)
+        head = git('rev-parse', 'HEAD').decode().strip()
+        self.assertEqual(mygit.find_object(head[:7].upper())[0], head)
+        git('repack', '-a', '-d')
+        reset_caches()
+        self.assertEqual(mygit.find_object(head[:7])[0], head)
+
+
+class DiffTests(RepoTestCase):
+
+    def test_diff_like_git(self):
+        rng = random.Random(0)
+        mygit.write_file('text.txt', b''.join(
+                b'%d\n' % i for i in range(200)))
+        mygit.write_file('binary.dat', bytes(rng.randrange(256)
+                                             for _ in range(20000)))
+        mygit.write_file('gone.txt', b'bye\n')
+        git('add', '.')
+        git('commit', '-q', '-m', 'initial')
+        mygit.write_file('text.txt', b''.join(
+                b'%d\n' % (i * (i % 50 != 7)) for i in range(200)))
+        mygit.write_file('binary.dat', bytes(rng.randrange(256)
+                                             for _ in range(30000)))
+        os.remove('gone.txt')
+        for args in [[], ['--stat']]:
+            output = subprocess.run(
+                    [sys.executable, mygit.__file__, 'diff', '-j', '1'] +
+                    args, stdout=subprocess.PIPE, check=True,
+                    env=dict(os.environ, MYGIT_NO_DAEMON='1')).stdout
+            self.assertEqual(output, git('diff', *args))
+
+
+class WriteTreeTests(RepoTestCase):
+
+    def write_files(self, paths):
+        for path in paths:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            mygit.write_file(path, path.encode() + b'\n')
+
+    def test_nested_tree_like_git(self):
+        self.write_files(['top.txt', 'a/one.txt', 'a/b/two.txt',
+                          'a/b/c/three.txt', 'a-b.txt', 'a.txt', 'z/z.txt'])
+        os.chmod('a/b/two.txt', 0o755)
+        git('add', '.')
+        self.assertEqual(mygit.write_tree(),
+                         git('write-tree').decode().strip())
+
+    def test_cache_tree_reused_after_add(self):
+        self.write_files(['top.txt', 'a/b/two.txt', 'a/b/c/three.txt',
+                          'x/y.txt', 'x/z/w.txt'])
+        mygit.add(['top.txt', 'a/b/two.txt', 'a/b/c/three.txt', 'x/y.txt',
+                   'x/z/w.txt'])
+        mygit.write_tree()
+        mygit.write_file('a/b/two.txt', b'changed\n')
+        mygit.add(['a/b/two.txt'])
+        with mock.patch.object(mygit, 'hash_objects',
+                               wraps=mygit.hash_objects) as hash_objects:
+            sha1 = mygit.write_tree()
+        #Only the trees along the changed path are written again
+        self.assertEqual(hash_objects.call_count, 3)
+        self.assertEqual(sha1, git('write-tree').decode().strip())
+
+    def test_executable_only_by_owner_bit(self):
+        self.write_files(['group-x.sh', 'owner-x.sh'])
+        os.chmod('group-x.sh', 0o654)
+        os.chmod('owner-x.sh', 0o744)
+        mygit.add(['group-x.sh', 'owner-x.sh'])
+        self.assertEqual([line.split()[0] for line in
+                          git('ls-files', '-s').decode().splitlines()],
+                         ['100644', '100755'])
+        self.assertEqual(mygit.get_status(), ([], [], []))
+
+
+class IndexVersionTests(RepoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        #Paths sharing long prefixes, which version 4 compresses
+        for i in range(30):
+            path = 'src/module{}/sub/file{}.py'.format(i % 4, i)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            mygit.write_file(path, b'%d\n' % i)
+        git('add', '.')
+
+    def ls_files(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            mygit.ls_files(details=True)
+        return output.getvalue().encode()
+
+    def test_read_index_written_by_git(self):
+        expected = git('ls-files', '-s')
+        git('update-index', '--index-version', '4')
+        self.assertEqual(mygit.read_index_file().version, 4)
+        self.assertEqual(self.ls_files(), expected)
+
+    def test_round_trip_through_version_4(self):
+        expected = git('ls-files', '-s')
+        for version in [4, 3, 2, 4]:
+            mygit.update_index_version(version)
+            header = mygit.read_file(os.path.join('.git', 'index'))[:8]
+            self.assertEqual(header, b'DIRC' + bytes([0, 0, 0, version]))
+            self.assertEqual(git('ls-files', '-s'), expected)
+            self.assertEqual(self.ls_files(), expected)
+        self.assertEqual(git('status', '--porcelain').decode().count('A '),
+                         30)
+
+
+class HistoryTests(RepoTestCase):
+
+    def commits(self):
+        #Return dict mapping sha1 of every commit on any branch to tuple
+        #of (tree, parents, timestamp), as git reads them
+        infos = {}
+        for line in git('log', '--all', '--format=%H %T %ct %P'
+                        ).decode().splitlines():
+            sha1, tree, timestamp, *parents = line.split()
+            infos[sha1] = (tree, tuple(parents), int(timestamp))
+        return infos
+
+    def test_git_verifies_commit_graph(self):
+        self.merge_history()
+        self.assertEqual(mygit.write_commit_graph(), len(self.commits()))
+        git('commit-graph', 'verify')
+
+    def test_commit_info_from_git_commit_graph(self):
+        self.merge_history()
+        git('commit-graph', 'write', '--reachable')
+        reset_caches()
+        self.assertIsNotNone(mygit.get_commit_graph())
+        commits = self.commits()
+        self.assertGreater(sum(len(c[1]) == 2 for c in commits.values()), 2)
+        for sha1, (tree, parents, timestamp) in commits.items():
+            info = mygit.commit_info(sha1)
+            self.assertEqual((info.tree, info.parents, info.timestamp),
+                             (tree, parents, timestamp))
+            self.assertNotEqual(info.generation, mygit.GENERATION_INFINITY)
+
+    def test_missing_objects_like_rev_list(self):
+        def rev_list(*args):
+            return {line.split()[0] for line in git(
+                    'rev-list', '--objects', *args).decode().splitlines()}
+        for seed in range(3):
+            with self.subTest(seed=seed):
+                #A new repo per history
+                os.chdir(self.temp_dir)
+                os.mkdir('repo{}'.format(seed))
+                os.chdir('repo{}'.format(seed))
+                git('init', '-q', '-b', 'main')
+                reset_caches()
+                self.merge_history(commits=30, seed=seed)
+                if seed == 2:
+                    mygit.write_commit_graph()
+                branches = git('for-each-ref', '--format=%(refname)',
+                               'refs/heads').decode().split()
+                commits = git('rev-list', '--all').decode().split()
+                remotes = branches + commits[::4]
+                for local in branches:
+                    local_sha1 = git('rev-parse', local).decode().strip()
+                    local_objects = rev_list(local)
+                    for remote in remotes:
+                        remote_sha1 = git('rev-parse', remote
+                                          ).decode().strip()
+                        missing = mygit.find_missing_objects(local_sha1,
+                                                             remote_sha1)
+                        expected = local_objects - rev_list(remote)
+                        self.assertLessEqual(expected, missing)
+                        self.assertLessEqual(missing, local_objects)
+
+    def mygit_log(self, **kwargs):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            mygit.log(**kwargs)
+        return output.getvalue().encode()
+
+    def test_log_like_git(self):
+        self.merge_history()
+        self.assertEqual(self.mygit_log(), git('log'))
+        self.assertEqual(self.mygit_log(oneline=True, max_count=10),
+                         git('log', '--oneline', '-n', '10'))
+        for path in ['main', 'main/file1.txt', 'topic1', 'topic7/file2.txt',
+                     'no/such/path']:
+            self.assertEqual(self.mygit_log(paths=[path]),
+                             git('log', '--', path))
+            self.assertEqual(self.mygit_log(paths=[path], oneline=True),
+                             git('log', '--oneline', '--', path))
+
+    def test_log_with_commit_graph(self):
+        self.merge_history(seed=1)
+        mygit.write_commit_graph()
+        self.assertEqual(self.mygit_log(), git('log'))
+        self.assertEqual(self.mygit_log(paths=['main']),
+                         git('log', '--', 'main'))
+
+
+class HashObjectTests(RepoTestCase):
+
+    def test_file_changing_while_hashed(self):
+        mygit.write_file('grows.txt', b'x' * 100000)
+        real_fstat = os.fstat
+        def fstat_and_grow(fd):
+            #Another process appends right after the size was taken
+            st = real_fstat(fd)
+            with open('grows.txt', 'ab') as f:
+                f.write(b'y' * 100000)
+            return st
+        with mock.patch('os.fstat', fstat_and_grow):
+            with self.assertRaisesRegex(ValueError, 'changed while'):
+                mygit.hash_object_file('grows.txt')
+        #Neither the object nor its temp file is left behind
+        self.assertEqual(sorted(os.listdir(os.path.join('.git', 'objects'))),
+                         ['info', 'pack'])
+
+
+class StatusTests(RepoTestCase):
+
+    def test_symlink_unchanged_after_git_add(self):
+        mygit.write_file('target.txt', b'contents\n')
+        os.symlink('target.txt', 'link')
+        git('add', '.')
+        self.assertEqual(mygit.get_status(), ([], [], []))
+
+    def test_add_symlink_like_git(self):
+        mygit.write_file('target.txt', b'contents\n')
+        os.symlink('target.txt', 'link')
+        mygit.add(['target.txt', 'link'])
+        self.assertEqual(git('ls-files', '-s').decode(), (
+                '120000 {} 0\tlink\n100644 {} 0\ttarget.txt\n'.format(
+                git('hash-object', '--stdin', input=b'target.txt').decode()
+                .strip(),
+                git('hash-object', 'target.txt').decode().strip())))
+        self.assertEqual(git('diff', '--name-only').decode(), '')
+
+    def git_untracked(self):
+        #Return sorted list of untracked files as git status reports them
+        return sorted(line[3:] for line in git(
+                'status', '--porcelain', '-uall').decode().splitlines()
+                if line.startswith('?? '))
+
+    def test_new_files_with_nested_ignore_rules(self):
+        files = ['keep.txt', 'debug.log', 'important.log', 'build/out.o',
+                 'build/keep/out.o', 'docs/a.md', 'docs/draft/b.md',
+                 'docs/draft/c.txt', 'src/app.py', 'src/app.pyc',
+                 'src/gen/x.py', 'src/gen/x.py.bak', 'src/lib/y.py',
+                 'deep/a/b/c/skip.tmp', 'deep/a/b/c/keep.tmp', '.hidden']
+        for path in files:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            mygit.write_file(path, b'x\n')
+        mygit.write_file('.gitignore', b'*.log\n!important.log\n'
+                         b'/build/\n*.pyc\n# comment\n*.tmp\n')
+        mygit.write_file('docs/.gitignore', b'draft/*\n!draft/*.txt\n')
+        mygit.write_file('src/.gitignore', b'gen/\n*.bak\n')
+        mygit.write_file('deep/a/.gitignore', b'!**/keep.tmp\n')
+        mygit.write_file(os.path.join('.git', 'info', 'exclude'),
+                         b'.hidden\n')
+        git('add', 'keep.txt')
+        self.assertEqual(mygit.get_status()[1], self.git_untracked())
+        #Again from the untracked cache, after changes in one directory
+        mygit.write_file('docs/draft/d.txt', b'x\n')
+        mygit.write_file('src/more.pyc', b'x\n')
+        os.remove('docs/a.md')
+        self.assertEqual(mygit.get_status()[1], self.git_untracked())
+
+    def test_fsmonitor_hook(self):
+        for i in range(10):
+            mygit.write_file('f{}'.format(i), b'%d\n' % i)
+        git('add', '.')
+        #Fake hook that answers with the token and paths in files in .git
+        #and records how it was called
+        mygit.write_file('hook', b'#!/bin/sh\n'
+                         b'echo "$@" >> .git/hook-calls\n'
+                         b'printf "token-%s\\0" "$(cat .git/hook-token)"\n'
+                         b'cat .git/hook-reported\n')
+        os.chmod('hook', 0o755)
+        mygit.write_file(os.path.join('.git', 'info', 'exclude'), b'hook\n')
+        git('config', 'core.fsmonitor', os.path.abspath('hook'))
+        mygit.write_file(os.path.join('.git', 'hook-token'), b'1')
+        mygit.write_file(os.path.join('.git', 'hook-reported'), b'')
+        self.assertEqual(mygit.get_status(), ([], [], []))
+
+        mygit.write_file(os.path.join('.git', 'hook-token'), b'2')
+        mygit.write_file(os.path.join('.git', 'hook-reported'), b'f3\x00')
+        mygit.write_file('f3', b'changed\n')
+        real_lstat = os.lstat
+        stated = []
+        def lstat(path, *args, **kwargs):
+            stated.append(path)
+            return real_lstat(path, *args, **kwargs)
+        with mock.patch('os.lstat', lstat):
+            self.assertEqual(mygit.get_status(), (['f3'], [], []))
+        self.assertEqual({p for p in stated if p.startswith('f')}, {'f3'})
+
+        #git reads the FSMN extension: it asks the hook for changes since
+        #mygit's token, and only f3 is dirty (upper case)
+        self.assertEqual(git('ls-files', '-f').decode().splitlines(),
+                         ['h f{}'.format(i) if i != 3 else 'H f3'
+                          for i in range(10)])
+        self.assertEqual(mygit.read_file(os.path.join('.git', 'hook-calls')
+                                         ).decode().splitlines(),
+                         ['2 ', '2 token-1', '2 token-2'])
+
+    def test_add_same_path_twice(self):
+        mygit.write_file('a.txt', b'a\n')
+        mygit.add(['a.txt', 'a.txt'])
+        self.assertEqual(len(git('ls-files', '-s').splitlines()), 1)
+        mygit.add(['a.txt'])
+        self.assertEqual(len(git('ls-files', '-s').splitlines()), 1)
+
+    def test_index_written_through_lock_file(self):
+        mygit.write_file('a.txt', b'a\n')
+        mygit.add(['a.txt'])
+        self.assertFalse(os.path.exists(os.path.join('.git', 'index.lock')))
+        index = mygit.read_file(os.path.join('.git', 'index'))
+        #While another process holds the lock, add fails and status
+        #leaves the index alone
+        mygit.write_file(os.path.join('.git', 'index.lock'), b'')
+        mygit.write_file('b.txt', b'b\n')
+        with self.assertRaises(FileExistsError):
+            mygit.add(['b.txt'])
+        os.utime('a.txt', ns=(0, 0))
+        self.assertEqual(mygit.get_status(), ([], ['b.txt'], []))
+        self.assertEqual(mygit.read_file(os.path.join('.git', 'index')),
+                         index)
+
+
+class GitHTTPHandler(http.server.BaseHTTPRequestHandler):
+
+    #Serves the bare repos in server.root with git http-backend, over
+    #keep-alive connections. Requests under /moved/ are redirected to
+    #/repo.git/, and requests for any host are served, so that the server
+    #can stand in for a proxy too. If server.drop_idle is set, connections
+    #are closed after each response without telling the client, as if they
+    #had timed out.
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        self.server.requests.append((self.command, parts.netloc, parts.path))
+        if parts.path.startswith('/moved/'):
+            self.send_response(301)
+            self.send_header('Location', '/repo.git/' + parts.path[
+                    len('/moved/'):] + '?' + parts.query)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline(), 16)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                if not size:
+                    break
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length',
+                                                        0)))
+        output = subprocess.run(['git', 'http-backend'], input=body,
+                                stdout=subprocess.PIPE, check=True, env=dict(
+                os.environ, GIT_PROJECT_ROOT=self.server.root,
+                GIT_HTTP_EXPORT_ALL='1', REMOTE_USER='test',
+                REMOTE_ADDR='127.0.0.1', PATH_INFO=parts.path,
+                QUERY_STRING=parts.query, REQUEST_METHOD=self.command,
+                CONTENT_TYPE=self.headers.get('Content-Type', ''),
+                CONTENT_LENGTH=str(len(body)))).stdout
+        header, _, content = output.partition(b'\r\n\r\n')
+        headers = dict(line.decode().split(': ', 1)
+                       for line in header.split(b'\r\n'))
+        self.send_response(int(headers.pop('Status', '200').split()[0]))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        if self.server.drop_idle:
+            self.close_connection = True
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPTests(RepoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        git('init', '-q', '--bare', '-b', 'main',
+            os.path.join(self.temp_dir, 'repo.git'))
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                 GitHTTPHandler)
+        server.root = self.temp_dir
+        server.connections = 0
+        server.requests = []
+        server.drop_idle = False
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.server = server
+        self.base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    def remote_git(self, *args, input=None):
+        return git('--git-dir', os.path.join(self.temp_dir, 'repo.git'),
+                   *args, input=input).decode().strip()
+
+    def test_push_and_clone_over_few_connections(self):
+        url = self.base_url + '/repo.git'
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.commit_history(commits=3)
+            mygit.push(url)
+            self.commit_history(commits=3, seed=1)
+            mygit.push(url)
+            self.assertEqual(self.remote_git('rev-parse', 'main'),
+                             git('rev-parse', 'HEAD').decode().strip())
+            self.remote_git('fsck', '--strict')
+            mygit.clone(url, os.path.join(self.temp_dir, 'clone'))
+        self.assertEqual(git('rev-parse', 'HEAD').decode().strip(),
+                         self.remote_git('rev-parse', 'main'))
+        self.assertEqual(git('status', '--porcelain').decode(), '')
+        git('fsck', '--strict')
+        #Each push streams its pack over a new connection, which the next
+        #requests reuse
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(len(self.server.requests), 6)
+
+    def test_push_after_idle_connection_closed(self):
+        self.server.drop_idle = True
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.commit_history(commits=3)
+            mygit.push(self.base_url + '/repo.git')
+        self.assertEqual(self.remote_git('rev-parse', 'main'),
+                         git('rev-parse', 'HEAD').decode().strip())
+
+    def test_fetch_follows_redirect(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.commit_history(commits=3)
+            mygit.push(self.base_url + '/repo.git')
+            mygit.clone(self.base_url + '/moved',
+                        os.path.join(self.temp_dir, 'clone'))
+        self.assertEqual(git('rev-parse', 'HEAD').decode().strip(),
+                         self.remote_git('rev-parse', 'main'))
+        self.assertEqual([path for _, _, path in self.server.requests[2:]],
+                         ['/moved/info/refs', '/repo.git/info/refs',
+                          '/repo.git/git-upload-pack'])
+
+    def test_fetch_through_proxy(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.commit_history(commits=3)
+            mygit.push(self.base_url + '/repo.git')
+            with mock.patch.dict(os.environ, {'http_proxy': self.base_url,
+                                              'no_proxy': ''}):
+                os.environ.pop('NO_PROXY', None)
+                mygit.clone('http://git.example.invalid/repo.git',
+                            os.path.join(self.temp_dir, 'clone'))
+        self.assertEqual(git('rev-parse', 'HEAD').decode().strip(),
+                         self.remote_git('rev-parse', 'main'))
+        self.assertEqual({netloc for _, netloc, _ in
+                          self.server.requests[2:]}, {'git.example.invalid'})
+
+    def test_clone_rejects_crafted_tree(self):
+        config = self.remote_git('hash-object', '-w', '--stdin',
+                                 input=b'[core]\n\tfsmonitor = touch pwned\n')
+        readme = self.remote_git('hash-object', '-w', '--stdin', input=b'hi\n')
+        subtree = self.remote_git(
+                'hash-object', '-t', 'tree', '-w', '--stdin', '--literally',
+                input=b'100644 config\x00' + bytes.fromhex(config))
+        for i, name in enumerate(['.git', '.GIT', '..', 'a/b']):
+            with self.subTest(name=name):
+                tree = self.remote_git(
+                        'hash-object', '-t', 'tree', '-w', '--stdin',
+                        '--literally', input=b'40000 ' + name.encode() +
+                        b'\x00' + bytes.fromhex(subtree) + b'100644 README\x00' +
+                        bytes.fromhex(readme))
+                commit = self.remote_git('commit-tree', '-m', 'crafted', tree)
+                self.remote_git('update-ref', 'refs/heads/main', commit)
+                clone_dir = os.path.join(self.temp_dir, 'clone{}'.format(i))
+                reset_caches()
+                with contextlib.redirect_stdout(io.StringIO()), \
+                        self.assertRaisesRegex(ValueError, 'invalid path'):
+                    mygit.clone(self.base_url + '/repo.git', clone_dir)
+                os.chdir(self.repo)
+                self.assertEqual(sorted(os.listdir(clone_dir)), ['.git'])
+                self.assertFalse(os.path.exists(
+                        os.path.join(clone_dir, '.git', 'config')))
+        #git itself can't serve a tree with an empty name
+        mygit.verify_tree_entry_name('README')
+        for name in ['', 'a\x00b']:
+            with self.subTest(name=name), self.assertRaises(ValueError):
+                mygit.verify_tree_entry_name(name)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'),
+                     'daemon needs Unix sockets')
+class DaemonTests(RepoTestCase):
+
+    def mygit_client(self, *args, input=None):
+        #Run command with the thin client, return its stdout
+        return subprocess.run(
+                [sys.executable, os.path.join(os.path.dirname(
+                mygit.__file__), 'mygit_client.py')] + list(args),
+                input=input, stdout=subprocess.PIPE, check=True).stdout
+
+    def test_commands_through_daemon(self):
+        self.commit_history(commits=2)
+        daemon = subprocess.Popen([sys.executable, mygit.__file__, 'daemon'],
+                                  stdout=subprocess.PIPE)
+        self.addCleanup(daemon.wait)
+        self.assertIn(b'listening', daemon.stdout.readline())
+        try:
+            mode = os.stat(mygit.DAEMON_SOCKET).st_mode
+            self.assertEqual(mode & 0o777, 0o600)
+            self.assertEqual(self.mygit_client('ls-files', '-s'),
+                             git('ls-files', '-s'))
+            head = git('rev-parse', 'HEAD')
+            self.assertEqual(self.mygit_client('cat-file', '--batch-check',
+                                               input=head),
+                             git('cat-file', '--batch-check', input=head))
+        finally:
+            self.mygit_client('daemon', '--stop')
+        daemon.stdout.close()
+        self.assertEqual(daemon.wait(), 0)
+        self.assertFalse(os.path.exists(mygit.DAEMON_SOCKET))
+
+    def test_command_frame(self):
+        argv = ['commit', '-m', 'a=b c\u00e9']
+        env = {'HOME': '/home/x', 'EMPTY': '', 'EQUALS': 'a=b'}
+        data = mygit_client.encode_command(argv, '/tmp/repo', env)
+        self.assertEqual(mygit_client.decode_command(data),
+                         dict(argv=argv, cwd='/tmp/repo', env=env))
+
+
+if __name__ == '__main__':
+    unittest.main()